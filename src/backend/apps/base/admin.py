@@ -1,16 +1,36 @@
 from django.contrib import admin
 
+from .live_state import LiveStateRing
 from .models import Battery, Inverter, InverterPool, TestCase
 
 
+def live_values(device, port, fields):
+    ring = LiveStateRing.open(device, port) if port else None
+    if ring is None:
+        return '-'
+    sample = ring.latest()
+    ring.close()
+    if sample is None:
+        return '-'
+    return ', '.join('{} {:.2f}'.format(field, sample[field]) for field in fields)
+
+
 class BatteryAdmin(admin.ModelAdmin):
     model = Battery
-    list_display = ('name', 'serial_number', 'port')
+    list_display = ('name', 'serial_number', 'port', 'get_live_state')
+
+    def get_live_state(self, instance):
+        return live_values('battery', instance.port, ('dc_current', 'cv_1', 'pack_temp'))
+    get_live_state.short_description = 'Live'
 
 
 class InverterAdmin(admin.ModelAdmin):
     model = Inverter
-    list_display = ('name', 'state', 'setpoint', 'port',)
+    list_display = ('name', 'state', 'setpoint', 'port', 'get_live_state')
+
+    def get_live_state(self, instance):
+        return live_values('inverter', instance.port, ('dc_voltage', 'dc_current', 'ac_voltage'))
+    get_live_state.short_description = 'Live'
 
 
 class InverterPoolAdmin(admin.ModelAdmin):
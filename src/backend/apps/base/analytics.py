@@ -0,0 +1,145 @@
+"""
+Post-test analytics.
+
+compute_report() works on the columnar archive of a finished test case (archive.py) with whole-array NumPy
+operations, no per-sample Python loop:
+    1. charge / discharge capacity (trapezoidal, sample gaps above INTEGRATOR_MAX_GAP are not integrated)
+       and coulombic efficiency
+    2. DC internal resistance from the current steps (|dV / dI| where the current jumps by DCIR_MIN_STEP amps)
+    3. cell imbalance over cv_1..cv_9 (spread between the highest and the lowest cell, per cell deviation)
+    4. temperature rise of the cells and the mosfets
+Positive pack current discharges the pack (same convention as the BATTERY_OCP check).
+
+analyse_test_cases() computes the reports of a batch of test cases in a process pool. The workers only read the
+memory mapped archives; the database is used by the calling process alone.
+Nothing here archives: that is the job of the archive_telemetry task scheduled by the teardown. A test case without
+an archive yet has no report.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from django.conf import settings
+
+from .archive import TestCaseArchive, open_archive
+from .log import log_test_case
+from .telemetry import CELL_COLUMNS
+
+DISCHARGE_SIGN = 1
+# current jump (A) between two consecutive samples that counts as a current step for the DCIR
+DCIR_MIN_STEP = 5.0
+
+
+def _integrate(timestamps, values, max_gap):
+    """
+        Trapezoidal integral of values over timestamps (seconds), intervals longer than max_gap excluded.
+    """
+    if len(timestamps) < 2:
+        return 0.0
+    dt = np.diff(timestamps)
+    areas = (values[1:] + values[:-1]) * dt / 2
+    valid = (dt > 0) & (dt <= max_gap) & ~np.isnan(areas)
+    return float(areas[valid].sum())
+
+
+def _capacity(timestamps, current, voltage, max_gap):
+    discharge_current = np.clip(current * DISCHARGE_SIGN, 0, None)
+    charge_current = np.clip(-current * DISCHARGE_SIGN, 0, None)
+    discharge_ah = _integrate(timestamps, discharge_current, max_gap) / 3600
+    charge_ah = _integrate(timestamps, charge_current, max_gap) / 3600
+    return {'discharge_ah': discharge_ah,
+            'charge_ah': charge_ah,
+            'discharge_wh': _integrate(timestamps, discharge_current * voltage, max_gap) / 3600,
+            'charge_wh': _integrate(timestamps, charge_current * voltage, max_gap) / 3600,
+            'coulombic_efficiency': discharge_ah / charge_ah if charge_ah else None}
+
+
+def _dcir(timestamps, current, voltage, max_gap):
+    d_current = np.diff(current)
+    d_voltage = np.diff(voltage)
+    steps = (np.abs(d_current) >= DCIR_MIN_STEP) & (np.diff(timestamps) <= max_gap) & ~np.isnan(d_voltage)
+    if not steps.any():
+        return {'dcir_ohm': None, 'dcir_steps': 0}
+    resistances = np.abs(d_voltage[steps] / d_current[steps])
+    return {'dcir_ohm': float(np.median(resistances)),
+            'dcir_min_ohm': float(resistances.min()),
+            'dcir_max_ohm': float(resistances.max()),
+            'dcir_steps': int(steps.sum())}
+
+
+def _imbalance(cells):
+    valid = ~np.isnan(cells).any(axis=1)
+    cells = cells[valid]
+    if not len(cells):
+        return {'imbalance_mean_v': None}
+    spread = cells.max(axis=1) - cells.min(axis=1)
+    deviation = cells - cells.mean(axis=1, keepdims=True)
+    return {'imbalance_mean_v': float(spread.mean()),
+            'imbalance_max_v': float(spread.max()),
+            'imbalance_p95_v': float(np.percentile(spread, 95)),
+            'imbalance_final_v': float(spread[-1]),
+            'cell_mean_deviation_v': [float(value) for value in deviation.mean(axis=0)],
+            'weakest_cell': int(deviation.mean(axis=0).argmin()) + 1}
+
+
+def _temperature_rise(values):
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return None
+    return float(values.max() - values[0])
+
+
+def compute_report(archive_path, max_gap=10.0):
+    """
+        Report of one archived test case. Plain data in, plain data out (runs in the pool workers).
+    """
+    archive = TestCaseArchive(archive_path)
+    timestamps = np.asarray(archive.column('battery', 'timestamp'))
+    report = {'samples': int(len(timestamps))}
+    if len(timestamps) < 2:
+        return report
+    current = np.asarray(archive.column('battery', 'dc_current'))
+    voltage = np.asarray(archive.column('battery', 'dc_voltage'))
+    cells = np.column_stack([archive.column('battery', column) for column in CELL_COLUMNS])
+    report['duration_s'] = float(timestamps[-1] - timestamps[0])
+    report.update(_capacity(timestamps, current, voltage, max_gap))
+    report.update(_dcir(timestamps, current, voltage, max_gap))
+    report.update(_imbalance(cells))
+    report['pack_temperature_rise'] = _temperature_rise(np.asarray(archive.column('battery', 'pack_temp')))
+    report['mosfet_temperature_rise'] = _temperature_rise(np.asarray(archive.column('battery', 'mosfet_temp')))
+    return report
+
+
+def _archive_path(test_case):
+    archive = open_archive(test_case)
+    return None if archive is None else archive.path
+
+
+def analyse_test_case(test_case):
+    """
+        Report of a test case, None until its archive is written.
+    """
+    path = _archive_path(test_case)
+    if path is None:
+        return None
+    return compute_report(path, getattr(settings, 'INTEGRATOR_MAX_GAP', 10.0))
+
+
+def analyse_test_cases(test_cases, processes=None):
+    """
+        Reports of several test cases ({test_case_id: report}), computed in parallel. Test cases without an
+        archive get {'error': ...}.
+    """
+    max_gap = getattr(settings, 'INTEGRATOR_MAX_GAP', 10.0)
+    paths = {test_case.id: _archive_path(test_case) for test_case in test_cases}
+    reports = {test_case_id: {'error': 'not archived yet'} for test_case_id, path in paths.items() if path is None}
+    paths = {test_case_id: path for test_case_id, path in paths.items() if path is not None}
+    with ProcessPoolExecutor(max_workers=processes or os.cpu_count()) as pool:
+        futures = {test_case_id: pool.submit(compute_report, path, max_gap) for test_case_id, path in paths.items()}
+        for test_case_id, future in futures.items():
+            try:
+                reports[test_case_id] = future.result()
+            except Exception as err:
+                log_test_case.exception('Report of test case %s failed. Error is: %s', test_case_id, err)
+                reports[test_case_id] = {'error': str(err)}
+    return reports
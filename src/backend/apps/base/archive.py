@@ -0,0 +1,116 @@
+"""
+Columnar archive of the telemetry of a finished test case.
+
+Once a test case is FINISHED its TelemetrySample rows are compacted into one directory per test case under
+ARCHIVE_DIR, with one .npy file per device and column (battery/cv_1.npy, inverter/ac_voltage.npy, ...) sorted by
+timestamp. TestCase.archive_path points at it. Reads go through np.load(mmap_mode='r'): loading one column of a
+multi-day test only pages in that column.
+
+(Parquet would need pyarrow, which is not a dependency; plain .npy files only need the NumPy we already have.)
+"""
+import os
+import shutil
+
+import numpy as np
+from django.conf import settings
+
+from .log import log_test_case
+from .telemetry import DEVICE_COLUMNS
+
+# rows fetched from the database per chunk while archiving
+ARCHIVE_CHUNK_SIZE = 20000
+
+
+def get_archive_dir(test_case_id):
+    return os.path.join(settings.ARCHIVE_DIR, 'test_case_{}'.format(test_case_id))
+
+
+def _archive_device(samples, device, directory):
+    queryset = samples.filter(device=device).order_by('timestamp')
+    count = queryset.count()
+    columns = DEVICE_COLUMNS[device]
+    os.makedirs(directory)
+    arrays = [np.lib.format.open_memmap(os.path.join(directory, '{}.npy'.format(column)), mode='w+',
+                                        dtype=np.int64 if column == 'flags' else np.float64, shape=(count,))
+              for column in columns]
+    row = 0
+    chunk = []
+    for values in queryset.values_list(*columns).iterator():
+        chunk.append(values)
+        if len(chunk) == ARCHIVE_CHUNK_SIZE:
+            row = _write_chunk(arrays, chunk, row)
+            chunk = []
+    if chunk:
+        row = _write_chunk(arrays, chunk, row)
+    for array in arrays:
+        array.flush()
+    return row
+
+
+def _write_chunk(arrays, chunk, row):
+    # None (column not filled) becomes NaN
+    block = np.array(chunk, dtype=np.float64)
+    for index, array in enumerate(arrays):
+        array[row:row + len(block)] = block[:, index]
+    return row + len(block)
+
+
+def archive_test_case(test_case):
+    """
+        Writes the archive of test_case and stores its path on the model. Returns the path.
+        An existing archive is replaced.
+    """
+    from .models import TelemetrySample
+    directory = get_archive_dir(test_case.id)
+    temporary = directory + '.tmp'
+    if os.path.exists(temporary):
+        shutil.rmtree(temporary)
+    samples = TelemetrySample.objects.filter(test_case=test_case)
+    rows = {device: _archive_device(samples, device, os.path.join(temporary, device)) for device in DEVICE_COLUMNS}
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.rename(temporary, directory)
+    test_case.archive_path = directory
+    test_case.save(update_fields=['archive_path'])
+    log_test_case.info('Archived test case %s to %s (%s).', test_case.id, directory, rows)
+    return directory
+
+
+class TestCaseArchive(object):
+    """
+        Read side of an archive. Columns are memory mapped, nothing is read until it is used.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def columns(self, device):
+        directory = os.path.join(self.path, device)
+        return sorted(name[:-4] for name in os.listdir(directory) if name.endswith('.npy'))
+
+    def column(self, device, name):
+        return np.load(os.path.join(self.path, device, '{}.npy'.format(name)), mmap_mode='r')
+
+    def __len__(self):
+        return sum(len(self.column(device, 'timestamp')) for device in DEVICE_COLUMNS)
+
+
+def open_archive(test_case):
+    if not test_case.archive_path or not os.path.isdir(test_case.archive_path):
+        return None
+    return TestCaseArchive(test_case.archive_path)
+
+
+def read_channel(test_case, device, column):
+    """
+        (timestamps, values) of one channel of a test case: from the archive if there is one, from the
+        TelemetrySample table otherwise.
+    """
+    archive = open_archive(test_case)
+    if archive is not None:
+        return archive.column(device, 'timestamp'), archive.column(device, column)
+    from .models import TelemetrySample
+    rows = (TelemetrySample.objects.filter(test_case=test_case, device=device).order_by('timestamp')
+            .values_list('timestamp', column))
+    values = np.array(list(rows.iterator()), dtype=np.float64).reshape(-1, 2)
+    return values[:, 0], values[:, 1]
@@ -0,0 +1,224 @@
+"""
+Telemetry backfill from the rotating device logs.
+
+Earlier releases of the drivers logged one value line per decoded frame:
+    Pack values updated on port <port>. Pack serial number: <serial>. Cells: <cv_1> .. <cv_9>. Current: <A>.
+        Temperatures: <mosfet>/<pack>. Flags: <flags>
+    DC frame on port <port>: <V> V, <A> A
+    AC frame on port <port>: <V> V, <A> A
+The drivers no longer do (the telemetry writer records every sample, logging it on the engine loop only cost
+time), so only the logs written by those releases can be imported; newer logs yield no samples.
+backfill_log_file() turns them into TelemetrySample rows (test_case None, the logs do not know it) and inserts
+them with bulk_create in batches of BACKFILL_BATCH_SIZE. Lines are prefiltered with a substring test and only the
+candidates go through the precompiled patterns; the timestamp is built from the asctime groups, one mktime per
+second of log. Any other line is skipped.
+
+Progress is checkpointed per file after each inserted batch (byte offset of the last imported line). The checkpoint
+is keyed by the first line of the file, so it follows the file when the RotatingFileHandler renames it, and a rerun
+(or a run after a crash) only imports what was not imported yet. backfill_logs() runs one file per worker process.
+"""
+import glob
+import hashlib
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+
+from .log import log_base
+
+BACKFILL_BATCH_SIZE = 5000
+BACKFILL_LOG_NAMES = ('battery.log', 'inverter.log')
+
+# '%(levelname)-8s %(asctime)s %(filename)s |%(lineno)4d| %(message)s'
+LINE_PATTERN = re.compile(r'^\S+\s+(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d),(\d{3}) \S+ \|\s*\d+\| (.*)$')
+PACK_PATTERN = re.compile(r'^Pack values updated on port (\S+)\. Pack serial number: \S*\. Cells: ([-\d. ]*)\. '
+                          r'Current: ([-\d.]+)\. Temperatures: ([-\d.]+)/([-\d.]+)\. Flags: (\d+)')
+FRAME_PATTERN = re.compile(r'^(DC|AC) frame on port (\S+): ([-\d.]+) V, ([-\d.]+) A')
+PACK_MARKER = 'Pack values updated on port'
+FRAME_MARKER = ' frame on port '
+
+
+def default_log_files():
+    """
+        The battery and inverter logs of this host, the rotated ones included.
+    """
+    directory = os.path.join(settings.BASE_DIR, 'logs')
+    paths = []
+    for name in BACKFILL_LOG_NAMES:
+        paths.extend(sorted(glob.glob(os.path.join(directory, name + '*'))))
+    return paths
+
+
+def default_checkpoint_dir():
+    return os.path.join(settings.BASE_DIR, 'logs', 'backfill')
+
+
+def file_key(path):
+    """
+        Identity of a log file across rotations: hash of its first line. None for an empty file.
+    """
+    with open(path, 'rb') as log_file:
+        first_line = log_file.readline()
+    if not first_line:
+        return None
+    return hashlib.sha1(first_line).hexdigest()
+
+
+class Checkpoint(object):
+    """
+        Byte offset of the last imported line of one log file, stored as a small JSON file.
+    """
+
+    def __init__(self, directory, key):
+        self.path = os.path.join(directory, '{}.json'.format(key))
+
+    def load(self):
+        try:
+            with open(self.path) as checkpoint_file:
+                return json.load(checkpoint_file)['offset']
+        except (IOError, OSError, ValueError, KeyError):
+            return 0
+
+    def save(self, offset, source):
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as checkpoint_file:
+            json.dump({'offset': offset, 'source': source, 'updated': time.time()}, checkpoint_file)
+        # atomic, a crash never leaves a half written checkpoint
+        os.replace(temporary, self.path)
+
+
+class LogParser(object):
+    """
+        Turns value lines into TelemetrySample keyword arguments. The inverter logs the DC and AC frames on
+        separate lines; each frame line gives a sample with the last known values of the other frame.
+    """
+
+    def __init__(self):
+        self._second = None
+        self._epoch = 0.0
+        # port -> [dc_voltage, dc_current, ac_voltage, ac_current]
+        self.inverters = {}
+
+    def timestamp(self, match):
+        second = match.group(1, 2, 3, 4, 5, 6)
+        if second != self._second:
+            self._second = second
+            self._epoch = time.mktime(tuple(int(value) for value in second) + (0, 0, -1))
+        return self._epoch + int(match.group(7)) / 1000
+
+    def parse(self, line):
+        if PACK_MARKER in line:
+            return self._pack(line)
+        if FRAME_MARKER in line:
+            return self._frame(line)
+        return None
+
+    def _pack(self, line):
+        match = LINE_PATTERN.match(line)
+        values = match and PACK_PATTERN.match(match.group(8))
+        if not values:
+            return None
+        port, cells, current, mosfet_temp, pack_temp, flags = values.groups()
+        cells = [float(cv) for cv in cells.split()]
+        sample = {'device': 'battery',
+                  'port': port,
+                  'timestamp': self.timestamp(match),
+                  'dc_voltage': sum(cells),
+                  'dc_current': float(current),
+                  'mosfet_temp': float(mosfet_temp),
+                  'pack_temp': float(pack_temp),
+                  'flags': int(flags)}
+        for index, cv in enumerate(cells, 1):
+            sample['cv_{}'.format(index)] = cv
+        return sample
+
+    def _frame(self, line):
+        match = LINE_PATTERN.match(line)
+        values = match and FRAME_PATTERN.match(match.group(8))
+        if not values:
+            return None
+        frame, port, voltage, current = values.groups()
+        last = self.inverters.setdefault(port, [None, None, None, None])
+        if frame == 'DC':
+            last[0], last[1] = float(voltage), float(current)
+        else:
+            last[2], last[3] = float(voltage), float(current)
+        return {'device': 'inverter',
+                'port': port,
+                'timestamp': self.timestamp(match),
+                'dc_voltage': last[0],
+                'dc_current': last[1],
+                'ac_voltage': last[2],
+                'ac_current': last[3]}
+
+
+def backfill_log_file(path, checkpoint_dir, batch_size=BACKFILL_BATCH_SIZE):
+    """
+        Imports the value lines of one log file from its checkpoint on. Returns (lines read, samples inserted).
+    """
+    from .models import TelemetrySample
+    key = file_key(path)
+    if key is None:
+        return 0, 0
+    checkpoint = Checkpoint(checkpoint_dir, key)
+    offset = checkpoint.load()
+    parser = LogParser()
+    batch = []
+    lines = inserted = 0
+    with open(path, 'rb') as log_file:
+        log_file.seek(offset)
+        for raw_line in log_file:
+            # a line without its newline is still being written, the next run picks it up
+            if not raw_line.endswith(b'\n'):
+                break
+            offset += len(raw_line)
+            lines += 1
+            sample = parser.parse(raw_line.decode('utf-8', 'replace'))
+            if sample is not None:
+                batch.append(TelemetrySample(**sample))
+            if len(batch) >= batch_size:
+                TelemetrySample.objects.bulk_create(batch)
+                inserted += len(batch)
+                batch = []
+                checkpoint.save(offset, path)
+    if batch:
+        TelemetrySample.objects.bulk_create(batch)
+        inserted += len(batch)
+    checkpoint.save(offset, path)
+    return lines, inserted
+
+
+def _backfill_worker(path, checkpoint_dir, batch_size):
+    from django.db import connections
+    # forked from the command process: the apps are loaded, only the database connection is the worker's own
+    try:
+        return backfill_log_file(path, checkpoint_dir, batch_size)
+    finally:
+        connections.close_all()
+
+
+def backfill_logs(paths=None, checkpoint_dir=None, processes=None, batch_size=BACKFILL_BATCH_SIZE):
+    """
+        Backfills several log files in parallel, one file per worker. Returns {path: (lines, samples) or error}.
+    """
+    from django.db import connections
+    paths = default_log_files() if paths is None else list(paths)
+    checkpoint_dir = checkpoint_dir or default_checkpoint_dir()
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    # the workers are forked, they must not share the connections of this process
+    connections.close_all()
+    results = {}
+    with ProcessPoolExecutor(max_workers=processes or os.cpu_count()) as pool:
+        futures = {path: pool.submit(_backfill_worker, path, checkpoint_dir, batch_size) for path in paths}
+        for path, future in futures.items():
+            try:
+                results[path] = future.result()
+            except Exception as err:
+                log_base.exception('Telemetry backfill of %s failed. Error is: %s', path, err)
+                results[path] = str(err)
+                continue
+            log_base.info('Telemetry backfill of %s: %s lines read, %s samples inserted.', path, *results[path])
+    return results
@@ -0,0 +1,289 @@
+"""
+Benchmark suite of the hot paths, run by the benchmark management command.
+
+1. codec: MK2 message construction and frame parsing, USB-ISS status frame decoding (one frame and batches)
+2. safety: the scalar level 2 check of one pack and the FleetSafetyEngine pass over all the rigs
+3. poll: driver round trips against the simulator (pseudo-terminals, see simulator/), for 1 to N rigs polled
+   concurrently on the SerialEngine loop
+4. task: the safety_check task itself (safety_check.run: model lookups, fresh values, integration, level 2
+   check) against Battery/Inverter/TestCase fixture rows, also with the task message going through an in-memory
+   kombu broker. The rows live in a throwaway test database of the configured backend, created like the test
+   runner does (in memory with sqlite) and destroyed at the end.
+
+Every benchmark reports throughput (ops/s), p50/p99 latency of one call and the peak memory allocated by one call
+(tracemalloc). compare() flags the benchmarks whose p50 or throughput got worse than a stored baseline by more than
+a threshold.
+"""
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+from django.test import override_settings
+
+from .protocol import Mk2FrameParser, decode_mk2_dc_frame, decode_status_frame, decode_status_frames
+from .safety import FleetSafetyEngine, LimitProfile
+from .simulator import Mk2Device, PackModel, SimulatorHost, status_frame
+from .utils import UsbIssBattery, VictronMultiplusMK2VCP
+
+# pyserial waits on its ports with select(): one process cannot use file descriptors above FD_SETSIZE (1024) and
+# every open port costs 5 of them (the port and two abort pipes), i.e. a process tops out below 200 ports
+DEFAULT_RIG_COUNTS = (1, 10, 50, 150)
+ALLOCATION_SAMPLES = 50
+
+
+class Benchmark(object):
+    """
+        func is called iterations times. One call does ops operations (e.g. one poll of every rig).
+    """
+
+    def __init__(self, name, func, iterations=1000, ops=1, warmup=None):
+        self.name = name
+        self.func = func
+        self.iterations = iterations
+        self.ops = ops
+        self.warmup = max(1, iterations // 10) if warmup is None else warmup
+
+    def run(self, scale=1.0):
+        func = self.func
+        iterations = max(1, int(self.iterations * scale))
+        for _ in range(self.warmup):
+            func()
+        timings = np.empty(iterations)
+        clock = time.perf_counter
+        for index in range(iterations):
+            started = clock()
+            func()
+            timings[index] = clock() - started
+
+        tracemalloc.start()
+        peaks = []
+        for _ in range(min(ALLOCATION_SAMPLES, iterations)):
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            func()
+            peaks.append(tracemalloc.get_traced_memory()[1] - current)
+        tracemalloc.stop()
+
+        total = float(timings.sum())
+        return {'iterations': iterations,
+                'ops': self.ops,
+                'ops_per_s': iterations * self.ops / total if total else None,
+                'mean_us': float(timings.mean() * 1e6),
+                'p50_us': float(np.percentile(timings, 50) * 1e6),
+                'p99_us': float(np.percentile(timings, 99) * 1e6),
+                'peak_alloc_bytes': int(np.median(peaks))}
+
+
+def codec_benchmarks(inverter):
+    pack = PackModel(1)
+    frame = status_frame(pack)
+    frames = frame * 1000
+    mk2 = Mk2Device(pack)
+    stream = (mk2.dc_frame() + mk2.ac_frame()) * 50
+    dc_frame = mk2.dc_frame()
+    parser = Mk2FrameParser()
+    return [
+        Benchmark('codec.make_message_MK2', lambda: inverter.make_message_MK2(1500), 20000),
+        Benchmark('codec.make_state_message', lambda: inverter.make_state_message(1), 20000),
+        Benchmark('codec.decode_status_frame', lambda: decode_status_frame(frame), 20000),
+        Benchmark('codec.decode_status_frames_1000', lambda: decode_status_frames(frames), 1000, ops=1000),
+        Benchmark('codec.mk2_parser_feed_100', lambda: parser.feed(stream), 2000, ops=100),
+        Benchmark('codec.decode_mk2_dc_frame', lambda: decode_mk2_dc_frame(dc_frame), 20000),
+        Benchmark('codec.get_info_frame_reply', inverter.get_info_frame_reply, 20000),
+    ]
+
+
+def safety_benchmarks(battery, rig_counts):
+    benchmarks = [Benchmark('safety.check_safety_level_2', battery.check_safety_level_2, 20000)]
+    snapshot = decode_status_frame(status_frame(PackModel(1)))
+    for count in rig_counts:
+        fleet = FleetSafetyEngine()
+        ports = ['rig{}'.format(index) for index in range(count)]
+        for port in ports:
+            fleet.register(port, LimitProfile())
+
+        def evaluate(fleet=fleet, ports=ports):
+            for port in ports:
+                fleet.update(port, snapshot)
+            return fleet.evaluate()
+        benchmarks.append(Benchmark('safety.fleet_update_evaluate_{}'.format(count), evaluate, 2000, ops=count))
+    return benchmarks
+
+
+def _wait_for(predicate, timeout=1.0):
+    deadline = time.perf_counter() + timeout
+    while not predicate() and time.perf_counter() < deadline:
+        time.sleep(0.0005)
+
+
+def poll_benchmarks(batteries, inverters, rig_counts):
+    engine = batteries[0].engine
+    battery = batteries[0]
+    inverter = inverters[0]
+
+    def inverter_round_trip():
+        last = inverter.snapshot.last_dc_update
+        inverter.request_DC_frame()
+        _wait_for(lambda: inverter.snapshot.last_dc_update != last)
+
+    benchmarks = [
+        Benchmark('poll.get_pack_status', battery.get_pack_status, 200),
+        Benchmark('poll.update_values', battery.update_values, 200),
+        Benchmark('poll.send_setpoint', inverter.send_setpoint, 1000),
+        Benchmark('poll.inverter_dc_round_trip', inverter_round_trip, 200),
+        Benchmark('poll.inverter_refresh', inverter.refresh, 200),
+    ]
+    for count in rig_counts:
+        selected = batteries[:count]
+
+        async def poll_all(selected=selected):
+            return await asyncio.gather(*[battery.update_values_async() for battery in selected])
+        benchmarks.append(Benchmark('poll.update_values_concurrent_{}'.format(count),
+                                    lambda poll_all=poll_all: engine.run(poll_all()), 50, ops=count))
+    return benchmarks
+
+
+@contextlib.contextmanager
+def benchmark_database():
+    """
+        Throwaway test database for the fixture rows of the task benchmarks. The background writers of the telemetry
+        and of the live fields stay off, they would outlive it.
+    """
+    from django.db import connection
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        with override_settings(TELEMETRY_ENABLED=False, LIVE_FIELDS_ENABLED=False, PORT_DAEMON_ADDRESS=None):
+            yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def _fixture_rows(battery):
+    """
+        Battery (on the port of the benchmark driver), Inverter and RUNNING TestCase rows. Returns the safety_check
+        arguments.
+    """
+    from .models import Battery, Inverter, InverterPool, TestCase
+    # Battery.battery_utilities hands out the driver already open on the port
+    UsbIssBattery.battery_instances[battery.com_port] = battery
+    battery_row = Battery.objects.create(name='benchmark', port=battery.com_port)
+    inverter_row = Inverter.objects.create(name='benchmark', port='benchmark',
+                                           inverter_pool=InverterPool.objects.create(name='benchmark'))
+    # bulk_create sends no post_save: no main_task for the benchmark test case
+    TestCase.objects.bulk_create([TestCase(name='benchmark', battery=battery_row, inverter=inverter_row,
+                                           state='RUNNING')])
+    test_case = TestCase.objects.get(battery=battery_row)
+    return [battery_row.id, inverter_row.id, test_case.id, None, None, None, 'benchmark']
+
+
+def task_benchmarks(battery):
+    """
+        Call within benchmark_database().
+    """
+    from .tasks import safety_check
+    arguments = _fixture_rows(battery)
+
+    benchmarks = [Benchmark('task.safety_check', lambda: safety_check.run(*arguments), 200)]
+    try:
+        from kombu import Connection
+    except ImportError:
+        return benchmarks
+    connection = Connection('memory://')
+    queue = connection.SimpleQueue('benchmark')
+
+    def safety_check_through_broker():
+        queue.put({'task': 'backend.apps.base.tasks.safety_check', 'args': arguments})
+        message = queue.get(timeout=1)
+        message.ack()
+        safety_check.run(*message.payload['args'])
+    benchmarks.append(Benchmark('task.safety_check_memory_broker', safety_check_through_broker, 200))
+    return benchmarks
+
+
+def _serve_simulator(rigs, connection):
+    # cells at about 3.5 V, inside the limits: the safety_check benchmarks stay on the path of a healthy pack
+    host = SimulatorHost(rigs, link_dir=None, soc=0.15)
+    host.start()
+    connection.send(host.ports())
+    # blocks until run_benchmarks is done
+    connection.recv()
+    host.stop()
+
+
+def run_benchmarks(rig_counts=DEFAULT_RIG_COUNTS, scale=1.0, name_filter=None, progress=None):
+    """
+        Runs the suite against max(rig_counts) simulated rigs. Returns the results document (see compare()).
+        The simulator runs in a child process, its pty file descriptors do not count against this one.
+    """
+    connection, child_connection = multiprocessing.Pipe()
+    simulator = multiprocessing.get_context('fork').Process(target=_serve_simulator,
+                                                            args=(max(rig_counts), child_connection), daemon=True)
+    simulator.start()
+    ports = connection.recv()
+    batteries = [UsbIssBattery(rig['battery_port']) for rig in ports]
+    # only the first inverter is exercised
+    inverters = [VictronMultiplusMK2VCP(ports[0]['inverter_port'])]
+    results = {}
+    try:
+        batteries[0].configure_USB_ISS()
+        for battery in batteries:
+            battery.turn_pack_on()
+        inverters[0].prepare_inverter()
+        inverters[0].set_point = 1000
+        inverters[0].send_state(1)
+        batteries[0].update_values()
+
+        with benchmark_database():
+            benchmarks = (codec_benchmarks(inverters[0]) + safety_benchmarks(batteries[0], rig_counts) +
+                          poll_benchmarks(batteries, inverters, rig_counts) + task_benchmarks(batteries[0]))
+            for benchmark in benchmarks:
+                if name_filter and name_filter not in benchmark.name:
+                    continue
+                results[benchmark.name] = benchmark.run(scale)
+                if progress is not None:
+                    progress(benchmark.name, results[benchmark.name])
+    finally:
+        inverters[0].stop()
+        for device in batteries + inverters:
+            device.close_coms()
+        connection.send('stop')
+        simulator.join()
+    return {'meta': {'timestamp': time.time(),
+                     'python': platform.python_version(),
+                     'machine': platform.machine(),
+                     'node': platform.node(),
+                     'rigs': max(rig_counts)},
+            'results': results}
+
+
+def compare(results, baseline, threshold=0.15):
+    """
+        Benchmarks slower than the baseline: p50 latency up or throughput down by more than threshold.
+        Returns a list of (name, metric, baseline value, value).
+    """
+    regressions = []
+    for name, result in sorted(results['results'].items()):
+        reference = baseline['results'].get(name)
+        if reference is None:
+            continue
+        if reference['p50_us'] and result['p50_us'] > reference['p50_us'] * (1 + threshold):
+            regressions.append((name, 'p50_us', reference['p50_us'], result['p50_us']))
+        if reference['ops_per_s'] and result['ops_per_s'] < reference['ops_per_s'] * (1 - threshold):
+            regressions.append((name, 'ops_per_s', reference['ops_per_s'], result['ops_per_s']))
+    return regressions
+
+
+def load_results(path):
+    with open(path) as results_file:
+        return json.load(results_file)
+
+
+def save_results(results, path):
+    with open(path, 'w') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
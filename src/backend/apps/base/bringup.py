@@ -0,0 +1,61 @@
+"""
+Parallel bring-up of the rigs of this host.
+
+Every battery (USB-ISS configuration, pack on) and every inverter (VE bus handshake) is brought up concurrently on the
+SerialEngine loop. The drivers wait on the device replies instead of fixed sleeps, so a bay comes up in about the
+time of its slowest device. The port daemon does it at start (BRING_UP_AT_START) for every port in the database;
+main_task then finds its rig ready and only turns the pack on.
+"""
+import asyncio
+import time
+
+from django.conf import settings
+
+from .log import log_base
+from .supervisor import get_local_battery, get_local_inverter
+
+
+async def _bring_up(device_type, port):
+    try:
+        if device_type == 'battery':
+            device = get_local_battery(port)
+            ok = await device.bring_up_async()
+        else:
+            device = get_local_inverter(port)
+            ok = await device.prepare_inverter_async()
+    except Exception as err:
+        log_base.exception('Bring-up of %s on port %s failed. Error is: %s', device_type, port, err)
+        return {'device': device_type, 'port': port, 'ok': False, 'seconds': None}
+    return {'device': device_type, 'port': port, 'ok': ok, 'seconds': device.bring_up_seconds if ok else None}
+
+
+async def bring_up_ports_async(battery_ports=(), inverter_ports=()):
+    return await asyncio.gather(*([_bring_up('battery', port) for port in battery_ports] +
+                                  [_bring_up('inverter', port) for port in inverter_ports]))
+
+
+def bring_up_ports(battery_ports=(), inverter_ports=()):
+    """
+        Brings the given ports up concurrently. Returns one {'device', 'port', 'ok', 'seconds'} per port.
+    """
+    from .transport import SerialEngine
+    started = time.perf_counter()
+    results = SerialEngine.get_engine().run(bring_up_ports_async(battery_ports, inverter_ports))
+    failed = [result['port'] for result in results if not result['ok']]
+    log_base.info('Brought up %s of %s devices in %.3f s. Failed: %s', len(results) - len(failed), len(results),
+                  time.perf_counter() - started, failed or 'none')
+    return results
+
+
+def bring_up_host():
+    """
+        Brings up every battery and inverter port found in the database.
+    """
+    from .models import Battery, Inverter
+    battery_ports = Battery.objects.exclude(port__isnull=True).exclude(port='').values_list('port', flat=True)
+    inverter_ports = Inverter.objects.exclude(port__isnull=True).exclude(port='').values_list('port', flat=True)
+    return bring_up_ports(sorted(set(battery_ports)), sorted(set(inverter_ports)))
+
+
+def is_bring_up_at_start_enabled():
+    return getattr(settings, 'BRING_UP_AT_START', False)
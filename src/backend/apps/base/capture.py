@@ -0,0 +1,451 @@
+"""
+Raw serial capture and replay.
+
+With SERIAL_CAPTURE_ENABLED every SerialTransport hands the bytes it reads and writes to the CaptureWriter, which
+appends them to one capture file per port from a background thread (the engine loop only appends to a list).
+
+Capture file:
+    header: CAPTURE_MAGIC, uint16 port name length, port name (utf-8), float64 wall clock time of the first record
+            minus its monotonic time (to date the records)
+    records: uint64 monotonic nanoseconds, uint8 direction (CAPTURE_RX / CAPTURE_TX), uint32 length, the bytes
+A file is closed and a new one started once it is larger than SERIAL_CAPTURE_MAX_BYTES.
+
+ReplaySerial stands in for the pyserial handle of a driver and plays the RX side of a capture back:
+    1. realtime: the bytes captured after the n-th write become readable with their original delay after the n-th
+       write of the driver (the bytes before the first write with their offset from the start of the replay)
+    2. as fast as possible: the bytes captured after the n-th write become readable when the driver does its n-th
+       write, i.e. every reply comes right after the request that triggered it
+The writes of the driver are compared with the captured ones (tx_mismatches), which makes a replay a regression run.
+replay_capture() rebuilds the driver calls out of the captured writes and runs them against a ReplaySerial (the
+driver's own sleeps, e.g. the status reply delay, still apply in both modes).
+"""
+import asyncio
+import fcntl
+import heapq
+import os
+import re
+import struct
+import termios
+import threading
+import time
+
+from django.conf import settings
+
+from .log import log_base
+
+CAPTURE_MAGIC = b'BMSCAP\x01'
+CAPTURE_RX = 0
+CAPTURE_TX = 1
+RECORD_HEADER = struct.Struct('<QBI')
+HEADER_PREFIX = struct.Struct('<H')
+HEADER_SUFFIX = struct.Struct('<d')
+
+
+def _capture_name(port):
+    return re.sub(r'[^A-Za-z0-9]', '_', port)
+
+
+class CaptureFile(object):
+
+    def __init__(self, directory, port, max_bytes):
+        self.directory = directory
+        self.port = port
+        self.max_bytes = max_bytes
+        self.handle = None
+        self.size = 0
+
+    def _open(self, first_timestamp):
+        path = os.path.join(self.directory, '{}_{}.cap'.format(_capture_name(self.port),
+                                                              time.strftime('%Y%m%d_%H%M%S')))
+        if os.path.exists(path):
+            path = path[:-4] + '_{}.cap'.format(first_timestamp)
+        self.handle = open(path, 'wb', buffering=1 << 16)
+        name = self.port.encode('utf-8')
+        header = CAPTURE_MAGIC + HEADER_PREFIX.pack(len(name)) + name + \
+            HEADER_SUFFIX.pack(time.time() - time.monotonic())
+        self.handle.write(header)
+        self.size = len(header)
+
+    def write(self, records):
+        for timestamp, direction, data in records:
+            if self.handle is None or self.size > self.max_bytes:
+                self.close()
+                self._open(timestamp)
+            self.handle.write(RECORD_HEADER.pack(timestamp, direction, len(data)))
+            self.handle.write(data)
+            self.size += RECORD_HEADER.size + len(data)
+        self.handle.flush()
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+
+class CaptureWriter(object):
+    """
+        Buffered background writer of the captures of all the ports of this process. Use get_capture_writer().
+    """
+
+    def __init__(self, directory, flush_interval=1.0, max_bytes=64 << 20):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        # port -> [(monotonic ns, direction, bytes)]
+        self.pending = {}
+        self.files = {}
+        self.records_written = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flusher = None
+
+    def record(self, port, direction, data):
+        """
+            Called from the engine loop for every chunk read or written. No I/O.
+        """
+        entry = (time.monotonic_ns(), direction, bytes(data))
+        with self._lock:
+            records = self.pending.get(port)
+            if records is None:
+                records = self.pending[port] = []
+            records.append(entry)
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run, name='serial_capture')
+                self._flusher.daemon = True
+                self._flusher.start()
+
+    def flush(self):
+        with self._lock:
+            pending, self.pending = self.pending, {}
+        for port, records in pending.items():
+            capture = self.files.get(port)
+            if capture is None:
+                capture = self.files[port] = CaptureFile(self.directory, port, self.max_bytes)
+            try:
+                capture.write(records)
+            except Exception as err:
+                log_base.exception('Dropped %s capture records of port %s. Error is: %s', len(records), port, err)
+                continue
+            self.records_written += len(records)
+
+    def close(self):
+        self.flush()
+        for capture in self.files.values():
+            capture.close()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_capture_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            directory = getattr(settings, 'SERIAL_CAPTURE_DIR')
+            os.makedirs(directory, exist_ok=True)
+            _writer = CaptureWriter(directory,
+                                    flush_interval=getattr(settings, 'SERIAL_CAPTURE_FLUSH_INTERVAL', 1.0),
+                                    max_bytes=getattr(settings, 'SERIAL_CAPTURE_MAX_BYTES', 64 << 20))
+            import atexit
+            atexit.register(_writer.close)
+        return _writer
+
+
+def is_capture_enabled(port):
+    if not getattr(settings, 'SERIAL_CAPTURE_ENABLED', False):
+        return False
+    ports = getattr(settings, 'SERIAL_CAPTURE_PORTS', None)
+    return not ports or port in ports
+
+
+def read_capture(path):
+    """
+        Returns (port, wall clock offset, records) of a capture file; records is a list of
+        (monotonic ns, direction, bytes). A truncated last record (crash while writing) is dropped.
+    """
+    with open(path, 'rb') as capture:
+        content = capture.read()
+    if not content.startswith(CAPTURE_MAGIC):
+        raise ValueError('{} is not a serial capture'.format(path))
+    position = len(CAPTURE_MAGIC)
+    name_length, = HEADER_PREFIX.unpack_from(content, position)
+    position += HEADER_PREFIX.size
+    port = content[position:position + name_length].decode('utf-8')
+    position += name_length
+    offset, = HEADER_SUFFIX.unpack_from(content, position)
+    position += HEADER_SUFFIX.size
+    records = []
+    view = memoryview(content)
+    while position + RECORD_HEADER.size <= len(content):
+        timestamp, direction, length = RECORD_HEADER.unpack_from(content, position)
+        position += RECORD_HEADER.size
+        if position + length > len(content):
+            break
+        records.append((timestamp, direction, bytes(view[position:position + length])))
+        position += length
+    return port, offset, records
+
+
+class ReplaySerial(object):
+    """
+        pyserial look-alike playing back the RX side of a capture. Pass it as the serial_handle of a driver (see
+        replay_capture). The replayed bytes go through a pipe, so SerialTransport watches it like a real port.
+    """
+
+    def __init__(self, records, realtime=False, port='replay'):
+        self.port = port
+        self.realtime = realtime
+        self.timeout = 0
+        self.baudrate = None
+        self.is_open = True
+        # RX chunks grouped by the number of writes that precede them in the capture
+        self.rx_groups = []
+        self.tx_expected = []
+        self.tx_offsets = []
+        group = []
+        first = records[0][0] if records else 0
+        for timestamp, direction, data in records:
+            if direction == CAPTURE_TX:
+                self.rx_groups.append(group)
+                self.tx_expected.append(data)
+                self.tx_offsets.append((timestamp - first) / 1e9)
+                group = []
+            else:
+                group.append(((timestamp - first) / 1e9, data))
+        self.rx_groups.append(group)
+        self.writes = 0
+        self.tx_mismatches = 0
+        self.bytes_replayed = 0
+        self._read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self._read_fd, False)
+        self._started = time.monotonic()
+        # realtime: (due monotonic time, sequence, bytes) released by the feeder thread
+        self._due = []
+        self._due_changed = threading.Condition()
+        self._feeder = None
+        if realtime:
+            self._feeder = threading.Thread(target=self._feed_realtime, name='replay_{}'.format(port))
+            self._feeder.daemon = True
+            self._feeder.start()
+        self._release(0)
+
+    @classmethod
+    def from_file(cls, path, realtime=False):
+        port, _, records = read_capture(path)
+        return cls(records, realtime=realtime, port=port)
+
+    @property
+    def finished(self):
+        return self.writes >= len(self.tx_expected)
+
+    @property
+    def next_write(self):
+        """
+            (offset in seconds, bytes) of the next captured write, None after the last one.
+        """
+        if self.finished:
+            return None
+        return self.tx_offsets[self.writes], self.tx_expected[self.writes]
+
+    def elapsed(self):
+        return time.monotonic() - self._started
+
+    def _push(self, data):
+        if not self.is_open:
+            return
+        os.write(self._write_fd, data)
+        self.bytes_replayed += len(data)
+
+    def _release(self, index):
+        if index >= len(self.rx_groups):
+            return
+        if not self.realtime:
+            for _, data in self.rx_groups[index]:
+                self._push(data)
+            return
+        now = time.monotonic()
+        # delays relative to the write that triggered the bytes (to the start before the first write)
+        reference = self.tx_offsets[index - 1] if index else 0.0
+        with self._due_changed:
+            for offset, data in self.rx_groups[index]:
+                heapq.heappush(self._due, (now + offset - reference, len(self._due), data))
+            self._due_changed.notify()
+
+    def _feed_realtime(self):
+        with self._due_changed:
+            while self.is_open:
+                if not self._due:
+                    self._due_changed.wait()
+                    continue
+                delay = self._due[0][0] - time.monotonic()
+                if delay > 0:
+                    self._due_changed.wait(delay)
+                    continue
+                self._push(heapq.heappop(self._due)[2])
+
+    # pyserial interface used by the drivers and SerialTransport
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        if self.is_open:
+            with self._due_changed:
+                self.is_open = False
+                self._due_changed.notify()
+            os.close(self._read_fd)
+            os.close(self._write_fd)
+
+    def setDTR(self, value=True):
+        pass
+
+    def fileno(self):
+        return self._read_fd
+
+    @property
+    def in_waiting(self):
+        return struct.unpack('I', fcntl.ioctl(self._read_fd, termios.FIONREAD, b'\x00' * 4))[0]
+
+    def read(self, size=1):
+        try:
+            return os.read(self._read_fd, size)
+        except BlockingIOError:
+            return b''
+
+    def write(self, data):
+        data = bytes(data)
+        if self.writes < len(self.tx_expected) and self.tx_expected[self.writes] != data:
+            self.tx_mismatches += 1
+        self.writes += 1
+        self._release(self.writes)
+        return len(data)
+
+    def reset_input_buffer(self):
+        # the replayed reply of the next write must not be discarded, only what is already readable
+        while self.read(4096):
+            pass
+
+    @property
+    def out_waiting(self):
+        return 0
+
+
+def capture_device(records):
+    """
+        'battery' (USB-ISS commands) or 'inverter' (MK2 frames) out of the first write of a capture, None if unknown.
+    """
+    for _, direction, data in records:
+        if direction != CAPTURE_TX or not data:
+            continue
+        if data[0] in (0x5A, 0x57, 0x54):
+            return 'battery'
+        if len(data) > 2 and data[1] == 0xFF:
+            return 'inverter'
+        return None
+    return None
+
+
+def _battery_call(battery, data):
+    """
+        Coroutine of the UsbIssBattery method that starts with the captured write data, None if there is none.
+    """
+    if data.startswith(b'\x5A\x01'):
+        return battery.configure_USB_ISS_async()
+    if data.startswith(b'\x57\x01\x35'):
+        return battery.turn_pack_on_async()
+    if data.startswith(b'\x57\x01\x34'):
+        return battery.update_values_async()
+    return None
+
+
+def _capture_set_point(inverter, message):
+    set_point = message[11] | message[12] << 8
+    # make_message_MK2 sends negative setpoints as 65535 + setpoint
+    inverter.set_point = set_point - 65535 if set_point > 0x7FFF else set_point
+
+
+def _inverter_call(inverter, data):
+    pipelined = inverter.AC_FRAME_REQUEST + inverter.DC_FRAME_REQUEST
+    if data.startswith(pipelined):
+        setpoint = data[len(pipelined):]
+        if setpoint:
+            _capture_set_point(inverter, setpoint)
+        return inverter.refresh_async(send_setpoint=bool(setpoint))
+    command = data[2:3]
+    if command == b'A':
+        return inverter.configure_ve_bus_async()
+    if command == b'S':
+        return inverter.send_state_async(1 if data[3] == 0x03 else 0)
+    if command == b'W' and len(data) >= 13:
+        _capture_set_point(inverter, data)
+        return inverter.send_setpoint_async()
+    if command == b'F':
+        return inverter.request_DC_frame_async() if data[3] == 0 else inverter.request_AC_frame_async()
+    return None
+
+
+async def _replay(device, replay, call):
+    calls = failures = skipped = 0
+    while not replay.finished:
+        offset, data = replay.next_write
+        if replay.realtime:
+            delay = offset - replay.elapsed()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        coro = call(device, data)
+        if coro is None:
+            # not a driver request (or a partial one): hand the captured bytes over so its replies are released
+            await device.transport.write(data)
+            skipped += 1
+            continue
+        calls += 1
+        if not await coro:
+            failures += 1
+    # let the inverter RX reader take the last replies
+    for _ in range(100):
+        if not replay.in_waiting and not device.transport.rx_buffer:
+            break
+        await asyncio.sleep(0.01)
+    return calls, failures, skipped
+
+
+def replay_capture(path, realtime=False):
+    """
+        Feeds a capture back into a fresh UsbIssBattery / VictronMultiplusMK2VCP, at the original speed (realtime) or
+        as fast as the driver goes. The driver runs on '<port>.replay', the rows of the real port are not touched.
+        Returns the replay statistics and the final snapshot of the driver.
+    """
+    from .utils import UsbIssBattery, VictronMultiplusMK2VCP
+
+    port, _, records = read_capture(path)
+    device_type = capture_device(records)
+    if device_type is None:
+        raise ValueError('{} does not hold USB-ISS or MK2 traffic'.format(path))
+    replay = ReplaySerial(records, realtime=realtime, port=port)
+    replay_port = '{}.replay'.format(port)
+    if device_type == 'battery':
+        device, call = UsbIssBattery(replay_port, serial_handle=replay), _battery_call
+    else:
+        device, call = VictronMultiplusMK2VCP(replay_port, serial_handle=replay), _inverter_call
+    started = time.perf_counter()
+    try:
+        calls, failures, skipped = device.engine.run(_replay(device, replay, call))
+    finally:
+        device.close_coms()
+    return {'port': port,
+            'device': device_type,
+            'records': len(records),
+            'writes': replay.writes,
+            'calls': calls,
+            'failed_calls': failures,
+            'skipped_writes': skipped,
+            'tx_mismatches': replay.tx_mismatches,
+            'bytes_replayed': replay.bytes_replayed,
+            'seconds': time.perf_counter() - started,
+            'snapshot': device.snapshot.as_dict()}
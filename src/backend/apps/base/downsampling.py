@@ -0,0 +1,158 @@
+"""
+Server side downsampling of the telemetry channels.
+
+1. minmax: min/max envelope per bucket, fully vectorised (np.minimum/maximum.reduceat)
+2. lttb: largest triangle three buckets, keeps the visual shape with one point per bucket
+
+Every channel gets a pyramid of min/max/mean levels (each level aggregates PYRAMID_FACTOR buckets of the level
+below). Queries pick the coarsest level that still has enough buckets in the requested window, so zooming on a
+week long 1 Hz test only touches a few thousand values. Pyramids of archived test cases never change and are kept
+in an LRU cache; pyramids of running test cases are rebuilt after PYRAMID_LIVE_TTL seconds.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from .archive import read_channel
+
+PYRAMID_FACTOR = 4
+# no level is built below this many buckets
+PYRAMID_MIN_BUCKETS = 256
+# lttb runs on the raw samples up to this size, on the bucket means of a pyramid level above it
+LTTB_MAX_INPUT = 200000
+PYRAMID_CACHE_SIZE = 64
+PYRAMID_LIVE_TTL = 5.0
+
+
+def _finite(x, y):
+    mask = ~np.isnan(y)
+    if mask.all():
+        return x, y
+    return x[mask], y[mask]
+
+
+def minmax(x, y, buckets):
+    """
+        Splits the samples in (at most) buckets equal count buckets.
+        Returns (x_start, x_end, y_min, y_max) arrays, one value per bucket.
+    """
+    x, y = _finite(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+    if len(x) == 0:
+        empty = np.empty(0)
+        return empty, empty, empty, empty
+    edges = np.unique(np.linspace(0, len(x), min(buckets, len(x)) + 1).astype(np.int64)[:-1])
+    ends = np.append(edges[1:], len(x)) - 1
+    return x[edges], x[ends], np.minimum.reduceat(y, edges), np.maximum.reduceat(y, edges)
+
+
+def lttb(x, y, threshold):
+    """
+        Largest triangle three buckets. Returns (x, y) with threshold points (first and last samples kept).
+        One iteration per bucket, the triangle areas of a bucket are computed in one NumPy pass.
+    """
+    x, y = _finite(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+    size = len(x)
+    if threshold >= size or threshold < 3:
+        return x, y
+    edges = np.linspace(1, size - 1, threshold - 1).astype(np.int64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = size - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else size
+        next_x = x[end:next_end].mean()
+        next_y = y[end:next_end].mean()
+        area = np.abs((x[previous] - next_x) * (y[start:end] - y[previous]) -
+                      (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(area.argmax())
+        selected[bucket + 1] = previous
+    return x[selected], y[selected]
+
+
+class Pyramid(object):
+    """
+        Min/max/mean levels of one channel. Level 0 are the raw samples.
+    """
+
+    def __init__(self, x, y, factor=PYRAMID_FACTOR):
+        x, y = _finite(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+        self.factor = factor
+        # each level: (x_start, x_end, y_min, y_max, y_mean)
+        self.levels = [(x, x, y, y, y)]
+        while len(self.levels[-1][0]) > PYRAMID_MIN_BUCKETS * factor:
+            x_start, x_end, y_min, y_max, y_mean = self.levels[-1]
+            edges = np.arange(0, len(x_start), factor)
+            counts = np.diff(np.append(edges, len(x_start)))
+            self.levels.append((x_start[edges],
+                                x_end[np.append(edges[1:], len(x_end)) - 1],
+                                np.minimum.reduceat(y_min, edges),
+                                np.maximum.reduceat(y_max, edges),
+                                np.add.reduceat(y_mean, edges) / counts))
+
+    @property
+    def raw(self):
+        return self.levels[0][0], self.levels[0][2]
+
+    def window(self, level, start=None, end=None):
+        x_start, x_end = self.levels[level][:2]
+        first = 0 if start is None else int(np.searchsorted(x_end, start, side='left'))
+        last = len(x_start) if end is None else int(np.searchsorted(x_start, end, side='right'))
+        return [values[first:last] for values in self.levels[level]]
+
+    def level_for(self, points, start=None, end=None, max_buckets=None):
+        """
+            Coarsest level with at least points buckets in the window (and at most max_buckets).
+        """
+        for level in range(len(self.levels) - 1, -1, -1):
+            count = len(self.window(level, start, end)[0])
+            if count >= points and (max_buckets is None or count <= max_buckets):
+                return level
+        return 0
+
+    def minmax(self, points, start=None, end=None):
+        level = self.level_for(points, start, end)
+        x_start, x_end, y_min, y_max, _ = self.window(level, start, end)
+        if len(x_start) <= points:
+            return x_start, x_end, y_min, y_max
+        edges = np.unique(np.linspace(0, len(x_start), points + 1).astype(np.int64)[:-1])
+        ends = np.append(edges[1:], len(x_end)) - 1
+        return (x_start[edges], x_end[ends], np.minimum.reduceat(y_min, edges),
+                np.maximum.reduceat(y_max, edges))
+
+    def lttb(self, points, start=None, end=None):
+        # a few input buckets per output point keep the shape, the means of coarser levels flatten it
+        level = self.level_for(points * self.factor, start, end, max_buckets=LTTB_MAX_INPUT)
+        x_start, x_end, _, _, y_mean = self.window(level, start, end)
+        x = x_start if level == 0 else (x_start + x_end) / 2
+        return lttb(x, y_mean, points)
+
+
+_pyramids = OrderedDict()
+_pyramids_lock = threading.Lock()
+
+
+def get_pyramid(test_case, device, column):
+    """
+        Cached pyramid of one channel of a test case.
+    """
+    key = (test_case.id, device, column)
+    now = time.time()
+    with _pyramids_lock:
+        cached = _pyramids.get(key)
+        if cached is not None:
+            version, built, pyramid = cached
+            if version == test_case.archive_path and (version or now - built < PYRAMID_LIVE_TTL):
+                _pyramids.move_to_end(key)
+                return pyramid
+    x, y = read_channel(test_case, device, column)
+    pyramid = Pyramid(x, y)
+    with _pyramids_lock:
+        _pyramids[key] = (test_case.archive_path, now, pyramid)
+        _pyramids.move_to_end(key)
+        while len(_pyramids) > PYRAMID_CACHE_SIZE:
+            _pyramids.popitem(last=False)
+    return pyramid
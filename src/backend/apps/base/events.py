@@ -0,0 +1,233 @@
+"""
+Publish/subscribe channel for test case state transitions.
+
+safety_check, the rig supervisor and the recipe execution publish on the 'test_case' channel. run_test also
+publishes the start of every recipe step on the 'test_case_step' channel. The telemetry writer (rollups)
+subscribes to both. The teardown does not depend on the bus, see tasks.dispatch_teardown.
+
+Backends (EVENT_BUS_BACKEND setting):
+1. 'memory' - in process only (tests, single process setups)
+2. 'sqlite' - local stand-in shared by all the processes of a host (EVENT_BUS_SQLITE_PATH)
+3. 'broker' - topic exchange on the celery broker, for workers spread over several hosts
+"""
+import json
+import socket
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+from .log import log_base
+
+TEST_CASE_CHANNEL = 'test_case'
+TEST_CASE_STEP_CHANNEL = 'test_case_step'
+
+
+class Subscription(object):
+
+    def __init__(self, bus, channel, callback):
+        self.bus = bus
+        self.channel = channel
+        self.callback = callback
+
+    def unsubscribe(self):
+        self.bus.unsubscribe(self)
+
+
+class EventBus(object):
+    """
+        Base class: keeps the subscribers and dispatches the messages. Backends implement publish() and make sure
+        _dispatch() is called for every message published on any process sharing the backend.
+    """
+
+    def __init__(self):
+        self._subscriptions = []
+        self._lock = threading.Lock()
+
+    def publish(self, channel, message):
+        raise NotImplementedError
+
+    def subscribe(self, channel, callback):
+        """
+            callback(channel, message) is called from the bus thread.
+        """
+        subscription = Subscription(self, channel, callback)
+        with self._lock:
+            self._subscriptions.append(subscription)
+        self._on_subscribe()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+    def _on_subscribe(self):
+        pass
+
+    def _dispatch(self, channel, message):
+        with self._lock:
+            subscriptions = [sub for sub in self._subscriptions if sub.channel == channel]
+        for subscription in subscriptions:
+            try:
+                subscription.callback(channel, message)
+            except Exception as err:
+                log_base.exception('Event subscriber failed on channel %s. Error is: %s', channel, err)
+
+
+class InMemoryEventBus(EventBus):
+
+    def publish(self, channel, message):
+        self._dispatch(channel, message)
+
+
+class SqliteEventBus(EventBus):
+    """
+        Events are rows of a small SQLite table; a listener thread per process polls for new ids.
+        Good enough for the handful of state transitions a test produces, no broker needed.
+    """
+
+    POLL_INTERVAL = 0.2
+    RETENTION_SECONDS = 24 * 3600
+
+    def __init__(self, path):
+        super(SqliteEventBus, self).__init__()
+        self.path = path
+        self._listener = None
+        self._last_id = 0
+        connection = self._connect()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                           'channel TEXT NOT NULL, payload TEXT NOT NULL, created REAL NOT NULL)')
+        connection.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5, isolation_level=None)
+
+    def publish(self, channel, message):
+        connection = self._connect()
+        try:
+            now = time.time()
+            connection.execute('INSERT INTO events (channel, payload, created) VALUES (?, ?, ?)',
+                               (channel, json.dumps(message), now))
+            connection.execute('DELETE FROM events WHERE created < ?', (now - self.RETENTION_SECONDS,))
+        finally:
+            connection.close()
+
+    def _on_subscribe(self):
+        with self._lock:
+            if self._listener is not None:
+                return
+            connection = self._connect()
+            self._last_id = connection.execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+            connection.close()
+            self._listener = threading.Thread(target=self._listen, name='event_bus_sqlite')
+            self._listener.daemon = True
+            self._listener.start()
+
+    def _listen(self):
+        connection = self._connect()
+        while True:
+            try:
+                rows = connection.execute('SELECT id, channel, payload FROM events WHERE id > ? ORDER BY id',
+                                          (self._last_id,)).fetchall()
+            except sqlite3.Error as err:
+                log_base.exception('Event bus poll failed on %s. Error is: %s', self.path, err)
+                rows = []
+            for event_id, channel, payload in rows:
+                self._last_id = event_id
+                self._dispatch(channel, json.loads(payload))
+            time.sleep(self.POLL_INTERVAL)
+
+
+class BrokerEventBus(EventBus):
+    """
+        Topic exchange on the celery broker. Every process gets its own exclusive, auto-deleted queue.
+    """
+
+    EXCHANGE_NAME = 'battery_tester.events'
+
+    def __init__(self):
+        super(BrokerEventBus, self).__init__()
+        from kombu import Exchange
+        self.exchange = Exchange(self.EXCHANGE_NAME, type='topic', durable=False)
+        self._listener = None
+
+    def _connection(self):
+        from celery import current_app
+        return current_app.connection()
+
+    def publish(self, channel, message):
+        with self._connection() as connection:
+            producer = connection.Producer(serializer='json')
+            producer.publish(message, exchange=self.exchange, routing_key=channel, declare=[self.exchange])
+
+    def _on_subscribe(self):
+        with self._lock:
+            if self._listener is not None:
+                return
+            self._listener = threading.Thread(target=self._listen, name='event_bus_broker')
+            self._listener.daemon = True
+            self._listener.start()
+
+    def _listen(self):
+        from kombu import Queue
+        queue = Queue(exchange=self.exchange, routing_key='#', exclusive=True, auto_delete=True, durable=False)
+
+        def on_message(body, message):
+            message.ack()
+            self._dispatch(message.delivery_info['routing_key'], body)
+
+        while True:
+            try:
+                with self._connection() as connection:
+                    with connection.Consumer(queue, callbacks=[on_message], accept=['json']):
+                        while True:
+                            try:
+                                connection.drain_events(timeout=1)
+                            except socket.timeout:
+                                continue
+            except Exception as err:
+                log_base.exception('Event bus consumer lost the broker. Reconnecting. Error is: %s', err)
+                time.sleep(1)
+
+
+_event_bus = None
+_event_bus_lock = threading.Lock()
+
+
+def get_event_bus():
+    global _event_bus
+    with _event_bus_lock:
+        if _event_bus is None:
+            backend = getattr(settings, 'EVENT_BUS_BACKEND', 'memory')
+            if backend == 'sqlite':
+                _event_bus = SqliteEventBus(settings.EVENT_BUS_SQLITE_PATH)
+            elif backend == 'broker':
+                _event_bus = BrokerEventBus()
+            else:
+                _event_bus = InMemoryEventBus()
+        return _event_bus
+
+
+def publish_test_case_state(test_case_id, state, result=None, description=None):
+    try:
+        get_event_bus().publish(TEST_CASE_CHANNEL, {'test_case_id': test_case_id,
+                                                    'state': state,
+                                                    'result': result,
+                                                    'description': description,
+                                                    'timestamp': time.time()})
+    except Exception as err:
+        log_base.exception('Could not publish state %s for test case %s. Error is: %s', state, test_case_id, err)
+
+
+def publish_test_case_step(test_case_id, step_index, step_type):
+    try:
+        get_event_bus().publish(TEST_CASE_STEP_CHANNEL, {'test_case_id': test_case_id,
+                                                         'step_index': step_index,
+                                                         'step_type': step_type,
+                                                         'timestamp': time.time()})
+    except Exception as err:
+        log_base.exception('Could not publish step %s for test case %s. Error is: %s', step_index, test_case_id, err)
+
@@ -0,0 +1,79 @@
+"""
+Telemetry export.
+
+iter_telemetry_rows() yields the samples of one device of a test case in chunks of EXPORT_CHUNK_SIZE rows, from the
+archive when there is one (slices of the memory mapped columns) and from the TelemetrySample table otherwise
+(keyset pagination on the primary key, each page read through a server side cursor where the backend has one).
+Memory stays the size of one chunk whatever the length of the test.
+"""
+import csv
+
+import numpy as np
+
+from .archive import open_archive
+from .telemetry import DEVICE_COLUMNS
+
+EXPORT_CHUNK_SIZE = 5000
+
+
+def _archive_rows(archive, device, columns, start, end):
+    timestamps = archive.column(device, 'timestamp')
+    first = 0 if start is None else int(np.searchsorted(timestamps, start, side='left'))
+    last = len(timestamps) if end is None else int(np.searchsorted(timestamps, end, side='right'))
+    arrays = [archive.column(device, column) for column in columns]
+    for offset in range(first, last, EXPORT_CHUNK_SIZE):
+        chunk = slice(offset, min(offset + EXPORT_CHUNK_SIZE, last))
+        for row in zip(*[array[chunk].tolist() for array in arrays]):
+            yield row
+
+
+def _database_rows(test_case, device, columns, start, end):
+    from .models import TelemetrySample
+    samples = TelemetrySample.objects.filter(test_case=test_case, device=device)
+    if start is not None:
+        samples = samples.filter(timestamp__gte=start)
+    if end is not None:
+        samples = samples.filter(timestamp__lte=end)
+    last_id = 0
+    while True:
+        page = samples.filter(id__gt=last_id).order_by('id').values_list('id', *columns)[:EXPORT_CHUNK_SIZE]
+        count = 0
+        for row in page.iterator():
+            last_id = row[0]
+            count += 1
+            yield row[1:]
+        if count < EXPORT_CHUNK_SIZE:
+            break
+
+
+def iter_telemetry_rows(test_case, device, columns, start=None, end=None):
+    archive = open_archive(test_case)
+    if archive is not None:
+        return _archive_rows(archive, device, columns, start, end)
+    return _database_rows(test_case, device, columns, start, end)
+
+
+class _Echo(object):
+    """
+        File-like object for csv.writer that hands back what is written instead of buffering it.
+    """
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(test_case, device, columns=None, start=None, end=None):
+    """
+        CSV lines (header first) of the requested columns, for a StreamingHttpResponse.
+    """
+    columns = list(columns or DEVICE_COLUMNS[device])
+    writer = csv.writer(_Echo())
+    lines = [writer.writerow(columns)]
+    for row in iter_telemetry_rows(test_case, device, columns, start, end):
+        lines.append(writer.writerow(['' if value is None or value != value else value for value in row]))
+        # one write per chunk instead of one per line
+        if len(lines) == EXPORT_CHUNK_SIZE:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
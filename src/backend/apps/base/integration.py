@@ -0,0 +1,200 @@
+"""
+Streaming coulomb and energy counting.
+
+CoulombCounter integrates the pack current (trapezoidal rule) into Ah and current x pack voltage into Wh, sample
+by sample, and keeps the cell voltage extremes. It only remembers the previous sample, i.e. O(1) memory for any
+test length. Samples further apart than INTEGRATOR_MAX_GAP seconds are not integrated across; the gap is counted
+instead so the results show how much of the step is missing.
+
+StepIntegrator accumulates in the database, so that it does not matter which process takes a sample (with the beat
+tasks safety_check runs in any worker child): every batch of samples is folded, under a lock on the TestCase row,
+into the StepResult of the running step and the StepResult with step_index None (the whole test case). The rows
+keep the last sample, the next batch integrates from it whatever the process. run_test opens the row of every step
+before it starts it. Samples of a FINISHED test case are ignored: the capacity is in the database
+the moment the test ends. Ah and Wh keep the sign of the pack current.
+"""
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .log import log_test_case
+
+
+class CoulombCounter(object):
+    __slots__ = ('max_gap', 'start', 'end', 'last_current', 'last_power', 'ampere_seconds', 'watt_seconds',
+                 'cv_min', 'cv_max', 'samples', 'gaps', 'gap_seconds')
+
+    def __init__(self, max_gap=10.0):
+        self.max_gap = max_gap
+        self.start = None
+        self.end = None
+        self.last_current = None
+        self.last_power = None
+        self.ampere_seconds = 0.0
+        self.watt_seconds = 0.0
+        self.cv_min = None
+        self.cv_max = None
+        self.samples = 0
+        self.gaps = 0
+        self.gap_seconds = 0.0
+
+    def add(self, timestamp, current, voltage, cv_min=None, cv_max=None):
+        power = current * voltage
+        if self.end is not None:
+            dt = timestamp - self.end
+            if dt <= 0:
+                # repeated or out of order sample
+                return
+            if dt > self.max_gap:
+                self.gaps += 1
+                self.gap_seconds += dt
+            else:
+                self.ampere_seconds += (self.last_current + current) * dt / 2
+                self.watt_seconds += (self.last_power + power) * dt / 2
+        else:
+            self.start = timestamp
+        self.end = timestamp
+        self.last_current = current
+        self.last_power = power
+        self.samples += 1
+        if cv_min is not None and (self.cv_min is None or cv_min < self.cv_min):
+            self.cv_min = cv_min
+        if cv_max is not None and (self.cv_max is None or cv_max > self.cv_max):
+            self.cv_max = cv_max
+
+    @classmethod
+    def from_result(cls, result, max_gap=10.0):
+        """
+            Counter resuming the StepResult row result.
+        """
+        counter = cls(max_gap)
+        counter.start = result.start
+        counter.end = result.end
+        counter.last_current = result.last_current
+        counter.last_power = result.last_power
+        counter.ampere_seconds = result.ah * 3600
+        counter.watt_seconds = result.wh * 3600
+        counter.cv_min = result.cv_min
+        counter.cv_max = result.cv_max
+        counter.samples = result.samples
+        counter.gaps = result.gaps
+        counter.gap_seconds = result.gap_seconds
+        return counter
+
+    @property
+    def ah(self):
+        return self.ampere_seconds / 3600
+
+    @property
+    def wh(self):
+        return self.watt_seconds / 3600
+
+    def as_dict(self):
+        return {'start': self.start,
+                'end': self.end,
+                'ah': self.ah,
+                'wh': self.wh,
+                'cv_min': self.cv_min,
+                'cv_max': self.cv_max,
+                'samples': self.samples,
+                'gaps': self.gaps,
+                'gap_seconds': self.gap_seconds,
+                'last_current': self.last_current,
+                'last_power': self.last_power}
+
+
+class StepIntegrator(object):
+    """
+        Folds the pack samples into the StepResult rows. Use get_step_integrator().
+    """
+
+    def __init__(self, max_gap=10.0):
+        self.max_gap = max_gap
+        # test_case_id -> snapshots waiting for the worker thread
+        self.pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker = None
+
+    def _start(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, name='step_integrator')
+            self._worker.daemon = True
+            self._worker.start()
+
+    def submit_sample(self, test_case_id, snapshot):
+        """
+            Sample listener side, called on the engine loop: queues the sample for the worker thread, no database
+            access.
+        """
+        with self._lock:
+            self.pending.setdefault(test_case_id, []).append(snapshot)
+            self._start()
+        self._wakeup.set()
+
+    def add_samples(self, test_case_id, snapshots):
+        """
+            Folds the samples into the rows of the test case, in one transaction. Returns False if the test case is
+            finished (or gone) and the samples were ignored.
+        """
+        from .models import StepResult, TestCase
+        with transaction.atomic():
+            # serialises the writers of every process on this test case
+            if not TestCase.objects.select_for_update().filter(id=test_case_id).exclude(state='FINISHED').exists():
+                return False
+            total = StepResult.objects.get_or_create(test_case_id=test_case_id, step_index=None)[0]
+            step = StepResult.objects.filter(test_case_id=test_case_id,
+                                             step_index__isnull=False).order_by('-id').first()
+            for result in (total, step):
+                if result is None:
+                    continue
+                counter = CoulombCounter.from_result(result, self.max_gap)
+                for snapshot in snapshots:
+                    counter.add(snapshot.timestamp, snapshot.dc_current, sum(snapshot.cell_voltages),
+                                snapshot.cv_min, snapshot.cv_max)
+                for field, value in counter.as_dict().items():
+                    setattr(result, field, value)
+                result.save()
+        return True
+
+    def flush(self):
+        with self._lock:
+            pending, self.pending = self.pending, {}
+        for test_case_id, snapshots in pending.items():
+            try:
+                self.add_samples(test_case_id, snapshots)
+            except Exception as err:
+                log_test_case.exception('Could not integrate %s samples of test case %s. Error is: %s',
+                                        len(snapshots), test_case_id, err)
+
+    def _run(self):
+        # one transaction per wakeup for everything submitted meanwhile
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            close_old_connections()
+            self.flush()
+
+    def start_step(self, test_case_id, step_index, step_type):
+        """
+            Opens the row of the step, the samples go to it from now on.
+        """
+        from .models import StepResult, TestCase
+        with transaction.atomic():
+            if not TestCase.objects.select_for_update().filter(id=test_case_id).exists():
+                return
+            StepResult.objects.get_or_create(test_case_id=test_case_id, step_index=step_index,
+                                             defaults={'step_type': step_type})
+
+
+_integrator = None
+_integrator_lock = threading.Lock()
+
+
+def get_step_integrator():
+    global _integrator
+    with _integrator_lock:
+        if _integrator is None:
+            _integrator = StepIntegrator(max_gap=getattr(settings, 'INTEGRATOR_MAX_GAP', 10.0))
+        return _integrator
@@ -0,0 +1,246 @@
+"""
+Live device state in shared memory.
+
+The process that owns a serial port publishes every fresh reading into a fixed layout ring buffer in
+multiprocessing.shared_memory, one segment per device ('bms_battery_COM3', 'bms_inverter_COM4', ...). Any process of
+the host (web, Celery, management commands) can map the segment and read the last samples without a database query
+and without copying: LiveStateRing.view() returns a NumPy structured array over the shared memory.
+
+Layout:
+    header (HEADER_SIZE bytes): magic, record size, capacity, number of samples written
+    records: 2 * capacity struct packed records (RECORD_FIELDS). Sample k goes to slot k % capacity and to its
+             mirror slot k % capacity + capacity, so the last n samples are always one contiguous slice.
+There is one writer per segment. It writes the record (mirror first) and then the sample count. Every record
+carries its sequence number, which lets read() detect a record overwritten while it was being copied.
+
+multiprocessing.shared_memory needs Python 3.8 or later. It is only imported once LIVE_STATE_ENABLED is set; on an
+older interpreter the live state stays disabled (one warning) and the readers see no segment.
+"""
+import atexit
+import re
+import struct
+import threading
+
+import numpy as np
+from django.conf import settings
+
+from .log import log_base
+
+LIVE_STATE_MAGIC = b'BMSL'
+HEADER_FORMAT = '<4sIIQ'
+HEADER_SIZE = 64
+COUNT_OFFSET = struct.calcsize('<4sII')
+READ_RETRIES = 3
+
+CELL_FIELDS = tuple(('cv_{}'.format(i), 'd') for i in range(1, 10))
+RECORD_FIELDS = {
+    'battery': (('seq', 'Q'), ('timestamp', 'd'), ('serial_number', 'q')) + CELL_FIELDS +
+               (('dc_current', 'd'), ('mosfet_temp', 'd'), ('pack_temp', 'd'), ('flags', 'I')),
+    'inverter': (('seq', 'Q'), ('timestamp', 'd'), ('dc_voltage', 'd'), ('dc_current', 'd'), ('ac_voltage', 'd'),
+                 ('ac_current', 'd'), ('last_dc_update', 'd'), ('last_ac_update', 'd'), ('flags', 'I')),
+}
+RECORD_STRUCTS = {device: struct.Struct('<' + ''.join(code for _, code in fields))
+                  for device, fields in RECORD_FIELDS.items()}
+RECORD_DTYPES = {device: np.dtype([(name, '<' + code) for name, code in fields])
+                 for device, fields in RECORD_FIELDS.items()}
+
+
+def segment_name(device, port):
+    return 'bms_{}_{}'.format(device, re.sub(r'[^A-Za-z0-9]', '_', port))
+
+
+def _pack_values(snapshot):
+    return (snapshot.timestamp, snapshot.serial_number) + tuple(snapshot.cell_voltages) + \
+           (snapshot.dc_current, snapshot.mosfet_temp, snapshot.pack_temp, snapshot.flags)
+
+
+def _inverter_values(snapshot):
+    nan = float('nan')
+    return (snapshot.timestamp or nan, snapshot.dc_voltage, snapshot.dc_current, snapshot.ac_voltage,
+            snapshot.ac_current, snapshot.last_dc_update or nan, snapshot.last_ac_update or nan, snapshot.flags)
+
+
+SNAPSHOT_VALUES = {'battery': _pack_values, 'inverter': _inverter_values}
+# segments created by this process, the resource tracker already knows them
+_created_segments = set()
+_shared_memory_available = None
+
+
+def _shared_memory():
+    from multiprocessing import shared_memory
+    return shared_memory
+
+
+def is_shared_memory_available():
+    global _shared_memory_available
+    if _shared_memory_available is None:
+        try:
+            _shared_memory()
+            _shared_memory_available = True
+        except ImportError:
+            _shared_memory_available = False
+    return _shared_memory_available
+
+
+def _attach(name):
+    """
+        Maps an existing segment without handing it to the resource tracker (it would unlink the segment of the
+        writer when this process exits).
+    """
+    shared_memory = _shared_memory()
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        from multiprocessing import resource_tracker
+        memory = shared_memory.SharedMemory(name=name)
+        if name not in _created_segments:
+            resource_tracker.unregister(memory._name, 'shared_memory')
+        return memory
+
+
+class LiveStateRing(object):
+    """
+        Ring buffer of the samples of one device. create() in the process owning the port, open() everywhere else.
+    """
+
+    def __init__(self, device, port, memory, owner=False):
+        self.device = device
+        self.port = port
+        self.memory = memory
+        self.owner = owner
+        self.record = RECORD_STRUCTS[device]
+        magic, record_size, self.capacity, _ = struct.unpack_from(HEADER_FORMAT, memory.buf, 0)
+        if magic != LIVE_STATE_MAGIC or record_size != self.record.size:
+            raise ValueError('{} is not a live state segment of a {}'.format(memory.name, device))
+        self.records = np.ndarray(2 * self.capacity, dtype=RECORD_DTYPES[device], buffer=memory.buf,
+                                  offset=HEADER_SIZE)
+
+    @classmethod
+    def create(cls, device, port, capacity=1024):
+        shared_memory = _shared_memory()
+        name = segment_name(device, port)
+        size = HEADER_SIZE + 2 * capacity * RECORD_STRUCTS[device].size
+        try:
+            memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # left behind by a previous owner of the port
+            stale = _attach(name)
+            stale.close()
+            stale.unlink()
+            memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+        _created_segments.add(name)
+        struct.pack_into(HEADER_FORMAT, memory.buf, 0, LIVE_STATE_MAGIC, RECORD_STRUCTS[device].size, capacity, 0)
+        return cls(device, port, memory, owner=True)
+
+    @classmethod
+    def open(cls, device, port):
+        """
+            Reader side. None if no process publishes this device.
+        """
+        if not is_shared_memory_available():
+            return None
+        try:
+            return cls(device, port, _attach(segment_name(device, port)))
+        except FileNotFoundError:
+            return None
+
+    @property
+    def count(self):
+        return struct.unpack_from('<Q', self.memory.buf, COUNT_OFFSET)[0]
+
+    def write(self, snapshot):
+        count = self.count
+        values = (count + 1,) + SNAPSHOT_VALUES[self.device](snapshot)
+        slot = count % self.capacity
+        self.record.pack_into(self.memory.buf, HEADER_SIZE + (slot + self.capacity) * self.record.size, *values)
+        self.record.pack_into(self.memory.buf, HEADER_SIZE + slot * self.record.size, *values)
+        struct.pack_into('<Q', self.memory.buf, COUNT_OFFSET, count + 1)
+
+    def view(self, samples=1):
+        """
+            Zero copy view of the last samples (oldest first). The writer keeps going: the oldest records of a
+            view of the whole capacity get overwritten, check their seq or use read() if that matters.
+        """
+        return self._last(self.count, samples)
+
+    def _last(self, count, samples):
+        samples = min(samples, count, self.capacity)
+        end = count % self.capacity + self.capacity
+        return self.records[end - samples:end]
+
+    def read(self, samples=1):
+        """
+            Consistent copy of the last samples (oldest first).
+        """
+        for _ in range(READ_RETRIES):
+            count = self.count
+            records = self._last(count, samples).copy()
+            if not len(records) or (records['seq'][0] == count - len(records) + 1 and
+                                    (np.diff(records['seq']) == 1).all()):
+                return records
+        # the writer keeps overwriting the oldest records of a reader asking for the whole ring
+        return self.read(min(samples, self.capacity) // 2)
+
+    def latest(self):
+        """
+            Last sample as a dict, None before the first one.
+        """
+        records = self.read(1)
+        if not len(records):
+            return None
+        return {name: records[name][0].item() for name in records.dtype.names}
+
+    def close(self):
+        # closed already (e.g. by the owner before the atexit hook)
+        if self.records is None:
+            return
+        self.records = None
+        if self.owner:
+            self.memory.unlink()
+            _created_segments.discard(self.memory.name)
+        try:
+            self.memory.close()
+        except BufferError:
+            # views handed out by view() are still alive, the mapping goes with them
+            pass
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+_warned = []
+
+
+def is_live_state_enabled():
+    if not getattr(settings, 'LIVE_STATE_ENABLED', False):
+        return False
+    if not is_shared_memory_available():
+        if not _warned:
+            _warned.append(True)
+            log_base.warning('LIVE_STATE_ENABLED is set but multiprocessing.shared_memory needs Python 3.8+.')
+        return False
+    return True
+
+
+def get_live_state_writer(device, port):
+    """
+        Ring of a device owned by this process, created on first use and unlinked at exit.
+    """
+    key = (device, port)
+    with _writers_lock:
+        ring = _writers.get(key)
+        if ring is None:
+            ring = _writers[key] = LiveStateRing.create(device, port, getattr(settings, 'LIVE_STATE_CAPACITY', 1024))
+            atexit.register(ring.close)
+        return ring
+
+
+def publish_live_state(device, port, snapshot):
+    """
+        Called with every fresh snapshot by the owner of the port. Never raises.
+    """
+    if not is_live_state_enabled():
+        return
+    try:
+        get_live_state_writer(device, port).write(snapshot)
+    except Exception as err:
+        log_base.exception('Could not publish the live state of %s %s. Error is: %s', device, port, err)
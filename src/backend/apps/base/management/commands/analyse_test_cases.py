@@ -0,0 +1,25 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from backend.apps.base.analytics import analyse_test_cases
+from backend.apps.base.models import TestCase
+
+
+class Command(BaseCommand):
+    help = 'Computes the post-test report (capacity, coulombic efficiency, DCIR, cell imbalance, temperature rise).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('test_case_ids', nargs='*', type=int,
+                            help='Test cases to analyse. Defaults to all the FINISHED ones.')
+        parser.add_argument('--processes', type=int, help='Worker processes. Defaults to the number of CPUs.')
+
+    def handle(self, *args, **options):
+        test_cases = TestCase.objects.filter(state='FINISHED')
+        if options['test_case_ids']:
+            test_cases = TestCase.objects.filter(id__in=options['test_case_ids'])
+        test_cases = list(test_cases)
+        if not test_cases:
+            raise CommandError('No test case to analyse.')
+        reports = analyse_test_cases(test_cases, processes=options['processes'])
+        self.stdout.write(json.dumps(reports, indent=2, sort_keys=True))
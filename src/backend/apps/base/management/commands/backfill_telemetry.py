@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from backend.apps.base.backfill import BACKFILL_BATCH_SIZE, backfill_logs
+
+
+class Command(BaseCommand):
+    help = 'Imports the telemetry found in the rotating battery and inverter logs. Resumes from its checkpoints.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help='Log files to import. Defaults to logs/battery.log* and '
+                                                     'logs/inverter.log*.')
+        parser.add_argument('--processes', type=int, help='Worker processes. Defaults to the number of CPUs.')
+        parser.add_argument('--checkpoint-dir', help='Where the per file checkpoints are kept. Defaults to '
+                                                     'logs/backfill.')
+        parser.add_argument('--batch-size', type=int, default=BACKFILL_BATCH_SIZE, help='Rows per insert.')
+
+    def handle(self, *args, **options):
+        results = backfill_logs(paths=options['paths'] or None, checkpoint_dir=options['checkpoint_dir'],
+                                processes=options['processes'], batch_size=options['batch_size'])
+        for path, result in sorted(results.items()):
+            if isinstance(result, str):
+                self.stderr.write('{}: failed, {}'.format(path, result))
+            else:
+                self.stdout.write('{}: {} lines read, {} samples inserted.'.format(path, *result))
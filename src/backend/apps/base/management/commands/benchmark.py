@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from backend.apps.base.benchmarks import DEFAULT_RIG_COUNTS, compare, load_results, run_benchmarks, save_results
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the codecs, the safety checks and the poll cycle against simulated rigs (Linux only).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help='JSON file for the results.')
+        parser.add_argument('--compare', metavar='BASELINE', help='Results JSON to compare against.')
+        parser.add_argument('--threshold', type=float, default=0.15,
+                            help='Relative slowdown (p50 or throughput) reported as a regression.')
+        parser.add_argument('--rigs', default=','.join(str(count) for count in DEFAULT_RIG_COUNTS),
+                            help='Comma separated rig counts for the scaling benchmarks.')
+        parser.add_argument('--scale', type=float, default=1.0, help='Multiplier of the iteration counts.')
+        parser.add_argument('--filter', help='Only the benchmarks whose name contains this.')
+
+    def handle(self, *args, **options):
+        try:
+            rig_counts = [int(count) for count in options['rigs'].split(',')]
+        except ValueError:
+            raise CommandError('--rigs must be comma separated integers.')
+        baseline = load_results(options['compare']) if options['compare'] else None
+
+        def progress(name, result):
+            self.stdout.write('{:45} {:>12.0f} ops/s  p50 {:>10.1f} us  p99 {:>10.1f} us  {:>8} B'.format(
+                name, result['ops_per_s'] or 0, result['p50_us'], result['p99_us'], result['peak_alloc_bytes']))
+
+        results = run_benchmarks(rig_counts, scale=options['scale'], name_filter=options['filter'],
+                                 progress=progress)
+        if options['output']:
+            save_results(results, options['output'])
+            self.stdout.write('Results written to {}'.format(options['output']))
+        if baseline is None:
+            return
+        regressions = compare(results, baseline, options['threshold'])
+        for name, metric, reference, value in regressions:
+            self.stdout.write('REGRESSION {} {}: {:.1f} -> {:.1f}'.format(name, metric, reference, value))
+        if regressions:
+            raise CommandError('{} regressions against {}'.format(len(regressions), options['compare']))
+        self.stdout.write('No regression against {}'.format(options['compare']))
@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from backend.apps.base.rollups import prune_raw_samples
+
+
+class Command(BaseCommand):
+    help = 'Deletes the raw telemetry samples older than the retention period. The rollups are kept.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float,
+                            help='Maximum age of the raw samples. Defaults to TELEMETRY_RAW_RETENTION_DAYS.')
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else settings.TELEMETRY_RAW_RETENTION_DAYS
+        deleted = prune_raw_samples(days)
+        self.stdout.write('Deleted {} telemetry samples older than {} days.'.format(deleted, days))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from backend.apps.base.capture import replay_capture
+
+
+class Command(BaseCommand):
+    help = 'Feeds serial captures (SERIAL_CAPTURE_ENABLED) back into the battery and inverter drivers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='Capture files.')
+        parser.add_argument('--realtime', action='store_true', help='Replay at the original speed instead of as '
+                                                                      'fast as possible.')
+
+    def handle(self, *args, **options):
+        for path in options['paths']:
+            try:
+                result = replay_capture(path, realtime=options['realtime'])
+            except ValueError as err:
+                self.stderr.write('{}: {}'.format(path, err))
+                continue
+            self.stdout.write('{}: {} on {}, {} writes replayed in {:.2f} s ({} driver calls, {} failed, {} writes '
+                              'skipped, {} mismatches).'.format(path, result['device'], result['port'],
+                                                               result['writes'], result['seconds'], result['calls'],
+                                                               result['failed_calls'], result['skipped_writes'],
+                                                               result['tx_mismatches']))
+            self.stdout.write('    last snapshot: {}'.format(result['snapshot']))
@@ -0,0 +1,36 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand, CommandError
+
+from backend.apps.base.port_daemon import PortDaemon, get_port_daemon_address
+
+
+class Command(BaseCommand):
+    help = 'Runs the port owner daemon: opens every COM port of this host and serves the celery workers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--address', help='Unix socket path (or host:port). Defaults to PORT_DAEMON_ADDRESS.')
+
+    def handle(self, *args, **options):
+        address = options['address'] or get_port_daemon_address()
+        if not address:
+            raise CommandError('Set PORT_DAEMON_ADDRESS in the settings or pass --address.')
+        if isinstance(address, str) and ':' in address and '/' not in address:
+            host, port = address.rsplit(':', 1)
+            address = (host, int(port))
+
+        daemon = PortDaemon(address)
+        brought_up = daemon.start()
+        self.stdout.write('Port daemon listening on {}'.format(address))
+        for result in brought_up:
+            if result['ok']:
+                self.stdout.write('{} on {} up in {:.3f} s'.format(result['device'], result['port'], result['seconds']))
+            else:
+                self.stderr.write('{} on {} did not come up'.format(result['device'], result['port']))
+
+        stopped = threading.Event()
+        signal.signal(signal.SIGINT, lambda *_: stopped.set())
+        signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+        stopped.wait()
+        daemon.stop()
@@ -0,0 +1,49 @@
+import json
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from backend.apps.base.simulator import SimulatorHost
+
+
+class Command(BaseCommand):
+    help = 'Simulates battery packs (USB-ISS) and inverters (MK2) on pseudo-terminals, for load tests without hardware.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rigs', type=int, default=1, help='Number of battery + inverter pairs.')
+        parser.add_argument('--link-dir', default='/tmp/s',
+                            help='Directory of the short port symlinks (b<n>, i<n>). Empty for the /dev/pts paths.')
+        parser.add_argument('--soc', type=float, default=0.5, help='Initial state of charge of the packs.')
+        parser.add_argument('--capacity', type=float, default=20.0, help='Cell capacity in Ah.')
+        parser.add_argument('--register', action='store_true',
+                            help='Create or update a Battery and an Inverter row (pool "simulator") per rig.')
+
+    def handle(self, *args, **options):
+        host = SimulatorHost(options['rigs'], link_dir=options['link_dir'] or None, soc=options['soc'],
+                             capacity_ah=options['capacity'])
+        if options['register']:
+            self.register(host)
+        self.stdout.write(json.dumps(host.ports(), indent=2))
+        host.start()
+
+        stopped = threading.Event()
+        signal.signal(signal.SIGINT, lambda *_: stopped.set())
+        signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+        stopped.wait()
+        host.stop()
+        self.stdout.write(json.dumps(host.stats(), indent=2))
+
+    def register(self, host):
+        from backend.apps.base.models import Battery, Inverter, InverterPool
+        pool, _ = InverterPool.objects.get_or_create(name='simulator')
+        for rig in host.rigs:
+            ports = rig.as_dict()
+            Battery.objects.update_or_create(name='sim_b{}'.format(rig.index),
+                                             defaults={'port': ports['battery_port'],
+                                                       'serial_number': str(ports['serial_number']),
+                                                       'state': 'FREE'})
+            Inverter.objects.update_or_create(name='sim_i{}'.format(rig.index),
+                                              defaults={'port': ports['inverter_port'],
+                                                        'inverter_pool': pool,
+                                                        'state': 'FREE'})
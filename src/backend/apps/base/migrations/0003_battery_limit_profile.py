@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0002_testcase_torn_down'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='battery',
+            name='cell_ovp_level_1',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='battery',
+            name='cell_ovp_level_2',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='battery',
+            name='cell_uvp_level_1',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='battery',
+            name='cell_uvp_level_2',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='battery',
+            name='overcurrent',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='battery',
+            name='mosfets_overtemperature',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='battery',
+            name='cells_overtemperature',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
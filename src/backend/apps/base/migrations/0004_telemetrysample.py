@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0003_battery_limit_profile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TelemetrySample',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device', models.CharField(choices=[('battery', 'battery'), ('inverter', 'inverter')], max_length=10)),
+                ('port', models.CharField(max_length=10)),
+                ('timestamp', models.FloatField()),
+                ('dc_voltage', models.FloatField(blank=True, null=True)),
+                ('dc_current', models.FloatField(blank=True, null=True)),
+                ('ac_voltage', models.FloatField(blank=True, null=True)),
+                ('ac_current', models.FloatField(blank=True, null=True)),
+                ('cv_1', models.FloatField(blank=True, null=True)),
+                ('cv_2', models.FloatField(blank=True, null=True)),
+                ('cv_3', models.FloatField(blank=True, null=True)),
+                ('cv_4', models.FloatField(blank=True, null=True)),
+                ('cv_5', models.FloatField(blank=True, null=True)),
+                ('cv_6', models.FloatField(blank=True, null=True)),
+                ('cv_7', models.FloatField(blank=True, null=True)),
+                ('cv_8', models.FloatField(blank=True, null=True)),
+                ('cv_9', models.FloatField(blank=True, null=True)),
+                ('mosfet_temp', models.FloatField(blank=True, null=True)),
+                ('pack_temp', models.FloatField(blank=True, null=True)),
+                ('flags', models.IntegerField(default=0)),
+                ('test_case', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='samples', to='base.TestCase')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='telemetrysample',
+            index_together=set([('test_case', 'device', 'timestamp')]),
+        ),
+    ]
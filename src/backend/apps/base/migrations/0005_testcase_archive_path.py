@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0004_telemetrysample'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='testcase',
+            name='archive_path',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
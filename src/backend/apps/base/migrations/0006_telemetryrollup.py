@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0005_testcase_archive_path'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='telemetrysample',
+            name='timestamp',
+            field=models.FloatField(db_index=True),
+        ),
+        migrations.CreateModel(
+            name='TelemetryRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('device', models.CharField(choices=[('battery', 'battery'), ('inverter', 'inverter')], max_length=10)),
+                ('port', models.CharField(max_length=10)),
+                ('channel', models.CharField(max_length=16)),
+                ('period', models.CharField(choices=[('minute', 'minute'), ('step', 'step')], max_length=10)),
+                ('step_index', models.IntegerField(blank=True, null=True)),
+                ('start', models.FloatField()),
+                ('end', models.FloatField()),
+                ('count', models.IntegerField()),
+                ('minimum', models.FloatField()),
+                ('maximum', models.FloatField()),
+                ('mean', models.FloatField()),
+                ('last', models.FloatField()),
+                ('test_case', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='base.TestCase')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='telemetryrollup',
+            index_together=set([('test_case', 'period', 'channel', 'start')]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0006_telemetryrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StepResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('step_index', models.IntegerField(blank=True, null=True)),
+                ('step_type', models.CharField(blank=True, max_length=32, null=True)),
+                ('start', models.FloatField()),
+                ('end', models.FloatField()),
+                ('ah', models.FloatField()),
+                ('wh', models.FloatField()),
+                ('cv_min', models.FloatField(blank=True, null=True)),
+                ('cv_max', models.FloatField(blank=True, null=True)),
+                ('samples', models.IntegerField()),
+                ('gaps', models.IntegerField(default=0)),
+                ('gap_seconds', models.FloatField(default=0)),
+                ('test_case', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='step_results', to='base.TestCase')),
+            ],
+        ),
+    ]
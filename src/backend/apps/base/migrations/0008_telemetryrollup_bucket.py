@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def merge_duplicate_rollups(apps, schema_editor):
+    """
+        Sets the bucket of the existing rollups and merges the rows the writers of several processes wrote for the
+        same bucket.
+    """
+    TelemetryRollup = apps.get_model('base', 'TelemetryRollup')
+    kept = {}
+    for rollup in TelemetryRollup.objects.order_by('id').iterator():
+        rollup.bucket = rollup.step_index if rollup.period == 'step' else int(rollup.start // 60)
+        key = (rollup.test_case_id, rollup.device, rollup.port, rollup.channel, rollup.period, rollup.bucket)
+        target = kept.get(key)
+        if target is None:
+            kept[key] = rollup
+            rollup.save(update_fields=['bucket'])
+            continue
+        count = target.count + rollup.count
+        target.mean = (target.mean * target.count + rollup.mean * rollup.count) / count
+        target.count = count
+        target.minimum = min(target.minimum, rollup.minimum)
+        target.maximum = max(target.maximum, rollup.maximum)
+        if rollup.end >= target.end:
+            target.last = rollup.last
+        target.start = min(target.start, rollup.start)
+        target.end = max(target.end, rollup.end)
+        target.save()
+        rollup.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0007_stepresult'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='telemetryrollup',
+            name='bucket',
+            field=models.IntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.RunPython(merge_duplicate_rollups, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='telemetryrollup',
+            unique_together=set([('test_case', 'device', 'port', 'channel', 'period', 'bucket')]),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0008_telemetryrollup_bucket'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stepresult',
+            name='last_current',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stepresult',
+            name='last_power',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='stepresult',
+            name='ah',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='stepresult',
+            name='end',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='stepresult',
+            name='samples',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='stepresult',
+            name='start',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='stepresult',
+            name='wh',
+            field=models.FloatField(default=0),
+        ),
+    ]
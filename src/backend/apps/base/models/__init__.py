@@ -2,3 +2,5 @@ from .battery import Battery
 from .inverter_pool import InverterPool
 from .inverter import Inverter
 from .test_case import TestCase
+from .telemetry import TelemetrySample, TelemetryRollup
+from .step_result import StepResult
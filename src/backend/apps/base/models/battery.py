@@ -1,5 +1,7 @@
 from django.db import models
 from ..utils import UsbIssBattery
+from ..safety import LimitProfile
+from ..port_daemon import RemoteBattery, get_port_daemon_address
 
 
 class Battery(models.Model):
@@ -42,6 +44,15 @@ class Battery(models.Model):
     pack_overtemperature_mosfet = models.CharField(max_length=10, blank=True, null=True)
     pack_overtemperature_cells = models.CharField(max_length=10, blank=True, null=True)
     
+    # per pack safety limits, empty means the global setting applies
+    cell_ovp_level_1 = models.FloatField(blank=True, null=True)
+    cell_ovp_level_2 = models.FloatField(blank=True, null=True)
+    cell_uvp_level_1 = models.FloatField(blank=True, null=True)
+    cell_uvp_level_2 = models.FloatField(blank=True, null=True)
+    overcurrent = models.FloatField(blank=True, null=True)
+    mosfets_overtemperature = models.FloatField(blank=True, null=True)
+    cells_overtemperature = models.FloatField(blank=True, null=True)
+
     is_on = models.BooleanField(default=False)
     error_flag = models.BooleanField(default=False)
 
@@ -50,13 +61,26 @@ class Battery(models.Model):
     def __str__(self):
         return '{}_{}'.format(self.name, self.port)
 
+    @property
+    def limit_profile(self):
+        return LimitProfile(**{field: getattr(self, field) for field in LimitProfile.FIELDS})
+
     @property
     def battery_utilities(self):
+        # the port daemon owns the port if there is one on this host, it gets the limits of this pack with every hand out
+        if get_port_daemon_address():
+            remote_battery = RemoteBattery(self.port)
+            remote_battery.limits = self.limit_profile
+            remote_battery.device_id = self.id
+            return remote_battery
         # get the instance from the class attribute if it's already there
         if self.port in UsbIssBattery.battery_instances:
-            return UsbIssBattery.battery_instances[self.port]
-        # if not, create it and store it on the class attribute
-        usbiss_instance = UsbIssBattery(self.port)
-        UsbIssBattery.battery_instances[self.port] = usbiss_instance
+            usbiss_instance = UsbIssBattery.battery_instances[self.port]
+        else:
+            # if not, create it and store it on the class attribute
+            usbiss_instance = UsbIssBattery(self.port)
+            UsbIssBattery.battery_instances[self.port] = usbiss_instance
+        usbiss_instance.limits = self.limit_profile
+        usbiss_instance.device_id = self.id
         return usbiss_instance
 
@@ -1,10 +1,8 @@
-import ctypes
-
 from django.db import models
 
 from ..models import InverterPool
-from ..log import log_inverter as log
 from ..utils import VictronMultiplusMK2VCP
+from ..port_daemon import RemoteInverter, get_port_daemon_address
 
 
 class Inverter(models.Model):
@@ -28,19 +26,12 @@ class Inverter(models.Model):
     inverter_pool = models.ForeignKey(InverterPool, related_name='inverters', related_query_name='inverters')
     state = models.CharField(choices=INVERTER_STATES, max_length=32, default='OFFLINE')
 
-    # rx_thread
-    # septpoint sending thread
     """
-    Sugestions:
+    Notes:
     1. setpoint has to be updated every 5 seconds or less. Should be running continuously.
     2. Readings from the inverter can be fetched with update_frames method. must be done periodically (2 seconds)
-
-    3. - Start reading thread (poll get_info_frame_reply for each byte coming in) when AC/DC frames are requested
-       - Stop the thread above when the update readings funtion is called.
-
-       >>> Easier: start thread which continually reads the RX bytestream. Once a 
-           Request Frame command is sent the thread will automatically chatch the replies and
-           populated the frame attributes of the model 
+    3. A reader on the inverter utilities continually parses the RX bytestream. Once a Request Frame command
+       is sent the reader catches the replies and publishes them into inverter_utilities.snapshot.
     """
 
     def __str__(self):
@@ -48,79 +39,48 @@ class Inverter(models.Model):
 
     @property
     def inverter_utilities(self):
+        # the port daemon owns the port if there is one on this host
+        if get_port_daemon_address():
+            remote_inverter = RemoteInverter(self.port)
+            remote_inverter.device_id = self.id
+            return remote_inverter
         # get the instance from the class attribute if it's already there
         if self.port in VictronMultiplusMK2VCP.inverter_instances:
-            return VictronMultiplusMK2VCP.inverter_instances[self.port]
-        # if not, create it and store it on the class attribute
-        victron_instance = VictronMultiplusMK2VCP(self.port)
-        VictronMultiplusMK2VCP.inverter_instances[self.port] = victron_instance
+            victron_instance = VictronMultiplusMK2VCP.inverter_instances[self.port]
+        else:
+            # if not, create it and store it on the class attribute
+            victron_instance = VictronMultiplusMK2VCP(self.port)
+            VictronMultiplusMK2VCP.inverter_instances[self.port] = victron_instance
+        # the live values go to this row (the port of an Inverter row is not unique)
+        victron_instance.device_id = self.id
         return victron_instance
 
-    def update_DC_frame(self, message, comport_handle):
+    def update_DC_frame(self, message, comport_handle=None):
         """
             Updates the self.dc_current and self.dc_voltage variables.
+            The decoding lives on the inverter utilities; the RX reader calls it for every DC frame it receives.
         """
-        try:
-            self.dc_voltage = int.from_bytes(message[7:9], byteorder='little')
-            self.dc_voltage = self.dc_voltage / 100
-            charging_current = int.from_bytes(message[9:12], byteorder='little')
-            discharging_current = int.from_bytes(message[12:15], byteorder='little')
-            self.dc_current = charging_current + discharging_current
-            self.dc_current = self.dc_current / 10
-
-            self.stop_RX_thread()
-            return True
-        except Exception as err:
-            log.exception('Could not update the DC frame because %s', err)
+        inverter_utilities = self.inverter_utilities
+        if not inverter_utilities.update_DC_frame(message):
             return False
+        self.dc_voltage = inverter_utilities.snapshot.dc_voltage
+        self.dc_current = inverter_utilities.snapshot.dc_current
+        return True
 
-    def update_AC_frame(self, message, comport_handle):
+    def update_AC_frame(self, message, comport_handle=None):
         """
             Updates the self.ac_voltage and self.ac_current
         """
-        try:
-            self.ac_voltage = int.from_bytes(message[7:9], byteorder='little') / 100
-            self.ac_current = ctypes.c_int16(int.from_bytes(message[9:11], byteorder='little'))
-            self.ac_current = self.ac_current.value / 100
-
-            self.stop_RX_thread()
-            return True
-        except Exception as err:
-            log.exception('Could not update AC frame', err)
+        inverter_utilities = self.inverter_utilities
+        if not inverter_utilities.update_AC_frame(message):
             return False
+        self.ac_voltage = inverter_utilities.snapshot.ac_voltage
+        self.ac_current = inverter_utilities.snapshot.ac_current
+        return True
 
     def get_info_frame_reply(self):
         """
-            This function should run continuously and run onto all the incoming bytestream after 'Get frame' Command
-            The function will automatically call an update of the self.ac/dc-voltage/current variables if a suitable reply is detected.
+            Returns the latest AC/DC frame ({'type', 'message', 'timestamp'}) caught by the RX reader of the inverter.
+            The reader runs continuously on the port, so there is no need to poll the byte stream here.
         """
-        message = b'\x0f\x20'
-        r = 15
-        byte = self.get_next_byte()
-        if byte == b'\x0f':
-            new_byte = self.get_next_byte()
-            if new_byte == b' ':
-                for i in range(r):
-                    new_byte = self.get_next_byte()
-                    message = message + new_byte
-
-                if message[6] == 12:
-                    print('DC message: ', message)
-                    frame = {'type': 'DC',
-                             'message': message}
-                    return frame
-                    self.update_DC_frame(message)
-
-                elif message[6] == 8:  # we have AC frame
-                    print('AC message: ', message)
-                    frame = {'type': 'AC',
-                             'message': message}
-                    return frame
-                    self.update_AC_frame(message)
-                else:
-                    print('Message not recognised')
-                    frame = {'type': 'Unknown',
-                             'message': message}
-            else:
-                return None
-        return None
+        return self.inverter_utilities.get_info_frame_reply()
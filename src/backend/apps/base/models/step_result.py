@@ -0,0 +1,32 @@
+from django.db import models
+
+from ..models import TestCase
+
+
+class StepResult(models.Model):
+    """
+    Charge and energy counted over one recipe step (step_index None: the whole test case), see integration.py.
+    Ah and Wh keep the sign of the pack current.
+    """
+    test_case = models.ForeignKey(TestCase, on_delete=models.CASCADE, related_name='step_results')
+    step_index = models.IntegerField(blank=True, null=True)
+    step_type = models.CharField(max_length=32, blank=True, null=True)
+    # timestamps of the first and last sample, None until the step has one
+    start = models.FloatField(blank=True, null=True)
+    end = models.FloatField(blank=True, null=True)
+
+    ah = models.FloatField(default=0)
+    wh = models.FloatField(default=0)
+    cv_min = models.FloatField(blank=True, null=True)
+    cv_max = models.FloatField(blank=True, null=True)
+
+    samples = models.IntegerField(default=0)
+    # sample gaps longer than INTEGRATOR_MAX_GAP are not integrated
+    gaps = models.IntegerField(default=0)
+    gap_seconds = models.FloatField(default=0)
+    # last sample, the next one integrates from it whatever the process that takes it
+    last_current = models.FloatField(blank=True, null=True)
+    last_power = models.FloatField(blank=True, null=True)
+
+    def __str__(self):
+        return '{}_{}'.format(self.test_case_id, 'total' if self.step_index is None else self.step_index)
@@ -0,0 +1,82 @@
+from django.db import models
+
+from ..models import TestCase
+
+
+class TelemetrySample(models.Model):
+    """
+    One reading of a device during a test case. Append only, written in batches by telemetry.TelemetryWriter.
+    Pack samples fill the cell columns, inverter samples the AC columns.
+    """
+    DEVICE_TYPES = (
+        ('battery', 'battery'),
+        ('inverter', 'inverter'),
+    )
+    test_case = models.ForeignKey(TestCase, on_delete=models.CASCADE, related_name='samples', blank=True, null=True)
+    device = models.CharField(max_length=10, choices=DEVICE_TYPES)
+    port = models.CharField(max_length=10)
+    # seconds since the epoch, as taken when the frame was decoded. Indexed on its own for the retention pruning.
+    timestamp = models.FloatField(db_index=True)
+
+    dc_voltage = models.FloatField(blank=True, null=True)
+    dc_current = models.FloatField(blank=True, null=True)
+    ac_voltage = models.FloatField(blank=True, null=True)
+    ac_current = models.FloatField(blank=True, null=True)
+
+    cv_1 = models.FloatField(blank=True, null=True)
+    cv_2 = models.FloatField(blank=True, null=True)
+    cv_3 = models.FloatField(blank=True, null=True)
+    cv_4 = models.FloatField(blank=True, null=True)
+    cv_5 = models.FloatField(blank=True, null=True)
+    cv_6 = models.FloatField(blank=True, null=True)
+    cv_7 = models.FloatField(blank=True, null=True)
+    cv_8 = models.FloatField(blank=True, null=True)
+    cv_9 = models.FloatField(blank=True, null=True)
+
+    mosfet_temp = models.FloatField(blank=True, null=True)
+    pack_temp = models.FloatField(blank=True, null=True)
+
+    flags = models.IntegerField(default=0)
+
+    class Meta:
+        index_together = [('test_case', 'device', 'timestamp')]
+
+    def __str__(self):
+        return '{}_{}_{}'.format(self.device, self.port, self.timestamp)
+
+
+class TelemetryRollup(models.Model):
+    """
+    Aggregate of one channel of a device over a minute or over a recipe step. Maintained incrementally by the
+    telemetry writer (see rollups.py) and kept when the raw samples are pruned.
+    """
+    PERIODS = (
+        ('minute', 'minute'),
+        ('step', 'step'),
+    )
+    test_case = models.ForeignKey(TestCase, on_delete=models.CASCADE, related_name='rollups', blank=True, null=True)
+    device = models.CharField(max_length=10, choices=TelemetrySample.DEVICE_TYPES)
+    port = models.CharField(max_length=10)
+    channel = models.CharField(max_length=16)
+    period = models.CharField(max_length=10, choices=PERIODS)
+    # recipe step index for the step rollups
+    step_index = models.IntegerField(blank=True, null=True)
+    # minute since the epoch for the minute rollups, step index for the step rollups
+    bucket = models.IntegerField()
+    # timestamps of the first and last sample aggregated
+    start = models.FloatField()
+    end = models.FloatField()
+
+    count = models.IntegerField()
+    minimum = models.FloatField()
+    maximum = models.FloatField()
+    mean = models.FloatField()
+    last = models.FloatField()
+
+    class Meta:
+        index_together = [('test_case', 'period', 'channel', 'start')]
+        # the writers of every process merge into the same row (see rollups.write_rollups)
+        unique_together = [('test_case', 'device', 'port', 'channel', 'period', 'bucket')]
+
+    def __str__(self):
+        return '{}_{}_{}_{}'.format(self.device, self.port, self.channel, self.start)
@@ -1,13 +1,14 @@
-import pandas as pd
 import time
 
-from django.db import models
+from django.db import models, transaction
 from django.dispatch import receiver
 from django.db.models.signals import post_save
-from django.conf import settings
 
 from ..models import Inverter, Battery
-from ..tasks import main_task
+from ..tasks import main_task, dispatch_teardown
+from ..events import publish_test_case_state, publish_test_case_step
+from ..integration import get_step_integrator
+from ..recipes import load_recipe, get_recipe_path, RecipeError, STEP_CC_CHARGE, STEP_CC_DISCHARGE, STEP_REST
 
 from ..log import log_test_case
 
@@ -27,113 +28,141 @@ class TestCase(models.Model):
     description = models.CharField(max_length=32, blank=True, null=True)
     config = models.CharField(max_length=32, blank=True, null=True)
     state = models.CharField(max_length=32, choices=TEST_CASE_STATES, default='PENDING')
+    # columnar telemetry archive, written once the test case is FINISHED (see archive.py)
+    archive_path = models.CharField(max_length=255, blank=True, null=True)
+    # set by the one teardown_test_case run that claims the finished test case
+    torn_down = models.BooleanField(default=False)
 
     def __str__(self):
         return '{}'.format(self.name)
 
+    STEP_HANDLERS = {
+        STEP_CC_CHARGE: 'cc_charge',
+        STEP_CC_DISCHARGE: 'cc_discharge',
+        STEP_REST: 'rest',
+    }
+    # seconds between two pack readings while a step runs
+    STEP_POLL_INTERVAL = 2
+
     def load_config(self):
         """
-            Load csv config file with the steps of the test.
+            Compiled recipe of the test: the file named in config, the global csv if config is empty.
         """
-        return pd.read_csv(settings.LOOKUP_TABLE)
-        
+        return load_recipe(get_recipe_path(self.config))
+
+    def set_state(self, state, result=None, description=None):
+        """
+            Saves the new state and publishes the transition on the event bus. FINISHED dispatches the teardown.
+        """
+        self.state = state
+        if result is not None:
+            self.result = result
+        if description is not None:
+            self.description = description
+        self.save(update_fields=['state', 'result', 'description'])
+        publish_test_case_state(self.id, self.state, self.result, self.description)
+        if state == 'FINISHED':
+            dispatch_teardown(self.id, self.battery.port)
 
     def run_test(self):
-        df_recipe = self.load_config()
+        try:
+            recipe = self.load_config()
+        except RecipeError as err:
+            log_test_case.info('Invalid recipe for test case with ID: %s. %s', self.id, err)
+            self.set_state('FINISHED', result='ERROR', description=str(err)[:32])
+            return
         battery_instance = self.battery.battery_utilities
         inverter_instance = self.inverter.inverter_utilities
-        
-       
-        
-        for i in range(0,len(df_recipe)):
-            log_test_case.info('Proceeding to step %s in test case with ID: %s.', i, self.id)
-            if inverter_instance.prepare_inverter():
-                try:
-                    if df_recipe.step_type[i] == 'CC Charge':
-                        log_test_case.info('Attempting step type %s in test case with ID: %s', df_recipe.step_type[i], self.id)
-                        self.cc_charge(battery_instance=battery_instance, 
-                                       inverter_instance=inverter_instance,
-                                       start_timestamp=time.time(),
-                                       timeout_seconds = df_recipe.timeout_seconds[i])
-                    
-                    elif df_recipe.step_type[i] == 'CC Discharge':
-                        log_test_case.info('Attempting step type %s in test case with ID: %s', df_recipe.step_type[i], self.id)
-                        self.cc_discharge(battery_instance=battery_instance, 
-                                       inverter_instance=inverter_instance,
-                                       start_timestamp=time.time(),
-                                       timeout_seconds = df_recipe.timeout_seconds[i])
-                        
-                    
-                    elif df_recipe.step_type[i] == 'Rest':
-                        log_test_case.info('Attempting step type %s in test case with ID: %s', df_recipe.step_type[i], self.id)
-                        self.rest(battery_instance=battery_instance, 
-                                       inverter_instance=inverter_instance,
-                                       start_timestamp=time.time(),
-                                       timeout_seconds = df_recipe.timeout_seconds[i])
-                        
-                    
-                    else:
-                        log_test_case.info('Unrecognised Step Type in test case with ID: %s', self.id)
-                except Exception as err:
-                    log_test_case.exception('Error while attempting to run test step %. Error is %s.', i, err)
-                    
-                    
-
-    def cc_charge(self, battery_instance=None, inverter_instance=None, start_timestamp=None, timeout_seconds = 0):
+        self.set_state('RUNNING')
+
+        # the VE bus is configured once for the whole recipe, and again only after a failed step
+        inverter_ready = inverter_instance.prepare_inverter()
+        for step in recipe.steps:
+            if battery_instance.snapshot.is_not_safe_level_2:
+                log_test_case.info('Level 2 limits reached, skipping the remaining steps of test case with ID: %s.', self.id)
+                break
+            log_test_case.info('Proceeding to step %s in test case with ID: %s.', step.index, self.id)
+            if not inverter_ready:
+                # force: the VE bus configuration is redone after a failed step
+                inverter_ready = inverter_instance.prepare_inverter(True)
+                if not inverter_ready:
+                    continue
+            try:
+                log_test_case.info('Attempting step type %s in test case with ID: %s', step.step_type, self.id)
+                get_step_integrator().start_step(self.id, step.index, step.step_type)
+                publish_test_case_step(self.id, step.index, step.step_type)
+                getattr(self, self.STEP_HANDLERS[step.step_type])(battery_instance=battery_instance,
+                                                                  inverter_instance=inverter_instance,
+                                                                  start_timestamp=time.time(),
+                                                                  timeout_seconds=step.timeout_seconds,
+                                                                  set_point=step.setpoint,
+                                                                  v_limit=step.v_limit)
+            except Exception as err:
+                log_test_case.exception('Error while attempting to run test step %s. Error is %s.', step.index, err)
+                inverter_ready = False
+
+        # a safety trip may have finished the test case already
+        self.refresh_from_db(fields=['state'])
+        if self.state != 'FINISHED':
+            self.set_state('FINISHED', result='COMPLETED')
+
+    def wait_step_end(self, battery_instance, start_timestamp, timeout_seconds, activity, voltage_reached=None):
+        """
+            Blocks until the step times out (never if timeout_seconds is None), voltage_reached(pack voltage) is true
+            or the pack reaches its limits. The pack is refreshed and evaluated here on every pass: with the beat
+            tasks nothing else updates the battery instance of this process.
+        """
+        while timeout_seconds is None or (time.time() - start_timestamp) < timeout_seconds:
+            if battery_instance.update_values():
+                # both checks latch their flags, run them both
+                level_1 = battery_instance.check_safety_level_1()
+                level_2 = battery_instance.check_safety_level_2()
+                if not (level_1 and level_2):
+                    log_test_case.info('Reached level 1 limits during %s on battery on port: %s.', activity, battery_instance.com_port)
+                    break
+                voltage = sum(battery_instance.snapshot.cell_voltages)
+                if voltage_reached is not None and voltage_reached(voltage):
+                    log_test_case.info('Reached the step voltage limit during %s on battery on port: %s (%.2f V).',
+                                       activity, battery_instance.com_port, voltage)
+                    break
+            time.sleep(self.STEP_POLL_INTERVAL)
+
+    def cc_charge(self, battery_instance=None, inverter_instance=None, start_timestamp=None, timeout_seconds=None,
+                  set_point=None, v_limit=None):
         """
             Method encapsulates a cc_charge step
         """
-        #TODO
-        #1. Place inverter in charge mode.
-        #2. Every 2 seconds check for battery data and timeout.
-        inverter_instance.charge()
+        inverter_instance.charge(set_point)
         log_test_case.info('Issued charge mode to inverter on port %s.', inverter_instance.com_port)
-        while (time.time()-start_timestamp)>timeout_seconds:
-            if battery_instance.pack_variables['is_not_safe_level_1']:
-                log_test_case.info('Reached level 1 limits during charging on battery on port: %s.', battery_instance.com_port)
-                break
-            
-            time.sleep(2)
-        
+        self.wait_step_end(battery_instance, start_timestamp, timeout_seconds, 'charging',
+                           None if v_limit is None else lambda voltage: voltage >= v_limit)
         inverter_instance.rest()
         battery_instance.clear_level_1_error_flag()
         log_test_case.info('CC charge mode on inverter on port %s finished.', inverter_instance.com_port)
         return True
-    
-    def cc_discharge(self, battery_instance=None, inverter_instance=None, start_timestamp=None, timeout_seconds = 0):
+
+    def cc_discharge(self, battery_instance=None, inverter_instance=None, start_timestamp=None, timeout_seconds=None,
+                     set_point=None, v_limit=None):
         """
             Method encapsulates a cc_dischage step
         """
-        inverter_instance.invert()
+        inverter_instance.invert(set_point)
         log_test_case.info('Issued invert mode to inverter on port %s.', inverter_instance.com_port)
-        
-        while (time.time()-start_timestamp)>timeout_seconds:
-            if battery_instance.pack_variables['is_not_safe_level_1']:
-                log_test_case.info('Reached level 1 limits during inverting on battery on port: %s.', battery_instance.com_port)
-                break
-            
-            time.sleep(2)
-        
+        self.wait_step_end(battery_instance, start_timestamp, timeout_seconds, 'inverting',
+                           None if v_limit is None else lambda voltage: voltage <= v_limit)
         inverter_instance.rest()
         battery_instance.clear_level_1_error_flag()
         log_test_case.info('CC discharge mode on inverter on port %s finished.', inverter_instance.com_port)
         return True
-    
-    def rest(self, battery_instance=None, inverter_instance=None, start_timestamp=None, timeout_seconds = 0):
+
+    def rest(self, battery_instance=None, inverter_instance=None, start_timestamp=None, timeout_seconds=None,
+             set_point=None, v_limit=None):
         """
             Method encapsulates a rest step
         """
         inverter_instance.rest()
         log_test_case.info('Issued rest mode to inverter on port %s.', inverter_instance.com_port)
-        
-        while (time.time()-start_timestamp)>timeout_seconds:
-            if battery_instance.pack_variables['is_not_safe_level_1']:
-                log_test_case.info('Reached level 1 limits during resting battery on port: %s.', battery_instance.com_port)
-                break
-            
-            time.sleep(2)
-        
-        inverter_instance.rest()
+        self.wait_step_end(battery_instance, start_timestamp, timeout_seconds, 'resting')
         battery_instance.clear_level_1_error_flag()
         log_test_case.info('Rest mode on inverter on port %s finished.', inverter_instance.com_port)
         return True
@@ -144,6 +173,11 @@ def start_test_task(sender, instance, **kwargs):
     created = kwargs.get('created', False)
     if created:
         # log.info('dispatching main task for test case id: %s', instance.id)
-        main_task_id = main_task.apply_async((instance.id,), queue='main_com_{}'.format(instance.battery.port))
-        log_test_case.info('main_task id: %s', main_task_id)
+        # dispatched once the row is committed, main_task reads it straight away
+        queue = 'main_com_{}'.format(instance.battery.port)
+
+        def dispatch_main_task():
+            main_task_id = main_task.apply_async((instance.id,), queue=queue)
+            log_test_case.info('main_task id: %s', main_task_id)
+        transaction.on_commit(dispatch_main_task)
 
@@ -0,0 +1,278 @@
+"""
+Port owner daemon.
+
+One long lived process per host (manage.py run_port_daemon) opens every COM port exclusively and keeps the
+driver instances (UsbIssBattery / VictronMultiplusMK2VCP) alive. Celery tasks talk to it over a local socket
+instead of opening their own handle on the port, so the main_com_N and periodic_com_N workers no longer race
+each other on the same serial device.
+
+Wire protocol: one JSON object per line.
+    request:  {"device": "battery" | "inverter", "port": "COM3", "method": "update_values", "args": []}
+              {"device": "host", "port": null, "method": "start_rig", "args": [...]} for the rig supervisor
+    response: {"ok": true, "result": ...} or {"ok": false, "error": "..."}
+
+Set PORT_DAEMON_ADDRESS in the settings to enable it: a filesystem path for a Unix socket or a
+[host, port] pair for TCP on hosts without Unix sockets. Battery.battery_utilities and
+Inverter.inverter_utilities then hand out RemoteBattery / RemoteInverter proxies.
+With BRING_UP_AT_START the daemon brings every rig of the database up in parallel when it starts (bringup.py).
+"""
+import asyncio
+import json
+import os
+import socket
+import threading
+
+from django.conf import settings
+
+from .bringup import bring_up_host, is_bring_up_at_start_enabled
+from .log import log_base
+from .safety import LimitProfile
+from .snapshots import PackSnapshot, InverterSnapshot
+from .supervisor import get_host_supervisor, get_local_battery, get_local_inverter
+from .transport import SerialEngine
+from .utils import UsbIssBattery, VictronMultiplusMK2VCP
+
+
+class PortDaemonError(Exception):
+    pass
+
+
+# methods (and settable attributes) the daemon exposes for each device type
+DEVICE_METHODS = {
+    'battery': ('configure_USB_ISS', 'bring_up', 'turn_pack_on', 'get_pack_status', 'update_values', 'check_safety_level_1',
+                'check_safety_level_2', 'clear_level_1_error_flag', 'stop_and_release', 'close_coms'),
+    'inverter': ('prepare_inverter', 'configure_ve_bus', 'send_setpoint', 'request_AC_frame', 'request_DC_frame',
+                 'request_frames_update', 'refresh', 'send_state', 'charge', 'invert', 'rest', 'stop', 'stop_and_release',
+                 'close_coms'),
+}
+DEVICE_ATTRIBUTES = {
+    'battery': ('limits', 'device_id'),
+    'inverter': ('set_point', 'device_id'),
+}
+# attributes sent as a dict over the socket and rebuilt on the daemon side
+ATTRIBUTE_TYPES = {
+    'limits': LimitProfile,
+}
+HOST_METHODS = ('start_rig', 'stop_rig', 'supervised_rigs')
+
+
+def get_port_daemon_address():
+    address = getattr(settings, 'PORT_DAEMON_ADDRESS', None)
+    if isinstance(address, (list, tuple)):
+        return tuple(address)
+    return address
+
+
+class PortDaemon(object):
+    """
+        Serves the device drivers of this host over a local socket. Runs on the SerialEngine loop.
+        Commands for the same port are serialised with a per-port lock; different ports run concurrently.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.engine = SerialEngine.get_engine()
+        self.server = None
+        self.port_locks = {}
+
+    def get_device(self, device, port):
+        if device == 'battery':
+            return get_local_battery(port)
+        elif device == 'inverter':
+            return get_local_inverter(port)
+        raise PortDaemonError('Unknown device type {}'.format(device))
+
+    def _port_lock(self, port):
+        if port not in self.port_locks:
+            self.port_locks[port] = asyncio.Lock()
+        return self.port_locks[port]
+
+    async def execute(self, request):
+        device_type = request['device']
+        port = request['port']
+        method = request['method']
+        args = request.get('args', [])
+        if device_type == 'host':
+            if method not in HOST_METHODS:
+                raise PortDaemonError('Method {} is not exposed for host'.format(method))
+            supervisor = get_host_supervisor()
+            if method == 'supervised_rigs':
+                return supervisor.supervised_rigs()
+            return await getattr(supervisor, method + '_async')(*args)
+
+        device = self.get_device(device_type, port)
+
+        if method == 'snapshot':
+            return device.snapshot.as_dict()
+        if method == 'getattr' and args[0] in DEVICE_ATTRIBUTES[device_type]:
+            value = getattr(device, args[0])
+            return value.as_dict() if args[0] in ATTRIBUTE_TYPES else value
+        if method == 'setattr' and args[0] in DEVICE_ATTRIBUTES[device_type]:
+            value = args[1]
+            if args[0] in ATTRIBUTE_TYPES:
+                value = ATTRIBUTE_TYPES[args[0]](**value)
+            setattr(device, args[0], value)
+            return True
+        if method not in DEVICE_METHODS[device_type]:
+            raise PortDaemonError('Method {} is not exposed for {}'.format(method, device_type))
+
+        # the driver methods are synchronous wrappers around the engine loop, run them off the loop
+        async with self._port_lock(port):
+            return await self.engine.loop.run_in_executor(None, lambda: getattr(device, method)(*args))
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    result = await self.execute(json.loads(line.decode()))
+                    response = {'ok': True, 'result': result}
+                except Exception as err:
+                    log_base.exception('Port daemon request failed: %s. Error is: %s', line, err)
+                    response = {'ok': False, 'error': str(err)}
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start_async(self):
+        if isinstance(self.address, tuple):
+            self.server = await asyncio.start_server(self.handle_client, *self.address)
+        else:
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            self.server = await asyncio.start_unix_server(self.handle_client, self.address)
+        log_base.info('Port daemon listening on %s', self.address)
+
+    def start(self):
+        self.engine.run(self.start_async())
+        if is_bring_up_at_start_enabled():
+            return bring_up_host()
+        return []
+
+    async def stop_async(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for port, device in list(UsbIssBattery.battery_instances.items()):
+            await device.close_coms_async()
+        for port, device in list(VictronMultiplusMK2VCP.inverter_instances.items()):
+            await device.close_coms_async()
+        log_base.info('Port daemon on %s stopped', self.address)
+
+    def stop(self):
+        self.engine.run(self.stop_async())
+
+
+class PortDaemonClient(object):
+    """
+        Blocking client used from the celery workers. Keeps one connection per thread.
+    """
+
+    def __init__(self, address=None, timeout=30):
+        self.address = address or get_port_daemon_address()
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        if isinstance(self.address, tuple):
+            connection = socket.create_connection(self.address, timeout=self.timeout)
+        else:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.settimeout(self.timeout)
+            connection.connect(self.address)
+        return connection, connection.makefile('rb')
+
+    def _connection(self):
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection, self._local.reader = self._connect()
+        return self._local.connection, self._local.reader
+
+    def close(self):
+        if getattr(self._local, 'connection', None) is not None:
+            self._local.reader.close()
+            self._local.connection.close()
+            self._local.connection = None
+
+    def call(self, device, port, method, *args):
+        request = json.dumps({'device': device, 'port': port, 'method': method, 'args': list(args)}).encode() + b'\n'
+        try:
+            connection, reader = self._connection()
+            connection.sendall(request)
+            line = reader.readline()
+        except (OSError, socket.timeout) as err:
+            self.close()
+            raise PortDaemonError('Port daemon on {} unreachable: {}'.format(self.address, err))
+        if not line:
+            self.close()
+            raise PortDaemonError('Port daemon on {} closed the connection'.format(self.address))
+        response = json.loads(line.decode())
+        if not response['ok']:
+            raise PortDaemonError(response['error'])
+        return response['result']
+
+
+_client = None
+
+
+def get_port_daemon_client():
+    global _client
+    if _client is None:
+        _client = PortDaemonClient()
+    return _client
+
+
+class RemoteDevice(object):
+    """
+        Proxy with the same interface as the local driver; every call is forwarded to the port daemon.
+    """
+    device = None
+    snapshot_class = None
+
+    def __init__(self, com_port, client=None):
+        object.__setattr__(self, 'com_port', com_port)
+        object.__setattr__(self, 'client', client or get_port_daemon_client())
+
+    def __getattr__(self, name):
+        if name in DEVICE_ATTRIBUTES[self.device]:
+            value = self.client.call(self.device, self.com_port, 'getattr', name)
+            return ATTRIBUTE_TYPES[name](**value) if name in ATTRIBUTE_TYPES else value
+        if name not in DEVICE_METHODS[self.device]:
+            raise AttributeError(name)
+
+        def remote_call(*args):
+            return self.client.call(self.device, self.com_port, name, *args)
+        return remote_call
+
+    def __setattr__(self, name, value):
+        if name not in DEVICE_ATTRIBUTES[self.device]:
+            raise AttributeError('{} cannot be set on a remote {}'.format(name, self.device))
+        if name in ATTRIBUTE_TYPES:
+            value = value.as_dict()
+        self.client.call(self.device, self.com_port, 'setattr', name, value)
+
+    @property
+    def snapshot(self):
+        return self.snapshot_class.from_dict(self.client.call(self.device, self.com_port, 'snapshot'))
+
+
+class RemoteBattery(RemoteDevice):
+    device = 'battery'
+    snapshot_class = PackSnapshot
+
+    @property
+    def pack_variables(self):
+        return self.client.call(self.device, self.com_port, 'snapshot')
+
+
+class RemoteInverter(RemoteDevice):
+    device = 'inverter'
+    snapshot_class = InverterSnapshot
+
+    @property
+    def inverter_variables(self):
+        return self.client.call(self.device, self.com_port, 'snapshot')
@@ -0,0 +1,158 @@
+"""
+Protocol codecs for the devices in utils.py
+
+1. MK2 (Victron VE bus interface) - incremental frame parser and AC/DC info frame decoding
+2. USB-ISS pack status frame - single pass decoder (one frame) and batch decoder (N concatenated frames)
+"""
+import ctypes
+import struct
+
+import numpy as np
+
+from .snapshots import PackSnapshot
+
+MK2_MARKER_COMMAND = 0xFF
+MK2_MARKER_INFO = 0x20
+MK2_MAX_FRAME_LENGTH = 0x3F
+
+MK2_INFO_FRAME_DC = 0x0C
+MK2_INFO_FRAME_AC = 0x08
+
+
+class Mk2FrameParser(object):
+    """
+        Incremental parser for the MK2 byte stream. Feed it chunks as they come off the wire, it returns
+        the complete frames found so far and keeps the incomplete tail for the next call.
+
+        Frame layout: [length][marker][length - 1 bytes][checksum]
+            - marker is 0xFF for command replies and 0x20 for info frames (AC/DC readings)
+            - the sum of all the frame bytes (length and checksum included) is 0 modulo 256
+        On a bad marker or checksum the parser drops one byte and resynchronises on the next one.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.frames_parsed = 0
+        self.checksum_errors = 0
+        self.bytes_dropped = 0
+
+    def reset(self):
+        self.buffer.clear()
+
+    def feed(self, data):
+        """
+            Adds data to the buffer and returns a list with the complete, checksum-valid frames (bytes).
+        """
+        buf = self.buffer
+        buf.extend(data)
+        frames = []
+        pos = 0
+        available = len(buf)
+        while available - pos >= 2:
+            length = buf[pos]
+            if length == 0 or length > MK2_MAX_FRAME_LENGTH or buf[pos + 1] not in (MK2_MARKER_COMMAND, MK2_MARKER_INFO):
+                pos += 1
+                self.bytes_dropped += 1
+                continue
+            end = pos + length + 2
+            if end > available:
+                break
+            frame = bytes(buf[pos:end])
+            if sum(frame) & 0xFF:
+                pos += 1
+                self.bytes_dropped += 1
+                self.checksum_errors += 1
+                continue
+            frames.append(frame)
+            pos = end
+        if pos:
+            del buf[:pos]
+        self.frames_parsed += len(frames)
+        return frames
+
+
+def mk2_frame_type(frame):
+    """
+        Returns 'AC' or 'DC' for info frames, the command letter (e.g. 'A', 'V', 'S') for command replies
+        and 'Unknown' for anything else.
+    """
+    if frame[1] == MK2_MARKER_INFO and len(frame) > 6:
+        if frame[6] == MK2_INFO_FRAME_DC:
+            return 'DC'
+        elif frame[6] == MK2_INFO_FRAME_AC:
+            return 'AC'
+        return 'Unknown'
+    if frame[1] == MK2_MARKER_COMMAND and len(frame) > 3:
+        return chr(frame[2])
+    return 'Unknown'
+
+
+def decode_mk2_dc_frame(frame):
+    """
+        Returns (dc_voltage, dc_current) out of a DC info frame.
+    """
+    dc_voltage = int.from_bytes(frame[7:9], byteorder='little') / 100
+    charging_current = int.from_bytes(frame[9:12], byteorder='little')
+    discharging_current = int.from_bytes(frame[12:15], byteorder='little')
+    dc_current = (charging_current + discharging_current) / 10
+    return dc_voltage, dc_current
+
+
+def decode_mk2_ac_frame(frame):
+    """
+        Returns (ac_voltage, ac_current) out of an AC info frame.
+    """
+    ac_voltage = int.from_bytes(frame[7:9], byteorder='little') / 100
+    ac_current = ctypes.c_int16(int.from_bytes(frame[9:11], byteorder='little')).value / 100
+    return ac_voltage, ac_current
+
+
+# USB-ISS status frame (reply to the 0x54 0x41 0x3E read), all fields little endian:
+#   0-5 header, 6-9 mosfet temp (float), 10-13 pack temp (float), 14-49 cell voltages 1 to 9 (float),
+#   50-53 pack current (float), 54-55 reserved, 56-59 serial number (uint32), 60-61 CRC (sum of bytes 0-59)
+USB_ISS_STATUS_CELLS = 9
+USB_ISS_STATUS_LENGTH = 62
+USB_ISS_STATUS_CRC_OFFSET = 60
+USB_ISS_STATUS_STRUCT = struct.Struct('<6x2f9ff2xIH')
+USB_ISS_STATUS_DTYPE = np.dtype([
+    ('header', 'u1', (6,)),
+    ('mosfet_temp', '<f4'),
+    ('pack_temp', '<f4'),
+    ('cell_voltages', '<f4', (USB_ISS_STATUS_CELLS,)),
+    ('dc_current', '<f4'),
+    ('reserved', 'u1', (2,)),
+    ('serial_number', '<u4'),
+    ('crc', '<u2'),
+])
+
+
+def decode_status_frame(status_message, timestamp=None):
+    """
+        Decodes one status frame in a single struct call.
+        Returns a PackSnapshot, or None if the frame is too short or the CRC does not match.
+    """
+    if len(status_message) < USB_ISS_STATUS_LENGTH:
+        return None
+    fields = USB_ISS_STATUS_STRUCT.unpack_from(status_message)
+    # builtin sum runs over the memoryview in C, cheaper than numpy for a single 60 byte frame
+    if sum(memoryview(status_message)[:USB_ISS_STATUS_CRC_OFFSET]) != fields[-1]:
+        return None
+    return PackSnapshot(serial_number=fields[12],
+                        cell_voltages=fields[2:11],
+                        dc_current=fields[11],
+                        mosfet_temp=fields[0],
+                        pack_temp=fields[1],
+                        timestamp=timestamp)
+
+
+def decode_status_frames(buffer):
+    """
+        Decodes a buffer of N concatenated status frames (e.g. an archived raw capture) without copying.
+        Returns (frames, crc_ok): a structured array with USB_ISS_STATUS_DTYPE and a boolean mask of the
+        frames whose CRC matches. A trailing partial frame is ignored.
+    """
+    count = len(buffer) // USB_ISS_STATUS_LENGTH
+    frames = np.frombuffer(buffer, dtype=USB_ISS_STATUS_DTYPE, count=count)
+    raw = np.frombuffer(buffer, dtype=np.uint8, count=count * USB_ISS_STATUS_LENGTH).reshape(count, USB_ISS_STATUS_LENGTH)
+    crc_ok = raw[:, :USB_ISS_STATUS_CRC_OFFSET].sum(axis=1, dtype=np.uint32) == frames['crc']
+    return frames, crc_ok
@@ -0,0 +1,133 @@
+"""
+Test recipes.
+
+A recipe is a csv file with one row per step (see settings/test_recipe.csv). It is compiled once into a Recipe of
+immutable RecipeSteps, validated, and cached by (path, mtime): editing the file is picked up by the next test,
+an unchanged file is never parsed again.
+
+TestCase.config selects a per test recipe: a file name in RECIPES_DIR or an absolute path. Empty means the global
+LOOKUP_TABLE.
+"""
+import csv
+import os
+import threading
+from collections import namedtuple
+
+from django.conf import settings
+
+STEP_CC_CHARGE = 'CC Charge'
+STEP_CC_DISCHARGE = 'CC Discharge'
+STEP_REST = 'Rest'
+STEP_TYPES = (STEP_CC_CHARGE, STEP_CC_DISCHARGE, STEP_REST)
+
+LIMIT_VOLTAGE = 'voltage'
+LIMIT_TYPES = (LIMIT_VOLTAGE,)
+
+REQUIRED_COLUMNS = ('step_id', 'step_type', 'timeout_seconds')
+
+
+class RecipeError(Exception):
+    pass
+
+
+# timeout_seconds None means the step only ends on the level 1 limits or its v_limit: allowed for the charge/discharge
+# steps only, a Rest step draws no current and would never end.
+# setpoint None means the CHARGING_SETPOINT/INVERTING_SETPOINT of the settings. v_limit is the pack voltage that ends
+# a charge (reached from below) or a discharge (reached from above); it is only set with the 'voltage' limit type.
+RecipeStep = namedtuple('RecipeStep', ('index', 'step_id', 'step_type', 'setpoint', 'limit_type', 'v_limit',
+                                       'timeout_seconds'))
+
+Recipe = namedtuple('Recipe', ('path', 'mtime', 'steps'))
+
+
+def _number(row, column, line, cast=float):
+    value = (row.get(column) or '').strip()
+    if not value:
+        return None
+    try:
+        return cast(float(value))
+    except ValueError:
+        raise RecipeError('Line {}: {} is not a number ({!r})'.format(line, column, value))
+
+
+def compile_recipe(path, mtime=None):
+    """
+        Parses and validates the recipe file. Raises RecipeError with the offending line.
+    """
+    try:
+        with open(path, newline='') as recipe_file:
+            reader = csv.DictReader(recipe_file)
+            missing = [column for column in REQUIRED_COLUMNS if column not in (reader.fieldnames or ())]
+            if missing:
+                raise RecipeError('{} misses the columns {}'.format(path, ', '.join(missing)))
+            rows = list(reader)
+    except OSError as err:
+        raise RecipeError('Cannot read recipe {}: {}'.format(path, err))
+
+    steps = []
+    for index, row in enumerate(rows):
+        line = index + 2
+        step_type = (row.get('step_type') or '').strip()
+        if step_type not in STEP_TYPES:
+            raise RecipeError('Line {}: unknown step type {!r}'.format(line, step_type))
+        limit_type = (row.get('limit_type') or '').strip() or None
+        if limit_type is not None and limit_type not in LIMIT_TYPES:
+            raise RecipeError('Line {}: unknown limit type {!r}'.format(line, limit_type))
+        timeout_seconds = _number(row, 'timeout_seconds', line)
+        if timeout_seconds is not None and timeout_seconds < 0:
+            raise RecipeError('Line {}: negative timeout'.format(line))
+        if timeout_seconds is None and step_type == STEP_REST:
+            raise RecipeError('Line {}: a Rest step needs a timeout'.format(line))
+        setpoint = _number(row, 'setpoint', line)
+        if step_type == STEP_REST:
+            if setpoint:
+                raise RecipeError('Line {}: a Rest step has no setpoint ({})'.format(line, setpoint))
+            setpoint = 0.0
+        elif setpoint is not None and (setpoint > 0 if step_type == STEP_CC_CHARGE else setpoint < 0):
+            # the inverter charges on negative setpoints and inverts on positive ones
+            raise RecipeError('Line {}: setpoint {} has the wrong sign for {}'.format(line, setpoint, step_type))
+        v_limit = None
+        if limit_type == LIMIT_VOLTAGE:
+            v_limit = _number(row, 'v_limit', line)
+            if v_limit is None:
+                raise RecipeError('Line {}: the voltage limit type needs a v_limit'.format(line))
+        steps.append(RecipeStep(index=index,
+                                step_id=_number(row, 'step_id', line, int),
+                                step_type=step_type,
+                                setpoint=setpoint,
+                                limit_type=limit_type,
+                                v_limit=v_limit,
+                                timeout_seconds=timeout_seconds))
+    if not steps:
+        raise RecipeError('{} has no steps'.format(path))
+    return Recipe(path=path, mtime=mtime, steps=tuple(steps))
+
+
+_recipe_cache = {}
+_recipe_cache_lock = threading.Lock()
+
+
+def load_recipe(path):
+    """
+        Compiled recipe for path, from the cache unless the file changed since it was compiled.
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError as err:
+        raise RecipeError('Cannot read recipe {}: {}'.format(path, err))
+    with _recipe_cache_lock:
+        recipe = _recipe_cache.get(path)
+        if recipe is not None and recipe.mtime == mtime:
+            return recipe
+    recipe = compile_recipe(path, mtime)
+    with _recipe_cache_lock:
+        _recipe_cache[path] = recipe
+    return recipe
+
+
+def get_recipe_path(config=None):
+    if not config:
+        return settings.LOOKUP_TABLE
+    if os.path.isabs(config):
+        return config
+    return os.path.join(getattr(settings, 'RECIPES_DIR', os.path.dirname(settings.LOOKUP_TABLE)), config)
@@ -0,0 +1,227 @@
+"""
+Incremental telemetry rollups and raw sample retention.
+
+RollupAggregator sits in the TelemetryWriter and folds every recorded sample into open buckets:
+    1. minute: one bucket per device and wall clock minute
+    2. step: one bucket per device and recipe step (steps come from the 'test_case_step' events of run_test)
+Each bucket keeps count/sum/min/max/last per channel, i.e. O(channels) memory whatever the sample rate. A bucket is
+closed (and written as TelemetryRollup rows with the next batch) when its minute is over, when the next step starts
+or when the test case finishes. Nothing is ever recomputed from the raw samples.
+Every process runs its own writer, so several of them may close a bucket of the same (test case, device, port):
+write_rollups() merges the closed buckets into the row already written for that bucket instead of adding one.
+
+prune_raw_samples() drops the TelemetrySample rows older than TELEMETRY_RAW_RETENTION_DAYS; the rollups stay.
+"""
+import time
+from collections import defaultdict
+
+from .log import log_base
+
+MINUTE = 60.0
+# raw sample rows deleted per statement while pruning
+PRUNE_BATCH_SIZE = 10000
+
+
+def rollup_channels(device):
+    from .telemetry import DEVICE_COLUMNS
+    return tuple(column for column in DEVICE_COLUMNS[device] if column not in ('timestamp', 'flags'))
+
+
+class RollupBucket(object):
+    __slots__ = ('test_case_id', 'device', 'port', 'period', 'step_index', 'key', 'channels', 'start', 'end',
+                 'counts', 'sums', 'minimums', 'maximums', 'lasts')
+
+    def __init__(self, test_case_id, device, port, period, key, step_index=None):
+        self.test_case_id = test_case_id
+        self.device = device
+        self.port = port
+        self.period = period
+        self.key = key
+        self.step_index = step_index
+        self.channels = rollup_channels(device)
+        self.start = None
+        self.end = None
+        size = len(self.channels)
+        self.counts = [0] * size
+        self.sums = [0.0] * size
+        self.minimums = [None] * size
+        self.maximums = [None] * size
+        self.lasts = [None] * size
+
+    def add(self, sample):
+        if self.start is None:
+            self.start = sample.timestamp
+        self.end = sample.timestamp
+        for index, channel in enumerate(self.channels):
+            value = getattr(sample, channel)
+            if value is None or value != value:
+                continue
+            self.counts[index] += 1
+            self.sums[index] += value
+            if self.minimums[index] is None or value < self.minimums[index]:
+                self.minimums[index] = value
+            if self.maximums[index] is None or value > self.maximums[index]:
+                self.maximums[index] = value
+            self.lasts[index] = value
+
+    def rows(self):
+        from .models import TelemetryRollup
+        return [TelemetryRollup(test_case_id=self.test_case_id,
+                                device=self.device,
+                                port=self.port,
+                                channel=channel,
+                                period=self.period,
+                                step_index=self.step_index,
+                                bucket=self.key,
+                                start=self.start,
+                                end=self.end,
+                                count=self.counts[index],
+                                minimum=self.minimums[index],
+                                maximum=self.maximums[index],
+                                mean=self.sums[index] / self.counts[index],
+                                last=self.lasts[index])
+                for index, channel in enumerate(self.channels) if self.counts[index]]
+
+
+class RollupAggregator(object):
+    """
+        Open minute and step buckets per (test case, device, port). Not thread safe, the TelemetryWriter calls it
+        under its lock.
+    """
+
+    def __init__(self):
+        self.minutes = {}
+        self.steps = {}
+        # test_case_id -> index of the running recipe step
+        self.current_steps = {}
+        self.closed = []
+
+    def add(self, sample):
+        stream = (sample.test_case_id, sample.device, sample.port)
+        minute = int(sample.timestamp // MINUTE)
+        bucket = self.minutes.get(stream)
+        if bucket is None or bucket.key != minute:
+            if bucket is not None:
+                self.closed.append(bucket)
+            bucket = self.minutes[stream] = RollupBucket(sample.test_case_id, sample.device, sample.port, 'minute',
+                                                         minute)
+        bucket.add(sample)
+
+        step_index = self.current_steps.get(sample.test_case_id)
+        if step_index is None:
+            return
+        bucket = self.steps.get(stream)
+        if bucket is None or bucket.key != step_index:
+            if bucket is not None:
+                self.closed.append(bucket)
+            bucket = self.steps[stream] = RollupBucket(sample.test_case_id, sample.device, sample.port, 'step',
+                                                       step_index, step_index)
+        bucket.add(sample)
+
+    def start_step(self, test_case_id, step_index):
+        self.close_steps(test_case_id)
+        self.current_steps[test_case_id] = step_index
+
+    def close_steps(self, test_case_id):
+        for stream in [stream for stream in self.steps if stream[0] == test_case_id]:
+            self.closed.append(self.steps.pop(stream))
+
+    def finish_test_case(self, test_case_id):
+        self.current_steps.pop(test_case_id, None)
+        self.close_steps(test_case_id)
+        for stream in [stream for stream in self.minutes if stream[0] == test_case_id]:
+            self.closed.append(self.minutes.pop(stream))
+
+    def close_all(self):
+        self.closed.extend(self.minutes.values())
+        self.closed.extend(self.steps.values())
+        self.minutes = {}
+        self.steps = {}
+
+    def collect(self, now=None, grace=0.0):
+        """
+            Closes the minute buckets whose minute is over (plus grace seconds for late samples) and returns the
+            TelemetryRollup rows of all the closed buckets.
+        """
+        now = time.time() if now is None else now
+        for stream, bucket in list(self.minutes.items()):
+            if (bucket.key + 1) * MINUTE + grace <= now:
+                self.closed.append(self.minutes.pop(stream))
+        closed, self.closed = self.closed, []
+        return [row for bucket in closed for row in bucket.rows()]
+
+
+# columns a merge changes
+MERGED_FIELDS = ('start', 'end', 'count', 'minimum', 'maximum', 'mean', 'last')
+
+
+def rollup_key(rollup):
+    return rollup.test_case_id, rollup.device, rollup.port, rollup.channel, rollup.period, rollup.bucket
+
+
+def merge_rollup(target, other):
+    """
+        Folds the rollup other into target, both of the same bucket.
+    """
+    count = target.count + other.count
+    target.mean = (target.mean * target.count + other.mean * other.count) / count
+    target.count = count
+    target.minimum = min(target.minimum, other.minimum)
+    target.maximum = max(target.maximum, other.maximum)
+    if other.end >= target.end:
+        target.last = other.last
+    target.start = min(target.start, other.start)
+    target.end = max(target.end, other.end)
+
+
+def write_rollups(rows, batch_size=None):
+    """
+        Writes the closed rollups, each merged into the row already written for its bucket (by an other process or
+        by this one for a bucket closed early). Call it in a transaction: the existing rows are locked until the
+        commit, and a row inserted concurrently by an other writer fails the unique constraint, the caller retries
+        the batch and it merges then. The rows given are left untouched for that retry.
+        Returns how many buckets were written.
+    """
+    from .models import TelemetryRollup
+    merged = {}
+    for row in rows:
+        key = rollup_key(row)
+        if key in merged:
+            merge_rollup(merged[key], row)
+        else:
+            merged[key] = TelemetryRollup(**{field: getattr(row, field) for field in
+                                             ('test_case_id', 'device', 'port', 'channel', 'period', 'step_index',
+                                              'bucket') + MERGED_FIELDS})
+    groups = defaultdict(list)
+    for row in merged.values():
+        groups[(row.test_case_id, row.period)].append(row)
+    created = []
+    for (test_case_id, period), group in groups.items():
+        existing = TelemetryRollup.objects.select_for_update().filter(test_case_id=test_case_id, period=period,
+                                                                      bucket__in={row.bucket for row in group})
+        existing = {rollup_key(rollup): rollup for rollup in existing}
+        for row in group:
+            target = existing.get(rollup_key(row))
+            if target is None:
+                created.append(row)
+                continue
+            merge_rollup(target, row)
+            target.save(update_fields=MERGED_FIELDS)
+    TelemetryRollup.objects.bulk_create(created, batch_size=batch_size)
+    return len(merged)
+
+
+def prune_raw_samples(max_age_days, now=None):
+    """
+        Deletes the TelemetrySample rows older than max_age_days, in batches. Returns how many were deleted.
+    """
+    from .models import TelemetrySample
+    cutoff = (time.time() if now is None else now) - max_age_days * 24 * 3600
+    deleted = 0
+    while True:
+        ids = list(TelemetrySample.objects.filter(timestamp__lt=cutoff).values_list('id', flat=True)[:PRUNE_BATCH_SIZE])
+        if not ids:
+            break
+        deleted += TelemetrySample.objects.filter(id__in=ids).delete()[0]
+    log_base.info('Pruned %s telemetry samples older than %s days.', deleted, max_age_days)
+    return deleted
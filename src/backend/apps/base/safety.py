@@ -0,0 +1,269 @@
+"""
+Safety evaluation close to the serial data.
+
+SafetyMonitor hooks into the sample listeners of a UsbIssBattery and evaluates check_safety_level_1 /
+check_safety_level_2 on every fresh pack snapshot, in the process (and on the loop) that reads the port.
+A level 2 trip stops the inverter straight away, without going through celery, and the trip latency
+(pack sample -> inverter stop written) is recorded.
+
+FleetSafetyEngine keeps the latest readings of every pack of the host in NumPy arrays and checks them against
+per pack LimitProfiles (stored on the Battery model) in one vectorised pass, returning the tripped flag bits
+per pack. With a fleet engine the monitors only feed it; the rig supervisor evaluates it once per tick.
+"""
+import time
+
+import numpy as np
+from django.conf import settings
+
+from .log import log_battery
+from .snapshots import PACK_FLAG_NAMES, PACK_NOT_SAFE_LEVEL_2, PACK_CELL_OVERVOLTAGE_LEVEL_2
+from .snapshots import PACK_CELL_UNDERVOLTAGE_LEVEL_2, PACK_OVERCURRENT, PACK_OVERTEMPERATURE_MOSFETS
+from .snapshots import PACK_OVERTEMPERATURE_CELLS, PACK_CELL_OVERVOLTAGE_LEVEL_1, PACK_CELL_UNDERVOLTAGE_LEVEL_1
+from .snapshots import PACK_NOT_SAFE_LEVEL_1
+
+LEVEL_2_FLAGS = (PACK_CELL_OVERVOLTAGE_LEVEL_2 | PACK_CELL_UNDERVOLTAGE_LEVEL_2 | PACK_OVERCURRENT |
+                 PACK_OVERTEMPERATURE_MOSFETS | PACK_OVERTEMPERATURE_CELLS)
+
+
+LEVEL_1_FLAGS = PACK_CELL_OVERVOLTAGE_LEVEL_1 | PACK_CELL_UNDERVOLTAGE_LEVEL_1 | PACK_NOT_SAFE_LEVEL_1
+
+
+def describe_flags(flags, mask=LEVEL_2_FLAGS):
+    return ', '.join(name for flag, name in PACK_FLAG_NAMES if flags & mask & flag)
+
+
+class LimitProfile(object):
+    """
+        Safety limits of one pack. Missing values fall back to the global settings.
+    """
+    FIELDS = ('cell_ovp_level_1', 'cell_ovp_level_2', 'cell_uvp_level_1', 'cell_uvp_level_2', 'overcurrent',
+              'mosfets_overtemperature', 'cells_overtemperature')
+    SETTINGS = ('BATTERY_CELL_OVP_LEVEL_1', 'BATTERY_CELL_OVP_LEVEL_2', 'BATTERY_CELL_UVP_LEVEL_1',
+                'BATTERY_CELL_UVP_LEVEL_2', 'BATTERY_OCP', 'MOSFETS_OVERTEMPERATURE', 'CELLS_OVERTEMPERATURE')
+    __slots__ = FIELDS
+
+    def __init__(self, **limits):
+        for field, setting in zip(self.FIELDS, self.SETTINGS):
+            value = limits.get(field)
+            setattr(self, field, float(getattr(settings, setting) if value is None else value))
+
+    def __repr__(self):
+        return '<LimitProfile {}>'.format(self.as_dict())
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def as_tuple(self):
+        return tuple(getattr(self, field) for field in self.FIELDS)
+
+
+class SafetyMetrics(object):
+    __slots__ = ('samples', 'trips', 'evaluation_time_total', 'last_trip_latency', 'max_trip_latency',
+                 'last_trip_reason')
+
+    def __init__(self):
+        self.samples = 0
+        self.trips = 0
+        self.evaluation_time_total = 0.0
+        self.last_trip_latency = None
+        self.max_trip_latency = None
+        self.last_trip_reason = None
+
+    def record_trip(self, latency, reason):
+        self.trips += 1
+        self.last_trip_latency = latency
+        self.last_trip_reason = reason
+        if self.max_trip_latency is None or latency > self.max_trip_latency:
+            self.max_trip_latency = latency
+
+    def as_dict(self):
+        return {'samples': self.samples,
+                'trips': self.trips,
+                'mean_evaluation_time': self.evaluation_time_total / self.samples if self.samples else None,
+                'last_trip_latency': self.last_trip_latency,
+                'max_trip_latency': self.max_trip_latency,
+                'last_trip_reason': self.last_trip_reason}
+
+
+class SafetyMonitor(object):
+    """
+        Evaluates the pack limits on every sample of battery and stops inverter on a level 2 trip.
+        With a fleet engine the evaluation is left to FleetSafetyEngine.evaluate_and_dispatch().
+        on_trip (optional coroutine function) is awaited with the trip reason once the inverter is stopped.
+    """
+
+    def __init__(self, battery, inverter, on_trip=None, fleet=None):
+        self.battery = battery
+        self.inverter = inverter
+        self.on_trip = on_trip
+        self.fleet = fleet
+        self.metrics = SafetyMetrics()
+        self.tripped = False
+
+    def attach(self):
+        if self.fleet is not None:
+            self.fleet.register(self.battery.com_port, self.battery.limits, self)
+        if self.on_sample not in self.battery.sample_listeners:
+            self.battery.sample_listeners.append(self.on_sample)
+
+    def detach(self):
+        if self.fleet is not None:
+            self.fleet.unregister(self.battery.com_port)
+        if self.on_sample in self.battery.sample_listeners:
+            self.battery.sample_listeners.remove(self.on_sample)
+
+    def on_sample(self, snapshot):
+        """
+            Sample listener, runs on the engine loop right after the status frame is decoded.
+        """
+        if self.fleet is not None:
+            self.fleet.update(self.battery.com_port, snapshot)
+            self.metrics.samples += 1
+            return True
+        started = time.time()
+        self.battery.check_safety_level_1()
+        safe = self.battery.check_safety_level_2()
+        self.metrics.samples += 1
+        self.metrics.evaluation_time_total += time.time() - started
+        if safe or self.tripped:
+            return True
+        self.tripped = True
+        self.battery.engine.loop.create_task(self.trip(snapshot))
+        return False
+
+    def on_fleet_flags(self, flags, snapshot):
+        """
+            Called by the fleet evaluation with the flag bits of this pack.
+        """
+        self.battery.snapshot.set_flag(int(flags))
+        if self.tripped or not flags & PACK_NOT_SAFE_LEVEL_2:
+            return True
+        self.tripped = True
+        self.battery.engine.loop.create_task(self.trip(snapshot))
+        return False
+
+    async def trip(self, snapshot):
+        reason = describe_flags(self.battery.snapshot.flags) or describe_flags(PACK_NOT_SAFE_LEVEL_2, PACK_NOT_SAFE_LEVEL_2)
+        await self.inverter.stop_async()
+        latency = time.time() - snapshot.timestamp
+        self.metrics.record_trip(latency, reason)
+        log_battery.info('Safety level 2 trip on port %s (%s). Inverter on port %s stopped %.1f ms after the sample.',
+                         self.battery.com_port, reason, self.inverter.com_port, latency * 1000)
+        if self.on_trip is not None:
+            await self.on_trip(reason)
+
+
+class FleetSafetyEngine(object):
+    """
+        Latest readings of all the packs (packs x cells, current, temperatures) and their limits in NumPy arrays.
+        evaluate() checks every pack in one vectorised pass and returns the tripped flag bits per pack.
+        Packs without a sample yet hold NaN and never trip.
+    """
+
+    def __init__(self, cells=9, capacity=16):
+        self.cell_count = cells
+        self.rows = {}
+        # port of each row, None for the free ones
+        self.ports = []
+        self.monitors = {}
+        self.snapshots = {}
+        self.dirty = False
+        self.evaluation_time_total = 0.0
+        self.evaluations = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        cells = np.full((capacity, self.cell_count), np.nan)
+        current = np.full(capacity, np.nan)
+        mosfet_temp = np.full(capacity, np.nan)
+        pack_temp = np.full(capacity, np.nan)
+        limits = np.full((capacity, len(LimitProfile.FIELDS)), np.nan)
+        self.ports.extend([None] * (capacity - len(self.ports)))
+        if hasattr(self, 'cells'):
+            used = len(self.cells)
+            cells[:used] = self.cells
+            current[:used] = self.current
+            mosfet_temp[:used] = self.mosfet_temp
+            pack_temp[:used] = self.pack_temp
+            limits[:used] = self.limits
+        self.cells, self.current, self.mosfet_temp, self.pack_temp, self.limits = (
+            cells, current, mosfet_temp, pack_temp, limits)
+        self.active = np.zeros(capacity, dtype=bool) if not hasattr(self, 'active') else np.concatenate(
+            [self.active, np.zeros(capacity - len(self.active), dtype=bool)])
+
+    def register(self, port, limits, monitor=None):
+        if port not in self.rows:
+            free = np.flatnonzero(~self.active)
+            if not len(free):
+                self._allocate(len(self.active) * 2)
+                free = np.flatnonzero(~self.active)
+            self.rows[port] = int(free[0])
+        row = self.rows[port]
+        self.ports[row] = port
+        self.active[row] = True
+        self.limits[row] = limits.as_tuple()
+        self.monitors[port] = monitor
+        return row
+
+    def unregister(self, port):
+        row = self.rows.pop(port, None)
+        self.monitors.pop(port, None)
+        self.snapshots.pop(port, None)
+        if row is None:
+            return
+        self.ports[row] = None
+        self.active[row] = False
+        for values in (self.cells, self.current, self.mosfet_temp, self.pack_temp):
+            values[row] = np.nan
+
+    def update(self, port, snapshot):
+        row = self.rows[port]
+        self.cells[row, :len(snapshot.cell_voltages)] = snapshot.cell_voltages
+        self.current[row] = snapshot.dc_current
+        self.mosfet_temp[row] = snapshot.mosfet_temp
+        self.pack_temp[row] = snapshot.pack_temp
+        self.snapshots[port] = snapshot
+        self.dirty = True
+
+    def evaluate(self):
+        """
+            Returns a uint16 array with the PACK_* flag bits tripped by each row (0 for the free rows).
+        """
+        started = time.time()
+        limits = self.limits
+        with np.errstate(invalid='ignore'):
+            cv_max = self.cells.max(axis=1)
+            cv_min = self.cells.min(axis=1)
+            checks = (
+                (cv_max > limits[:, 0], PACK_CELL_OVERVOLTAGE_LEVEL_1 | PACK_NOT_SAFE_LEVEL_1),
+                (cv_min < limits[:, 2], PACK_CELL_UNDERVOLTAGE_LEVEL_1 | PACK_NOT_SAFE_LEVEL_1),
+                (cv_max > limits[:, 1], PACK_CELL_OVERVOLTAGE_LEVEL_2 | PACK_NOT_SAFE_LEVEL_2),
+                (cv_min < limits[:, 3], PACK_CELL_UNDERVOLTAGE_LEVEL_2 | PACK_NOT_SAFE_LEVEL_2),
+                (self.current > limits[:, 4], PACK_OVERCURRENT | PACK_NOT_SAFE_LEVEL_2),
+                (self.mosfet_temp > limits[:, 5], PACK_OVERTEMPERATURE_MOSFETS | PACK_NOT_SAFE_LEVEL_2),
+                (self.pack_temp > limits[:, 6], PACK_OVERTEMPERATURE_CELLS | PACK_NOT_SAFE_LEVEL_2),
+            )
+        flags = np.zeros(len(self.active), dtype=np.uint16)
+        for tripped, bits in checks:
+            flags[tripped] |= bits
+        flags[~self.active] = 0
+        self.dirty = False
+        self.evaluations += 1
+        self.evaluation_time_total += time.time() - started
+        return flags
+
+    def flags_by_port(self):
+        flags = self.evaluate()
+        return {port: int(flags[row]) for port, row in self.rows.items()}
+
+    def evaluate_and_dispatch(self):
+        """
+            Evaluates the fleet and hands every pack with tripped flags to its SafetyMonitor.
+        """
+        flags = self.evaluate()
+        for row in np.flatnonzero(flags):
+            port = self.ports[row]
+            monitor = self.monitors.get(port)
+            if monitor is not None:
+                monitor.on_fleet_flags(flags[row], self.snapshots.get(port))
+        return flags
@@ -0,0 +1,7 @@
+"""
+Hardware simulator: battery packs behind USB-ISS bridges and Victron inverters behind MK2 interfaces, served on
+Linux pseudo-terminals so the real drivers (utils.py) run unchanged against them. See the run_simulator command.
+"""
+from .devices import Mk2Device, UsbIssDevice, mk2_frame, status_frame
+from .host import SimulatorHost, SimulatedRig
+from .pack import PackModel
@@ -0,0 +1,196 @@
+"""
+Device side of the two serial protocols. feed() takes the bytes the driver wrote and returns the reply bytes.
+
+Mk2Device (Victron MK2 interface, see VictronMultiplusMK2VCP):
+    'A' address      -> 'A' reply
+    'R' reset        -> 'V' version frame
+    'V' version      -> 'V' version frame
+    'S' state        -> 'S' reply, 0x03 switches the inverter on, 0x04 off
+    'W' ram var      -> 0x87 reply, a write of ram var 0x34 sets the power setpoint
+    'F' 0x00 / 0x01  -> DC / AC info frame
+UsbIssDevice (USB-ISS I2C bridge in front of the pack, see UsbIssBattery):
+    0x5A 0x01        -> module id, firmware version, mode
+    0x5A 0x02 m s    -> 0xFF 0x00 (mode set)
+    0x57 ...         -> I2C_DIRECT sequence ending with STOP (0x03): 0xFF, read count, read bytes. The turn on
+                        command (0x04) written to the pack is its keep alive.
+    0x54 0x41 n      -> n bytes of the status frame (62, CRC valid, from the PackModel)
+"""
+import struct
+import time
+
+from ..protocol import Mk2FrameParser, MK2_MARKER_COMMAND, MK2_MARKER_INFO, MK2_INFO_FRAME_AC, MK2_INFO_FRAME_DC
+from ..protocol import USB_ISS_STATUS_CELLS, USB_ISS_STATUS_CRC_OFFSET
+
+MK2_VERSION = 2636000
+# 'S' argument of make_state_message
+MK2_STATE_ON = 0x03
+MK2_SETPOINT_RAM_VAR = 0x34
+MK2_WRITE_REPLY = 0x87
+MAINS_VOLTAGE = 230.0
+INVERTER_EFFICIENCY = 0.92
+
+USB_ISS_ID = 0x07
+USB_ISS_FIRMWARE = 0x08
+# frame without its CRC, same layout as protocol.USB_ISS_STATUS_STRUCT
+STATUS_BODY_STRUCT = struct.Struct('<6x2f{}ff2xI'.format(USB_ISS_STATUS_CELLS))
+I2C_START, I2C_RESTART, I2C_STOP, I2C_NACK = 0x01, 0x02, 0x03, 0x04
+PACK_I2C_ADDRESS = 0x40
+PACK_COMMAND_TURN_ON = 0x04
+
+
+def mk2_frame(marker, payload):
+    """
+        [length][marker][payload][checksum], the bytes sum to 0 modulo 256.
+    """
+    frame = bytearray([len(payload) + 1, marker])
+    frame.extend(payload)
+    frame.append(-sum(frame) & 0xFF)
+    return bytes(frame)
+
+
+def status_frame(pack):
+    body = STATUS_BODY_STRUCT.pack(pack.mosfet_temp, pack.pack_temp, *pack.cell_voltages, pack.current,
+                                   pack.serial_number)
+    assert len(body) == USB_ISS_STATUS_CRC_OFFSET
+    return body + struct.pack('<H', sum(body) & 0xFFFF)
+
+
+class Mk2Device(object):
+
+    def __init__(self, pack):
+        self.pack = pack
+        self.parser = Mk2FrameParser()
+        self.is_on = False
+        # watts, positive discharges the pack
+        self.set_point = 0
+        self.ram_var = None
+        self.frames_in = 0
+
+    @property
+    def power(self):
+        return self.set_point if self.is_on else 0
+
+    def version_frame(self):
+        return mk2_frame(MK2_MARKER_COMMAND, b'V' + struct.pack('<I', MK2_VERSION) + b'B')
+
+    def dc_frame(self):
+        # the decoder adds the two 24 bit currents and has no sign, report the magnitude
+        current = int(round(abs(self.pack.current) * 10))
+        charging, discharging = (current, 0) if self.pack.current >= 0 else (0, current)
+        payload = bytes([0xFF, 0xFF, 0xFF, 0x00, MK2_INFO_FRAME_DC])
+        payload += struct.pack('<H', int(round(self.pack.voltage * 100)) & 0xFFFF)
+        payload += charging.to_bytes(3, 'little') + discharging.to_bytes(3, 'little') + b'\x00'
+        return mk2_frame(MK2_MARKER_INFO, payload)
+
+    def ac_frame(self):
+        ac_current = int(round(self.power * INVERTER_EFFICIENCY / MAINS_VOLTAGE * 100))
+        payload = bytes([0x01, 0x01, 0x00, 0x00, MK2_INFO_FRAME_AC])
+        payload += struct.pack('<Hh', int(MAINS_VOLTAGE * 100), ac_current)
+        payload += struct.pack('<Hh', int(MAINS_VOLTAGE * 100), ac_current) + b'\x64'
+        return mk2_frame(MK2_MARKER_INFO, payload)
+
+    def feed(self, data):
+        replies = []
+        for frame in self.parser.feed(data):
+            self.frames_in += 1
+            reply = self.handle(frame)
+            if reply:
+                replies.append(reply)
+        return b''.join(replies)
+
+    def handle(self, frame):
+        if frame[1] != MK2_MARKER_COMMAND:
+            return None
+        command, arguments = chr(frame[2]), frame[3:-1]
+        if command == 'A':
+            return mk2_frame(MK2_MARKER_COMMAND, b'A' + bytes(arguments[:2]))
+        if command in ('R', 'V'):
+            return self.version_frame()
+        if command == 'S':
+            self.is_on = arguments[0] == MK2_STATE_ON
+            return mk2_frame(MK2_MARKER_COMMAND, b'S\x00')
+        if command == 'W':
+            return self.write_ram_var(arguments)
+        if command == 'F':
+            return self.dc_frame() if arguments[0] == 0 else self.ac_frame()
+        return None
+
+    def write_ram_var(self, arguments):
+        # the drivers select the ram var with one W frame and write its value with the next
+        if arguments[0] == MK2_SETPOINT_RAM_VAR and len(arguments) >= 3:
+            value = arguments[1] | arguments[2] << 8
+            # make_message_MK2 sends negative setpoints as 65535 + setpoint
+            self.set_point = value - 65535 if value > 0x7FFF else value
+        else:
+            self.ram_var = bytes(arguments)
+        return mk2_frame(MK2_MARKER_COMMAND, bytes([MK2_WRITE_REPLY, 0x00, 0x00]))
+
+
+class UsbIssDevice(object):
+
+    def __init__(self, pack):
+        self.pack = pack
+        self.buffer = bytearray()
+        self.mode = None
+        self.status_requests = 0
+
+    def feed(self, data, now=None):
+        now = time.time() if now is None else now
+        self.buffer.extend(data)
+        replies = []
+        while self.buffer:
+            consumed, reply = self.handle(self.buffer, now)
+            if not consumed:
+                # incomplete command, wait for the rest
+                break
+            del self.buffer[:consumed]
+            if reply:
+                replies.append(reply)
+        return b''.join(replies)
+
+    def handle(self, buf, now):
+        """
+            Returns (bytes consumed, reply). 0 consumed means the command is not complete yet.
+        """
+        command = buf[0]
+        if command == 0x5A:
+            if len(buf) < 2:
+                return 0, None
+            if buf[1] == 0x02:
+                if len(buf) < 4:
+                    return 0, None
+                self.mode = bytes(buf[2:4])
+                return 4, b'\xff\x00'
+            return 2, bytes([USB_ISS_ID, USB_ISS_FIRMWARE, self.mode[0] if self.mode else 0x40])
+        if command == 0x57:
+            return self.i2c_direct(buf, now)
+        if command == 0x54:
+            if len(buf) < 3:
+                return 0, None
+            self.status_requests += 1
+            return 3, status_frame(self.pack)[:buf[2]]
+        # unknown byte, resynchronise on the next one
+        return 1, None
+
+    def i2c_direct(self, buf, now):
+        position = 1
+        written = bytearray()
+        read = 0
+        while position < len(buf):
+            item = buf[position]
+            position += 1
+            if item == I2C_STOP:
+                if written[:2] == bytes([PACK_I2C_ADDRESS, PACK_COMMAND_TURN_ON]):
+                    self.pack.keep_alive(now)
+                return position, bytes([0xFF, read]) + b'\x00' * read
+            if 0x30 <= item <= 0x3F:
+                count = item - 0x2F
+                if position + count > len(buf):
+                    return 0, None
+                written.extend(buf[position:position + count])
+                position += count
+            elif 0x20 <= item <= 0x2F:
+                read += item - 0x1F
+            elif item not in (I2C_START, I2C_RESTART, I2C_NACK):
+                return position, b'\x00\x00'
+        return 0, None
@@ -0,0 +1,166 @@
+"""
+Pseudo-terminal host for the simulated rigs.
+
+Every rig is a PackModel behind a UsbIssDevice and a Mk2Device, each on its own pty pair. The drivers open the
+slave side like a real COM port (os.ttyname, or a short symlink: the port columns hold 10 characters). One thread
+serves all the master sides with a selector and steps the models every TICK seconds, so a single process handles
+hundreds of rigs: a rig costs two pty pairs and a few microseconds per tick.
+"""
+import errno
+import os
+import resource
+import selectors
+import threading
+import time
+import tty
+
+from ..log import log_base
+from .devices import Mk2Device, UsbIssDevice
+from .pack import PackModel
+
+TICK = 0.1
+READ_CHUNK = 4096
+FIRST_SERIAL_NUMBER = 900000
+
+
+class PtyEndpoint(object):
+    """
+        Master side of a pty pair plus the device answering on it.
+    """
+
+    def __init__(self, device, link=None):
+        self.device = device
+        self.master, self.slave = os.openpty()
+        # raw mode on the slave, the frames are binary
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.path = os.ttyname(self.slave)
+        self.link = link
+        if link:
+            if os.path.lexists(link):
+                os.unlink(link)
+            os.symlink(self.path, link)
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @property
+    def port(self):
+        return self.link or self.path
+
+    def on_readable(self):
+        try:
+            data = os.read(self.master, READ_CHUNK)
+        except OSError as err:
+            # EIO while no driver has the slave open, EAGAIN on a spurious wake up
+            if err.errno in (errno.EIO, errno.EAGAIN):
+                return
+            raise
+        self.bytes_in += len(data)
+        reply = self.device.feed(data)
+        if reply:
+            self.bytes_out += os.write(self.master, reply)
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+        if self.link and os.path.islink(self.link):
+            os.unlink(self.link)
+
+
+class SimulatedRig(object):
+
+    def __init__(self, index, link_dir=None, **pack_options):
+        self.index = index
+        self.pack = PackModel(FIRST_SERIAL_NUMBER + index, **pack_options)
+        self.inverter = Mk2Device(self.pack)
+        self.battery = UsbIssDevice(self.pack)
+        self.battery_endpoint = PtyEndpoint(self.battery, link_dir and os.path.join(link_dir, 'b{}'.format(index)))
+        self.inverter_endpoint = PtyEndpoint(self.inverter, link_dir and os.path.join(link_dir, 'i{}'.format(index)))
+
+    def step(self, dt, now):
+        self.pack.step(dt, self.inverter.power, now)
+
+    def as_dict(self):
+        return {'index': self.index,
+                'serial_number': self.pack.serial_number,
+                'battery_port': self.battery_endpoint.port,
+                'inverter_port': self.inverter_endpoint.port}
+
+    def close(self):
+        self.battery_endpoint.close()
+        self.inverter_endpoint.close()
+
+
+def raise_file_limit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY or soft >= needed:
+        return
+    resource.setrlimit(resource.RLIMIT_NOFILE, (needed if hard == resource.RLIM_INFINITY else min(needed, hard), hard))
+
+
+class SimulatorHost(object):
+    """
+        Runs a number of simulated rigs. start() serves them from a daemon thread, stop() closes every pty.
+    """
+
+    def __init__(self, rigs, link_dir=None, tick=TICK, **pack_options):
+        # 2 pty pairs per rig, the drivers may open the slave sides in this process too (benchmarks)
+        raise_file_limit(rigs * 6 + 256)
+        if link_dir:
+            os.makedirs(link_dir, exist_ok=True)
+        self.tick = tick
+        self.rigs = [SimulatedRig(index, link_dir, **pack_options) for index in range(rigs)]
+        self.selector = selectors.DefaultSelector()
+        for rig in self.rigs:
+            for endpoint in (rig.battery_endpoint, rig.inverter_endpoint):
+                self.selector.register(endpoint.master, selectors.EVENT_READ, endpoint)
+        self.ticks = 0
+        self.late_ticks = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def serve(self):
+        last = next_tick = time.time()
+        while not self._stopped.is_set():
+            for key, _ in self.selector.select(max(0.0, next_tick - time.time())):
+                try:
+                    key.data.on_readable()
+                except Exception as err:
+                    log_base.exception('Simulated device on %s failed. Error is: %s', key.data.port, err)
+            now = time.time()
+            if now < next_tick:
+                continue
+            for rig in self.rigs:
+                rig.step(now - last, now)
+            self.ticks += 1
+            last = now
+            next_tick += self.tick
+            if next_tick < now:
+                # the host cannot keep up, do not try to catch up
+                self.late_ticks += 1
+                next_tick = now + self.tick
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve, name='simulator')
+        self._thread.daemon = True
+        self._thread.start()
+        log_base.info('Simulating %s rigs.', len(self.rigs))
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.selector.close()
+        for rig in self.rigs:
+            rig.close()
+
+    def ports(self):
+        return [rig.as_dict() for rig in self.rigs]
+
+    def stats(self):
+        return {'rigs': len(self.rigs),
+                'ticks': self.ticks,
+                'late_ticks': self.late_ticks,
+                'bytes_in': sum(rig.battery_endpoint.bytes_in + rig.inverter_endpoint.bytes_in for rig in self.rigs),
+                'bytes_out': sum(rig.battery_endpoint.bytes_out + rig.inverter_endpoint.bytes_out
+                                 for rig in self.rigs)}
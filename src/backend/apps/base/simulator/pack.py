@@ -0,0 +1,66 @@
+"""
+Electrical and thermal model of a battery pack and its inverter load, just detailed enough to drive the drivers,
+the safety checks and the analytics with plausible values.
+
+Each cell has its own capacity (a few percent spread, seeded by the serial number) and state of charge, an open
+circuit voltage taken from OCV_CURVE and a series resistance. Positive current discharges the pack, like the
+BATTERY_OCP check. The pack and the mosfets heat with I^2 R and cool towards the ambient temperature.
+"""
+import bisect
+import random
+
+# (state of charge, open circuit voltage) of one cell
+OCV_CURVE = ((0.0, 3.00), (0.05, 3.30), (0.1, 3.45), (0.2, 3.58), (0.4, 3.70), (0.6, 3.82), (0.8, 3.98),
+             (0.9, 4.07), (1.0, 4.18))
+_OCV_SOC = [soc for soc, _ in OCV_CURVE]
+
+
+def open_circuit_voltage(soc):
+    soc = min(max(soc, 0.0), 1.0)
+    index = min(max(bisect.bisect_right(_OCV_SOC, soc), 1), len(OCV_CURVE) - 1)
+    (soc_0, v_0), (soc_1, v_1) = OCV_CURVE[index - 1], OCV_CURVE[index]
+    return v_0 + (v_1 - v_0) * (soc - soc_0) / (soc_1 - soc_0)
+
+
+class PackModel(object):
+    # seconds the pack stays on after the last keep alive (the drivers send one every 10 seconds or less)
+    KEEP_ALIVE = 10.0
+
+    def __init__(self, serial_number, cells=9, capacity_ah=20.0, soc=0.5, cell_resistance=0.003, ambient=25.0,
+                 spread=0.03):
+        rng = random.Random(serial_number)
+        self.serial_number = serial_number
+        self.capacities = [capacity_ah * (1 + rng.uniform(-spread, spread)) for _ in range(cells)]
+        self.socs = [min(max(soc + rng.uniform(-spread, spread), 0.0), 1.0) for _ in range(cells)]
+        self.cell_resistance = cell_resistance
+        self.ambient = ambient
+        self.pack_temp = ambient
+        self.mosfet_temp = ambient
+        self.current = 0.0
+        self.on_until = 0.0
+
+    @property
+    def cell_voltages(self):
+        drop = self.current * self.cell_resistance
+        return [open_circuit_voltage(soc) - drop for soc in self.socs]
+
+    @property
+    def voltage(self):
+        return sum(self.cell_voltages)
+
+    def is_on(self, now):
+        return now < self.on_until
+
+    def keep_alive(self, now):
+        self.on_until = now + self.KEEP_ALIVE
+
+    def step(self, dt, power, now):
+        """
+            Advances the model by dt seconds with the inverter drawing power watts (negative charges the pack).
+        """
+        self.current = power / self.voltage if power and self.is_on(now) else 0.0
+        for index, capacity in enumerate(self.capacities):
+            self.socs[index] = min(max(self.socs[index] - self.current * dt / 3600 / capacity, 0.0), 1.0)
+        heat = self.current ** 2 * self.cell_resistance * len(self.socs)
+        self.pack_temp += (heat * 0.02 - (self.pack_temp - self.ambient) * 0.002) * dt
+        self.mosfet_temp += (heat * 0.05 - (self.mosfet_temp - self.ambient) * 0.01) * dt
@@ -0,0 +1,182 @@
+"""
+Typed snapshots of the device readings.
+
+The values are kept as raw numbers and the pack/inverter states as flag bits.
+Formatting is left to whoever presents them (logs, admin, API), see as_dict().
+"""
+import time
+
+# PackSnapshot.flags
+PACK_CELL_OVERVOLTAGE_LEVEL_1 = 1 << 0
+PACK_CELL_OVERVOLTAGE_LEVEL_2 = 1 << 1
+PACK_CELL_UNDERVOLTAGE_LEVEL_1 = 1 << 2
+PACK_CELL_UNDERVOLTAGE_LEVEL_2 = 1 << 3
+PACK_NOT_SAFE_LEVEL_1 = 1 << 4
+PACK_NOT_SAFE_LEVEL_2 = 1 << 5
+PACK_OVERCURRENT = 1 << 6
+PACK_OVERTEMPERATURE_MOSFETS = 1 << 7
+PACK_OVERTEMPERATURE_CELLS = 1 << 8
+PACK_IS_ON = 1 << 9
+
+PACK_FLAG_NAMES = (
+    (PACK_CELL_OVERVOLTAGE_LEVEL_1, 'is_cell_overvoltage_level_1'),
+    (PACK_CELL_OVERVOLTAGE_LEVEL_2, 'is_cell_overvoltage_level_2'),
+    (PACK_CELL_UNDERVOLTAGE_LEVEL_1, 'is_cell_undervoltage_level_1'),
+    (PACK_CELL_UNDERVOLTAGE_LEVEL_2, 'is_cell_undervoltage_level_2'),
+    (PACK_NOT_SAFE_LEVEL_1, 'is_not_safe_level_1'),
+    (PACK_NOT_SAFE_LEVEL_2, 'is_not_safe_level_2'),
+    (PACK_OVERCURRENT, 'is_pack_overcurrent'),
+    (PACK_OVERTEMPERATURE_MOSFETS, 'is_overtemperature_mosfets'),
+    (PACK_OVERTEMPERATURE_CELLS, 'is_overtemperature_cells'),
+    (PACK_IS_ON, 'is_on'),
+)
+
+# InverterSnapshot.flags
+INVERTER_IS_ON = 1 << 0
+
+
+class PackSnapshot(object):
+    """
+        One decoded USB-ISS status frame of a battery pack plus the pack state flags.
+    """
+    __slots__ = ('timestamp', 'serial_number', 'cell_voltages', 'dc_current', 'mosfet_temp', 'pack_temp', 'flags')
+
+    def __init__(self, serial_number=0, cell_voltages=(0.0,) * 9, dc_current=0.0, mosfet_temp=0.0, pack_temp=0.0,
+                 flags=0, timestamp=None):
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.serial_number = serial_number
+        self.cell_voltages = tuple(cell_voltages)
+        self.dc_current = dc_current
+        self.mosfet_temp = mosfet_temp
+        self.pack_temp = pack_temp
+        self.flags = flags
+
+    def __repr__(self):
+        return '<PackSnapshot {} cells={} current={:.3f} flags={:#05x}>'.format(
+            self.serial_number,
+            ['{:.3f}'.format(cv) for cv in self.cell_voltages],
+            self.dc_current,
+            self.flags)
+
+    @property
+    def cv_min(self):
+        return min(self.cell_voltages)
+
+    @property
+    def cv_max(self):
+        return max(self.cell_voltages)
+
+    def has_flag(self, flag):
+        return bool(self.flags & flag)
+
+    def set_flag(self, flag):
+        self.flags |= flag
+
+    def clear_flag(self, flag):
+        self.flags &= ~flag
+
+    @property
+    def is_not_safe_level_1(self):
+        return self.has_flag(PACK_NOT_SAFE_LEVEL_1)
+
+    @property
+    def is_not_safe_level_2(self):
+        return self.has_flag(PACK_NOT_SAFE_LEVEL_2)
+
+    @property
+    def is_on(self):
+        return self.has_flag(PACK_IS_ON)
+
+    def as_dict(self):
+        """
+            Presentation view, keyed like the old pack_variables dict. Values stay numeric.
+        """
+        values = {'serial_number': self.serial_number,
+                  'dc_current': self.dc_current,
+                  'mosfet_temp': self.mosfet_temp,
+                  'pack_temp': self.pack_temp,
+                  'cv_min': self.cv_min,
+                  'cv_max': self.cv_max,
+                  'last_status_update': self.timestamp}
+        for i, cv in enumerate(self.cell_voltages, 1):
+            values['cv_{}'.format(i)] = cv
+        for flag, name in PACK_FLAG_NAMES:
+            values[name] = bool(self.flags & flag)
+        return values
+
+    @classmethod
+    def from_dict(cls, values):
+        """
+            Inverse of as_dict (e.g. for values that travelled over IPC).
+        """
+        flags = 0
+        for flag, name in PACK_FLAG_NAMES:
+            if values.get(name):
+                flags |= flag
+        cell_count = len([key for key in values if key.startswith('cv_') and key[3:].isdigit()])
+        return cls(serial_number=values['serial_number'],
+                   cell_voltages=[values['cv_{}'.format(i)] for i in range(1, cell_count + 1)],
+                   dc_current=values['dc_current'],
+                   mosfet_temp=values['mosfet_temp'],
+                   pack_temp=values['pack_temp'],
+                   flags=flags,
+                   timestamp=values['last_status_update'])
+
+
+class InverterSnapshot(object):
+    """
+        Latest AC/DC readings of an inverter. AC and DC frames arrive separately, each has its own timestamp.
+    """
+    __slots__ = ('dc_voltage', 'dc_current', 'ac_voltage', 'ac_current', 'last_ac_update', 'last_dc_update', 'flags')
+
+    def __init__(self, dc_voltage=0.0, dc_current=0.0, ac_voltage=0.0, ac_current=0.0,
+                 last_ac_update=None, last_dc_update=None, flags=0):
+        self.dc_voltage = dc_voltage
+        self.dc_current = dc_current
+        self.ac_voltage = ac_voltage
+        self.ac_current = ac_current
+        self.last_ac_update = last_ac_update
+        self.last_dc_update = last_dc_update
+        self.flags = flags
+
+    def __repr__(self):
+        return '<InverterSnapshot dc={:.2f}V/{:.2f}A ac={:.2f}V/{:.2f}A>'.format(
+            self.dc_voltage, self.dc_current, self.ac_voltage, self.ac_current)
+
+    @property
+    def timestamp(self):
+        """
+            Time of the oldest of the two frames, i.e. how fresh the snapshot is as a whole.
+        """
+        if self.last_ac_update is None or self.last_dc_update is None:
+            return self.last_ac_update or self.last_dc_update
+        return min(self.last_ac_update, self.last_dc_update)
+
+    @property
+    def is_on(self):
+        return bool(self.flags & INVERTER_IS_ON)
+
+    def as_dict(self):
+        """
+            Presentation view, keyed like the old inverter_variables dict.
+        """
+        return {'dc_current': self.dc_current,
+                'dc_voltage': self.dc_voltage,
+                'ac_current': self.ac_current,
+                'ac_voltage': self.ac_voltage,
+                'last_ac_update': self.last_ac_update,
+                'last_dc_update': self.last_dc_update,
+                'is_on': self.is_on}
+
+    @classmethod
+    def from_dict(cls, values):
+        """
+            Inverse of as_dict (e.g. for values that travelled over IPC).
+        """
+        return cls(dc_voltage=values['dc_voltage'],
+                   dc_current=values['dc_current'],
+                   ac_voltage=values['ac_voltage'],
+                   ac_current=values['ac_current'],
+                   last_ac_update=values['last_ac_update'],
+                   last_dc_update=values['last_dc_update'],
+                   flags=INVERTER_IS_ON if values.get('is_on') else 0)
@@ -0,0 +1,309 @@
+"""
+Rig supervisor.
+
+Replaces the three django_celery_beat PeriodicTasks per test (inverter setpoint, battery keep alive, safety check)
+with one timer wheel per host that drives every supervised rig on the SerialEngine loop:
+    1. setpoint refresh (inverter needs it every 5 seconds or less)
+    2. battery keep alive (turn_pack_on, needed every 10 seconds or less)
+    3. pack telemetry poll; every sample goes through the SafetyMonitor (5 Hz by default) into the
+       FleetSafetyEngine, which checks all the packs of the host in one pass on the next tick
+    4. inverter AC/DC frame requests
+Celery (and beat) is then only needed for the coarse orchestration: main_task hands the rig over and returns.
+
+The supervisor lives where the serial ports are owned: in the port daemon if there is one
+(PORT_DAEMON_ADDRESS), otherwise in the worker process that ran main_task. The teardown may run in another
+worker process than that one, so the supervisor also releases the rigs of finished test cases by itself.
+"""
+import asyncio
+
+from django.conf import settings
+
+from .events import publish_test_case_state
+from .log import log_base, log_test_case
+from .safety import SafetyMonitor, FleetSafetyEngine, LimitProfile
+from .integration import get_step_integrator
+from .telemetry import get_telemetry_writer, is_telemetry_enabled
+from .transport import SerialEngine
+from .utils import UsbIssBattery, VictronMultiplusMK2VCP
+
+DEFAULT_INTERVALS = {
+    'setpoint': 5,
+    'keep_alive': 5,
+    'pack_poll': 0.2,
+    'inverter_poll': 2,
+    # host wide: how often the supervisor looks for rigs whose test case has finished
+    'state_check': 5,
+}
+
+
+class TimerJob(object):
+    __slots__ = ('name', 'interval', 'callback', 'target_tick', 'running', 'cancelled')
+
+    def __init__(self, name, interval, callback):
+        self.name = name
+        self.interval = interval
+        self.callback = callback
+        self.target_tick = 0
+        self.running = False
+        self.cancelled = False
+
+
+class TimerWheel(object):
+    """
+        Hashed timer wheel: jobs are put in slot (target_tick % size), advance() only looks at the current slot.
+        Scheduling and expiry are O(1) per job, the resolution is one tick.
+    """
+
+    def __init__(self, tick=0.05, size=256):
+        self.tick = tick
+        self.size = size
+        self.slots = [[] for _ in range(size)]
+        self.current_tick = 0
+
+    def schedule(self, job, delay):
+        ticks = max(1, int(round(delay / self.tick)))
+        job.target_tick = self.current_tick + ticks
+        self.slots[job.target_tick % self.size].append(job)
+
+    def advance(self):
+        """
+            Moves the wheel one tick forward and returns the jobs that expired.
+        """
+        self.current_tick += 1
+        slot = self.slots[self.current_tick % self.size]
+        if not slot:
+            return []
+        due = [job for job in slot if job.target_tick <= self.current_tick]
+        if due:
+            slot[:] = [job for job in slot if job.target_tick > self.current_tick]
+        return due
+
+
+class RigSupervisor(object):
+    """
+        The periodic work of one rig (battery + inverter) for the duration of a test case.
+    """
+
+    def __init__(self, test_case_id, battery, inverter, set_point, intervals=None, fleet=None):
+        self.test_case_id = test_case_id
+        self.battery = battery
+        self.inverter = inverter
+        self.inverter.set_point = set_point
+        self.intervals = dict(DEFAULT_INTERVALS, **(intervals or {}))
+        self.jobs = []
+        self.safety_monitor = SafetyMonitor(battery, inverter, on_trip=self.on_safety_trip, fleet=fleet)
+        self.telemetry = get_telemetry_writer() if is_telemetry_enabled() else None
+        self.integrator = get_step_integrator()
+
+    def make_jobs(self):
+        self.safety_monitor.attach()
+        self.battery.sample_listeners.append(self.integrate_pack_sample)
+        if self.telemetry is not None:
+            self.battery.sample_listeners.append(self.record_pack_sample)
+        # the jobs of one device run concurrently, the driver serialises their I/O on its transport lock
+        self.jobs = [
+            TimerJob('setpoint', self.intervals['setpoint'], self.inverter.send_setpoint_async),
+            TimerJob('keep_alive', self.intervals['keep_alive'], self.battery.turn_pack_on_async),
+            TimerJob('pack_poll', self.intervals['pack_poll'], self.battery.update_values_async),
+            TimerJob('inverter_poll', self.intervals['inverter_poll'], self.poll_inverter),
+        ]
+        return self.jobs
+
+    def integrate_pack_sample(self, snapshot):
+        self.integrator.submit_sample(self.test_case_id, snapshot)
+
+    def record_pack_sample(self, snapshot):
+        self.telemetry.record_pack(self.test_case_id, self.battery.com_port, snapshot)
+
+    async def poll_inverter(self):
+        # completes with the fresh AC/DC frames in the snapshot (one pipelined round trip)
+        refreshed = await self.inverter.request_frames_update_async()
+        if refreshed and self.telemetry is not None:
+            self.telemetry.record_inverter(self.test_case_id, self.inverter.com_port, self.inverter.snapshot)
+        return refreshed
+
+    def cancel(self):
+        self.safety_monitor.detach()
+        for listener in (self.integrate_pack_sample, self.record_pack_sample):
+            if listener in self.battery.sample_listeners:
+                self.battery.sample_listeners.remove(listener)
+        for job in self.jobs:
+            job.cancelled = True
+
+    async def on_safety_trip(self, reason):
+        """
+            The safety monitor already stopped the inverter. Level 1 only latches the flag (the recipe steps react
+            to it), so we only get here for level 2.
+        """
+        log_base.info('Safety level 2 tripped for test case %s on port %s (%s). Stopping the rig.',
+                      self.test_case_id, self.battery.com_port, reason)
+        self.cancel()
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, finish_test_case, self.test_case_id, 'ERROR', reason[:32])
+
+
+def finished_test_cases(test_case_ids):
+    """
+        The ids of test_case_ids that are FINISHED (or gone). Queries the database, do not call it on the loop.
+    """
+    from .models import TestCase
+    running = set(TestCase.objects.filter(id__in=test_case_ids).exclude(state='FINISHED').values_list('id', flat=True))
+    return [test_case_id for test_case_id in test_case_ids if test_case_id not in running]
+
+
+def finish_test_case(test_case_id, result, description):
+    from .models import TestCase
+    from .tasks import dispatch_teardown
+    TestCase.objects.filter(id=test_case_id).update(state='FINISHED', result=result, description=description)
+    publish_test_case_state(test_case_id, 'FINISHED', result, description)
+    dispatch_teardown(test_case_id)
+    log_test_case.info('Test case %s finished with result %s (%s).', test_case_id, result, description)
+
+
+class HostSupervisor(object):
+    """
+        Runs the timer wheel of all the supervised rigs of this process on the SerialEngine loop.
+        Use get_host_supervisor().
+    """
+
+    def __init__(self, tick=0.05):
+        self.engine = SerialEngine.get_engine()
+        self.wheel = TimerWheel(tick=tick)
+        self.rigs = {}
+        self.fleet = FleetSafetyEngine()
+        self.intervals = dict(DEFAULT_INTERVALS, **(getattr(settings, 'RIG_SUPERVISOR_INTERVALS', None) or {}))
+        self._runner = None
+        self._state_check = None
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        next_time = loop.time()
+        while self.rigs:
+            next_time += self.wheel.tick
+            await asyncio.sleep(max(0, next_time - loop.time()))
+            if self.fleet.dirty:
+                self.fleet.evaluate_and_dispatch()
+            for job in self.wheel.advance():
+                if job.cancelled:
+                    continue
+                # a slow device never gets overlapping calls, the job just skips this period
+                if not job.running:
+                    loop.create_task(self._run_job(job))
+                self.wheel.schedule(job, job.interval)
+        self._state_check.cancelled = True
+        self._runner = None
+
+    async def _run_job(self, job):
+        job.running = True
+        try:
+            await job.callback()
+        except Exception as err:
+            log_base.exception('Supervisor job %s failed. Error is: %s', job.name, err)
+        finally:
+            job.running = False
+
+    async def release_finished_rigs(self):
+        """
+            Stops the rigs whose test case has finished. teardown_test_case releases the rig as well, but without
+            a port daemon it may run in another worker process than this one.
+        """
+        if not self.rigs:
+            return True
+        loop = asyncio.get_event_loop()
+        for test_case_id in await loop.run_in_executor(None, finished_test_cases, list(self.rigs)):
+            await self.stop_rig_async(test_case_id)
+        return True
+
+    async def start_rig_async(self, test_case_id, battery_port, inverter_port, set_point, intervals=None,
+                              limits=None):
+        if test_case_id in self.rigs:
+            return False
+        # one rig per port: a rig left over by a finished test case goes, a running one keeps its ports
+        sharing = [rig_id for rig_id, rig in self.rigs.items()
+                   if rig.battery.com_port == battery_port or rig.inverter.com_port == inverter_port]
+        if sharing:
+            finished = await asyncio.get_event_loop().run_in_executor(None, finished_test_cases, sharing)
+            for rig_id in finished:
+                await self.stop_rig_async(rig_id)
+            if len(finished) < len(sharing):
+                log_base.error('Cannot supervise test case %s: test case %s is still running on its ports.',
+                               test_case_id, ', '.join(str(rig_id) for rig_id in sharing if rig_id not in finished))
+                return False
+        battery = get_local_battery(battery_port)
+        if limits is not None:
+            battery.limits = LimitProfile(**limits)
+        inverter = get_local_inverter(inverter_port)
+        rig = RigSupervisor(test_case_id, battery, inverter, set_point, intervals, fleet=self.fleet)
+        self.rigs[test_case_id] = rig
+        for job in rig.make_jobs():
+            self.wheel.schedule(job, 0)
+        if self._runner is None:
+            self._state_check = TimerJob('state_check', self.intervals['state_check'], self.release_finished_rigs)
+            self.wheel.schedule(self._state_check, self._state_check.interval)
+            self._runner = asyncio.get_event_loop().create_task(self._run())
+        log_base.info('Supervising test case %s (battery %s, inverter %s).', test_case_id, battery_port, inverter_port)
+        return True
+
+    async def stop_rig_async(self, test_case_id):
+        rig = self.rigs.pop(test_case_id, None)
+        if rig is None:
+            return False
+        rig.cancel()
+        log_base.info('Stopped supervising test case %s.', test_case_id)
+        return True
+
+    def start_rig(self, test_case_id, battery_port, inverter_port, set_point, intervals=None, limits=None):
+        return self.engine.run(self.start_rig_async(test_case_id, battery_port, inverter_port, set_point, intervals,
+                                                    limits))
+
+    def stop_rig(self, test_case_id):
+        return self.engine.run(self.stop_rig_async(test_case_id))
+
+    def supervised_rigs(self):
+        return sorted(self.rigs)
+
+
+def get_local_battery(port):
+    if port not in UsbIssBattery.battery_instances:
+        UsbIssBattery.battery_instances[port] = UsbIssBattery(port)
+    return UsbIssBattery.battery_instances[port]
+
+
+def get_local_inverter(port):
+    if port not in VictronMultiplusMK2VCP.inverter_instances:
+        VictronMultiplusMK2VCP.inverter_instances[port] = VictronMultiplusMK2VCP(port)
+    return VictronMultiplusMK2VCP.inverter_instances[port]
+
+
+_host_supervisor = None
+
+
+def get_host_supervisor():
+    global _host_supervisor
+    if _host_supervisor is None:
+        _host_supervisor = HostSupervisor()
+    return _host_supervisor
+
+
+def is_supervisor_enabled():
+    return getattr(settings, 'RIG_SUPERVISOR_ENABLED', False)
+
+
+def supervise_rig(test_case_id, battery_port, inverter_port, set_point, limits=None):
+    """
+        Hands a rig over to the supervisor of the process that owns its ports.
+        limits: LimitProfile.as_dict() of the battery (the settings apply if None).
+    """
+    from .port_daemon import get_port_daemon_address, get_port_daemon_client
+    intervals = getattr(settings, 'RIG_SUPERVISOR_INTERVALS', None)
+    if get_port_daemon_address():
+        return get_port_daemon_client().call('host', None, 'start_rig',
+                                             test_case_id, battery_port, inverter_port, set_point, intervals, limits)
+    return get_host_supervisor().start_rig(test_case_id, battery_port, inverter_port, set_point, intervals, limits)
+
+
+def release_rig(test_case_id):
+    from .port_daemon import get_port_daemon_address, get_port_daemon_client
+    if get_port_daemon_address():
+        return get_port_daemon_client().call('host', None, 'stop_rig', test_case_id)
+    return get_host_supervisor().stop_rig(test_case_id)
@@ -11,6 +11,10 @@ from django_celery_beat.models import PeriodicTask, IntervalSchedule
 # log_inv should be used for the inverter tasks
 from .log import log_inverter as log_inv, log_battery as log_bat
 from .log import log_test_case as log_main
+from .supervisor import is_supervisor_enabled, supervise_rig, release_rig
+from .events import publish_test_case_state
+from .telemetry import get_telemetry_writer, is_telemetry_enabled
+from .integration import get_step_integrator
 
 
 class MaxRetriesExceededException(Exception):
@@ -80,7 +84,14 @@ def safety_check(self, battery_id, inverter_id, test_case_id,
 
     # add code to check the battery parameter(or just call a method of the battery object
     log_bat.info('before parameters check')
-    if not battery.battery_utilities.check_safety_level_2():
+    battery_instance = battery.battery_utilities
+    if not battery_instance.update_values():
+        log_bat.info('no fresh values for battery %s, skipping the parameters check', battery.name)
+        return
+    get_step_integrator().add_samples(test_case.id, [battery_instance.snapshot])
+    if is_telemetry_enabled():
+        get_telemetry_writer().record_pack(test_case.id, battery.port, battery_instance.snapshot)
+    if not battery_instance.check_safety_level_2():
         # stop rig here
         log_bat.info('battery params failed')
         # stop the periodic tasks: bat and inv
@@ -96,6 +107,8 @@ def safety_check(self, battery_id, inverter_id, test_case_id,
         test_case.result = 'ERROR'
         test_case.description = 'failed because of ...'
         test_case.save()
+        publish_test_case_state(test_case.id, test_case.state, test_case.result, test_case.description)
+        dispatch_teardown(test_case.id, battery.port)
 
         #stop inverter, stop battery
 #         battery.battery_utilities.stop_and_release()
@@ -111,7 +124,6 @@ def safety_check(self, battery_id, inverter_id, test_case_id,
 
 @shared_task(bind=True)
 def main_task(self, test_case_id):
-    time.sleep(1)
     from .models import TestCase
     from .models import Inverter
     from .models import Battery
@@ -120,24 +132,29 @@ def main_task(self, test_case_id):
     battery = test_case.battery
     inverter = test_case.inverter
     
-    # Inverter Setup
+    # Inverter Setup (a no-op if the rig was brought up at start, see bringup.py)
     victron_inv = inverter.inverter_utilities #local instance of the inv utilities for the inverter in use
     victron_inv.prepare_inverter()
 
     # Battery Setup
     battery_instance = battery.battery_utilities
-    battery_instance.configure_USB_ISS()
-    battery_instance.turn_pack_on()
+    battery_instance.bring_up()
     
+    val = -200# inverter.inverter_utilities.send_setpoint()
+    log_main.info('send_setpoint returns %s', val)
+
+    if is_supervisor_enabled():
+        # setpoint, keep alive, telemetry and safety run on the rig supervisor instead of beat
+        supervise_rig(test_case.id, battery.port, inverter.port, val, battery.limit_profile.as_dict())
+        log_main.info('test case %s handed over to the rig supervisor', test_case.id)
+        return
+
     # create django celery beat periodic task
     # they are like normal django objects with the same methods and query engine
 
     # create 5s period schedule. Use this for all the tasks that must run at every 5 seconds
     s5_schedule, created = IntervalSchedule.objects.get_or_create(every=5, period=IntervalSchedule.SECONDS)
     
-    
-    val = -200# inverter.inverter_utilities.send_setpoint()
-    log_main.info('send_setpoint returns %s', val)
     # create the send_inverter_setpoint periodic task
     inv_periodic_task = PeriodicTask.objects.create(
         interval=s5_schedule,  # we created this above.
@@ -176,22 +193,71 @@ def main_task(self, test_case_id):
         queue='periodic_com_{}'.format(battery.port)
     )
     log_main.info('periodic task send_battery_keep_alive scheduled')
-        
-    
-    
-    ### test the scheduler with the while loop below:
-    while True:
-        test_case = TestCase.objects.get(id=test_case_id)
-        log_main.info('main_task logic %s', test_case.state)
-        if test_case.state == 'FINISHED':
-            break
-
-        time.sleep(20)
-    ### 
-    
-    
-    
-    
-    # TODO
-    # main logic
-    
+    # no polling: whoever finishes the test case dispatches its teardown (see dispatch_teardown)
+
+
+@shared_task(bind=True)
+def teardown_test_case(self, test_case_id):
+    """
+    Runs once the test case is FINISHED. Dispatched by dispatch_teardown wherever the FINISHED state is written.
+    Idempotent: only the first run claims the test case (torn_down), a duplicate dispatch returns straight away.
+    :param self:
+    :param test_case_id:
+    :return:
+    """
+    from .models import TestCase
+    if not TestCase.objects.filter(id=test_case_id, state='FINISHED', torn_down=False).update(torn_down=True):
+        log_main.info('test case %s is not finished or already torn down', test_case_id)
+        return
+    log_main.info('tearing down test case %s', test_case_id)
+    if is_supervisor_enabled():
+        release_rig(test_case_id)
+    if is_telemetry_enabled():
+        get_telemetry_writer().flush()
+        port = TestCase.objects.filter(id=test_case_id).values_list('battery__port', flat=True).first()
+        # the process that recorded the samples may still hold a batch, give it one flush interval
+        archive_telemetry.apply_async((test_case_id,), queue='main_com_{}'.format(port),
+                                      countdown=get_telemetry_writer().flush_interval + 1)
+
+
+@shared_task(bind=True)
+def archive_telemetry(self, test_case_id):
+    """
+    Compacts the telemetry of a finished test case into its columnar archive.
+    :param self:
+    :param test_case_id:
+    :return:
+    """
+    from .models import TestCase
+    from .archive import archive_test_case
+    test_case = TestCase.objects.get(id=test_case_id)
+    archive_test_case(test_case)
+
+
+@shared_task(bind=True)
+def prune_telemetry(self):
+    """
+    Retention policy of the raw telemetry. Schedule it daily with beat; the rollups are kept.
+    :param self:
+    :return:
+    """
+    from django.conf import settings
+    from .rollups import prune_raw_samples
+    return prune_raw_samples(settings.TELEMETRY_RAW_RETENTION_DAYS)
+
+
+def dispatch_teardown(test_case_id, port=None):
+    """
+    Queues teardown_test_case once the FINISHED state is committed. Called by every writer of the FINISHED state
+    (TestCase.set_state, supervisor.finish_test_case, safety_check), so the teardown does not depend on the
+    process that ran main_task still being alive.
+    :param test_case_id:
+    :param port: battery port of the test case, the teardown goes to its main_com queue (looked up if None)
+    :return:
+    """
+    from django.db import transaction
+    from .models import TestCase
+    if port is None:
+        port = TestCase.objects.filter(id=test_case_id).values_list('battery__port', flat=True).first()
+    log_main.info('test case %s finished, dispatching its teardown', test_case_id)
+    transaction.on_commit(lambda: teardown_test_case.apply_async((test_case_id,), queue='main_com_{}'.format(port)))
@@ -0,0 +1,216 @@
+"""
+Telemetry history.
+
+Every pack / inverter reading taken during a test becomes a TelemetrySample row. The readings are buffered in
+memory and written with bulk_create by a background thread, in batches of TELEMETRY_BATCH_SIZE samples or every
+TELEMETRY_FLUSH_INTERVAL seconds, whichever comes first. Recording never touches the database, so it is safe to
+call from the SerialEngine loop (e.g. as a battery sample listener).
+The per minute and per step TelemetryRollup rows are maintained on the way (see rollups.py) and written with the
+same batches, merged with the rows the writers of the other processes wrote for the same buckets.
+A batch whose insert fails goes back to the buffer and is retried with the next flush. While the database stays
+unreachable the buffer is capped at TELEMETRY_MAX_BUFFER samples (and as many rollup rows): the oldest are dropped
+and counted in samples_dropped / rollups_dropped.
+"""
+import atexit
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .events import get_event_bus, TEST_CASE_CHANNEL, TEST_CASE_STEP_CHANNEL
+from .log import log_base
+from .rollups import RollupAggregator, write_rollups
+
+CELL_COLUMNS = tuple('cv_{}'.format(i) for i in range(1, 10))
+# float columns of TelemetrySample each device type fills, in storage order
+DEVICE_COLUMNS = {
+    'battery': ('timestamp', 'dc_voltage', 'dc_current') + CELL_COLUMNS + ('mosfet_temp', 'pack_temp', 'flags'),
+    'inverter': ('timestamp', 'dc_voltage', 'dc_current', 'ac_voltage', 'ac_current', 'flags'),
+}
+
+
+class TelemetryWriter(object):
+    """
+        Write-behind buffer of TelemetrySample rows. Use get_telemetry_writer().
+    """
+
+    def __init__(self, batch_size=500, flush_interval=5.0, max_buffer=50000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.buffer = []
+        self.rollups = RollupAggregator()
+        # closed rollup rows whose insert failed, retried with the next flush
+        self.pending_rollups = []
+        self.samples_written = 0
+        self.rollups_written = 0
+        self.samples_dropped = 0
+        self.rollups_dropped = 0
+        self.flushes = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flusher = None
+
+    def _start(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._run, name='telemetry_writer')
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _append(self, sample):
+        with self._lock:
+            self.buffer.append(sample)
+            self.rollups.add(sample)
+            full = len(self.buffer) >= self.batch_size
+            self._start()
+        if full:
+            self._wakeup.set()
+
+    def record_pack(self, test_case_id, port, snapshot):
+        from .models import TelemetrySample
+        cells = {'cv_{}'.format(i): cv for i, cv in enumerate(snapshot.cell_voltages, 1)}
+        self._append(TelemetrySample(test_case_id=test_case_id,
+                                     device='battery',
+                                     port=port,
+                                     timestamp=snapshot.timestamp,
+                                     dc_voltage=sum(snapshot.cell_voltages),
+                                     dc_current=snapshot.dc_current,
+                                     mosfet_temp=snapshot.mosfet_temp,
+                                     pack_temp=snapshot.pack_temp,
+                                     flags=snapshot.flags,
+                                     **cells))
+
+    def record_inverter(self, test_case_id, port, snapshot):
+        from .models import TelemetrySample
+        if snapshot.timestamp is None:
+            return
+        self._append(TelemetrySample(test_case_id=test_case_id,
+                                     device='inverter',
+                                     port=port,
+                                     timestamp=snapshot.timestamp,
+                                     dc_voltage=snapshot.dc_voltage,
+                                     dc_current=snapshot.dc_current,
+                                     ac_voltage=snapshot.ac_voltage,
+                                     ac_current=snapshot.ac_current,
+                                     flags=snapshot.flags))
+
+    def start_step(self, test_case_id, step_index):
+        with self._lock:
+            self.rollups.start_step(test_case_id, step_index)
+
+    def finish_test_case(self, test_case_id):
+        with self._lock:
+            self.rollups.finish_test_case(test_case_id)
+        self._wakeup.set()
+
+    def on_event(self, channel, message):
+        if channel == TEST_CASE_STEP_CHANNEL:
+            self.start_step(message['test_case_id'], message['step_index'])
+        elif message['state'] == 'FINISHED':
+            self.finish_test_case(message['test_case_id'])
+        return False
+
+    def subscribe(self):
+        """
+            Follows the recipe steps and the end of the test cases for the step rollups.
+        """
+        bus = get_event_bus()
+        bus.subscribe(TEST_CASE_STEP_CHANNEL, self.on_event)
+        bus.subscribe(TEST_CASE_CHANNEL, self.on_event)
+
+    def _requeue(self, samples, rollups):
+        """
+            Puts a failed batch back in front of what was recorded since. Drops the oldest rows past max_buffer.
+        """
+        with self._lock:
+            self.buffer = samples + self.buffer
+            self.pending_rollups = rollups + self.pending_rollups
+            dropped_samples = max(0, len(self.buffer) - self.max_buffer)
+            dropped_rollups = max(0, len(self.pending_rollups) - self.max_buffer)
+            if dropped_samples:
+                del self.buffer[:dropped_samples]
+                self.samples_dropped += dropped_samples
+            if dropped_rollups:
+                del self.pending_rollups[:dropped_rollups]
+                self.rollups_dropped += dropped_rollups
+        if dropped_samples or dropped_rollups:
+            log_base.error('Telemetry buffer full, dropped the %s oldest samples and %s rollups.', dropped_samples,
+                           dropped_rollups)
+
+    def flush(self):
+        """
+            Writes the buffered samples and the closed rollups. Returns how many samples were written.
+        """
+        from .models import TelemetrySample
+        with self._flush_lock:
+            with self._lock:
+                batch, self.buffer = self.buffer, []
+                rollups = self.pending_rollups + self.rollups.collect(grace=self.flush_interval)
+                self.pending_rollups = []
+            failed_rollups = []
+            if rollups:
+                try:
+                    # all or nothing, a retried batch must not insert its first chunks twice
+                    with transaction.atomic():
+                        write_rollups(rollups, batch_size=self.batch_size)
+                    self.rollups_written += len(rollups)
+                except Exception as err:
+                    log_base.exception('Could not write %s telemetry rollups, retrying with the next flush. Error is: %s',
+                                       len(rollups), err)
+                    failed_rollups = rollups
+            if not batch:
+                if failed_rollups:
+                    self._requeue([], failed_rollups)
+                return 0
+            try:
+                with transaction.atomic():
+                    TelemetrySample.objects.bulk_create(batch, batch_size=self.batch_size)
+            except Exception as err:
+                log_base.exception('Could not write %s telemetry samples, retrying with the next flush. Error is: %s',
+                                   len(batch), err)
+                self._requeue(batch, failed_rollups)
+                return 0
+            if failed_rollups:
+                self._requeue([], failed_rollups)
+            self.samples_written += len(batch)
+            self.flushes += 1
+            return len(batch)
+
+    def close(self):
+        """
+            Closes every open rollup bucket and writes everything (process exit).
+        """
+        with self._lock:
+            self.rollups.close_all()
+        self.flush()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            close_old_connections()
+            self.flush()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_telemetry_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = TelemetryWriter(batch_size=getattr(settings, 'TELEMETRY_BATCH_SIZE', 500),
+                                      flush_interval=getattr(settings, 'TELEMETRY_FLUSH_INTERVAL', 5.0),
+                                      max_buffer=getattr(settings, 'TELEMETRY_MAX_BUFFER', 50000))
+            try:
+                _writer.subscribe()
+            except Exception as err:
+                log_base.exception('Telemetry writer could not subscribe to the test case events. Error is: %s', err)
+            atexit.register(_writer.close)
+        return _writer
+
+
+def is_telemetry_enabled():
+    return getattr(settings, 'TELEMETRY_ENABLED', True)
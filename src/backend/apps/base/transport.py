@@ -0,0 +1,287 @@
+"""
+Asyncio transport layer for the serial devices in utils.py
+
+1. SerialEngine - one event loop (in a daemon thread) per process that services every COM port
+2. SerialTransport - non-blocking reads/writes and awaitable request/response helpers for one serial handle
+   (with SERIAL_CAPTURE_ENABLED the bytes read and written are recorded, see capture.py)
+
+The drivers in utils.py implement their I/O as coroutines on top of SerialTransport and keep their
+synchronous methods as thin wrappers (SerialEngine.run) so celery tasks and TestCase.run_test keep working.
+"""
+import asyncio
+import os
+import threading
+
+from .capture import CAPTURE_RX, CAPTURE_TX, get_capture_writer, is_capture_enabled
+from .log import log_base
+
+
+class SerialEngine(object):
+    """
+        Single asyncio event loop servicing all the serial ports of this process.
+        Use SerialEngine.get_engine() rather than instantiating it directly.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run_loop, name='serial_engine')
+        self.thread.daemon = True
+        self.thread.start()
+        log_base.info('Serial engine started.')
+
+    @classmethod
+    def get_engine(cls):
+        """
+            Returns the process wide engine, starting it on first use.
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def in_engine_thread(self):
+        return threading.current_thread() is self.thread
+
+    def submit(self, coro):
+        """
+            Schedules a coroutine on the engine loop. Returns a concurrent.futures.Future.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """
+            Runs a coroutine on the engine loop and blocks the calling thread until it is done.
+            This is what the synchronous driver methods use.
+        """
+        if self.in_engine_thread():
+            raise RuntimeError('SerialEngine.run() called from the engine thread. Await the coroutine instead.')
+        return self.submit(coro).result(timeout)
+
+    def call_soon(self, callback, *args):
+        """
+            Thread safe call of a plain callback on the engine loop.
+        """
+        self.loop.call_soon_threadsafe(callback, *args)
+
+
+class SerialTransport(object):
+    """
+        Non-blocking wrapper around an (already configured) pyserial handle.
+        All the methods must be called from the engine loop.
+
+        Incoming bytes are collected into self.rx_buffer by a reader callback (loop.add_reader on posix,
+        a polling task where the handle has no file descriptor, e.g. Windows COM ports).
+        Writes go to the non-blocking file descriptor and wait for the rest with loop.add_writer when the OS
+        buffer is full; handles without one are written with a zero write timeout and polled.
+    """
+
+    POLL_INTERVAL = 0.005
+    READ_CHUNK = 4096
+    WRITE_TIMEOUT = 1.0
+
+    def __init__(self, serial_handle, loop):
+        self.serial_handle = serial_handle
+        self.loop = loop
+        self.rx_buffer = bytearray()
+        self._rx_event = None
+        self._lock = None
+        self._fd = None
+        self._write_fd = None
+        self._poll_task = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.capture = get_capture_writer() if is_capture_enabled(self.port) else None
+
+    @property
+    def port(self):
+        return self.serial_handle.port
+
+    @property
+    def lock(self):
+        """
+            Held by the drivers around every request/reply sequence, so the jobs sharing a port (e.g. the keep alive
+            and the status poll of the rig supervisor) never interleave their commands.
+        """
+        if self._lock is None:
+            # created lazily so the lock belongs to the engine loop
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def attach(self):
+        """
+            Starts watching the serial handle for incoming data. Safe to call again after the port was reopened.
+        """
+        if not self.serial_handle.is_open:
+            return False
+        # pyserial reconfigures the port on every assignment
+        if self.serial_handle.timeout != 0:
+            self.serial_handle.timeout = 0
+        if getattr(self.serial_handle, 'write_timeout', None) != 0:
+            self.serial_handle.write_timeout = 0
+        # the posix pyserial handle opens its port O_NONBLOCK and exposes the descriptor as .fd
+        self._write_fd = getattr(self.serial_handle, 'fd', None)
+        try:
+            fd = self.serial_handle.fileno()
+        except Exception:
+            fd = None
+
+        if fd is not None:
+            if fd == self._fd:
+                return True
+            self.detach()
+            self.loop.add_reader(fd, self._on_readable)
+            self._fd = fd
+        elif self._poll_task is None or self._poll_task.done():
+            self._poll_task = self.loop.create_task(self._poll_reader())
+        return True
+
+    def detach(self):
+        """
+            Stops watching the serial handle. Call before closing the port.
+        """
+        if self._fd is not None:
+            self.loop.remove_reader(self._fd)
+            self._fd = None
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            self._poll_task = None
+
+    def _read_pending(self):
+        try:
+            waiting = self.serial_handle.in_waiting
+            data = self.serial_handle.read(waiting or self.READ_CHUNK)
+        except Exception as err:
+            log_base.exception('Read failed on port %s, detaching. Error is: %s', self.port, err)
+            self.detach()
+            return
+        if data:
+            self.rx_buffer.extend(data)
+            self.bytes_in += len(data)
+            if self.capture is not None:
+                self.capture.record(self.port, CAPTURE_RX, data)
+            if self._rx_event is not None:
+                self._rx_event.set()
+
+    def _on_readable(self):
+        self._read_pending()
+
+    async def _poll_reader(self):
+        while self.serial_handle.is_open:
+            self._read_pending()
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+    async def _wait_for_data(self, deadline):
+        remaining = deadline - self.loop.time()
+        if remaining <= 0:
+            return False
+        if self._rx_event is None:
+            # created lazily so the event belongs to the engine loop
+            self._rx_event = asyncio.Event()
+        self._rx_event.clear()
+        try:
+            await asyncio.wait_for(self._rx_event.wait(), remaining)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def _take(self, size):
+        data = bytes(self.rx_buffer[:size])
+        del self.rx_buffer[:size]
+        return data
+
+    def _write_some(self, data):
+        if self._write_fd is None:
+            return self.serial_handle.write(data) or 0
+        try:
+            return os.write(self._write_fd, data)
+        except (BlockingIOError, InterruptedError):
+            return 0
+
+    async def _wait_writable(self, deadline):
+        remaining = deadline - self.loop.time()
+        if remaining <= 0:
+            raise asyncio.TimeoutError('Write timeout on port {}'.format(self.port))
+        if self._write_fd is None:
+            await asyncio.sleep(min(self.POLL_INTERVAL, remaining))
+            return
+        writable = self.loop.create_future()
+        self.loop.add_writer(self._write_fd, lambda: writable.done() or writable.set_result(None))
+        try:
+            await asyncio.wait_for(writable, remaining)
+        finally:
+            self.loop.remove_writer(self._write_fd)
+
+    async def write(self, data):
+        """
+            Writes all of data to the port without blocking the loop: what the OS buffer does not take at once
+            is written when the port becomes writable again. Raises asyncio.TimeoutError when the port does not
+            take the data within WRITE_TIMEOUT seconds.
+        """
+        self.attach()
+        data = memoryview(bytes(data))
+        deadline = self.loop.time() + self.WRITE_TIMEOUT
+        pending = data
+        while pending:
+            written = self._write_some(pending)
+            pending = pending[written:]
+            if pending:
+                await self._wait_writable(deadline)
+        self.bytes_out += len(data)
+        if self.capture is not None:
+            self.capture.record(self.port, CAPTURE_TX, bytes(data))
+        return len(data)
+
+    async def drain(self, timeout=1.0):
+        """
+            Waits until the OS output buffer is empty (where the platform reports it).
+        """
+        deadline = self.loop.time() + timeout
+        try:
+            while self.serial_handle.out_waiting and self.loop.time() < deadline:
+                await asyncio.sleep(self.POLL_INTERVAL)
+        except (AttributeError, NotImplementedError):
+            pass
+        return True
+
+    async def read(self, size, timeout):
+        """
+            Returns up to size bytes. Completes as soon as size bytes arrived or after timeout seconds,
+            whichever comes first (same semantics as serial.read with a timeout).
+        """
+        self.attach()
+        deadline = self.loop.time() + timeout
+        while len(self.rx_buffer) < size:
+            if not await self._wait_for_data(deadline):
+                break
+        return self._take(size)
+
+    async def read_available(self, timeout):
+        """
+            Returns whatever is in the RX buffer, waiting up to timeout seconds for at least one byte.
+        """
+        self.attach()
+        if not self.rx_buffer:
+            await self._wait_for_data(self.loop.time() + timeout)
+        return self._take(len(self.rx_buffer))
+
+    def reset_input_buffer(self):
+        self.rx_buffer.clear()
+        try:
+            self.serial_handle.reset_input_buffer()
+        except Exception as err:
+            log_base.exception('Could not reset the input buffer on port %s. Error is: %s', self.port, err)
+
+    async def request(self, message, reply_size, timeout):
+        """
+            Discards stale input, writes message and returns the reply (up to reply_size bytes).
+        """
+        self.reset_input_buffer()
+        await self.write(message)
+        return await self.read(reply_size, timeout)
@@ -6,6 +6,15 @@ from django.views.generic.base import RedirectView
 from backend.apps.base.views import *
 
 urlpatterns = [
+    # customer telemetry and live device state: authenticated users only
+    url(r'^api/test_cases/(?P<test_case_id>\d+)/telemetry/$', login_required(telemetry_channels),
+        name='telemetry_channels'),
+    url(r'^api/test_cases/(?P<test_case_id>\d+)/telemetry/(?P<device>\w+)/(?P<column>\w+)/$',
+        login_required(telemetry_series), name='telemetry_series'),
+    url(r'^api/test_cases/(?P<test_case_id>\d+)/report/$', login_required(test_case_report), name='test_case_report'),
+    url(r'^api/test_cases/(?P<test_case_id>\d+)/export/(?P<device>\w+)\.csv$', login_required(export_telemetry),
+        name='export_telemetry'),
+    url(r'^api/live/(?P<device>\w+)/(?P<port>.+)/$', login_required(live_state), name='live_state'),
 #     url(r'^login/$', LoginView.as_view(template_name='base/login.html') , name='login'),
 #     url(r'^logout/$', logout, name='logout'),
 #     url(r'^$', login_required(home), name='home'),
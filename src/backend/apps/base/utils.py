@@ -12,10 +12,20 @@ from django.conf import settings
 from .log import log_inverter as log_inverter
 from .log import log_battery as log_battery
 
+import asyncio
 import serial
 import time
-import struct
 from backend.apps.base.log import log_test_case, log_battery
+from .transport import SerialEngine, SerialTransport
+from .protocol import Mk2FrameParser, mk2_frame_type, decode_mk2_ac_frame, decode_mk2_dc_frame
+from .protocol import decode_status_frame, USB_ISS_STATUS_LENGTH
+from .snapshots import PackSnapshot, InverterSnapshot
+from .live_state import publish_live_state
+from .write_behind import mirror_pack_state, mirror_inverter_state
+from .safety import LimitProfile
+from .snapshots import PACK_CELL_OVERVOLTAGE_LEVEL_1, PACK_CELL_OVERVOLTAGE_LEVEL_2, PACK_CELL_UNDERVOLTAGE_LEVEL_1
+from .snapshots import PACK_CELL_UNDERVOLTAGE_LEVEL_2, PACK_NOT_SAFE_LEVEL_1, PACK_NOT_SAFE_LEVEL_2, PACK_OVERCURRENT
+from .snapshots import PACK_OVERTEMPERATURE_MOSFETS, PACK_OVERTEMPERATURE_CELLS, PACK_IS_ON, INVERTER_IS_ON
 
 
 class VictronMultiplusMK2VCP(object):
@@ -24,23 +34,44 @@ class VictronMultiplusMK2VCP(object):
 
     1. Call 'send setpoint' periodically (5 seconds)
     2. Call 'request_frames_update' periodically (5 seconds)
-    3. Call '
+    3. The RX reader (started on the first frame request) publishes the AC/DC replies into self.snapshot
+    Or call 'refresh' as often as needed: setpoint and both frame requests in one round trip
 
     """
 
     inverter_instances = {}
 
-    def __init__(self, com_port):
+    # the 'A' and 'V' replies of the VE bus handshake take a few frame times at 2400 baud
+    HANDSHAKE_TIMEOUT = 0.25
+    HANDSHAKE_RETRIES = 3
+    AC_FRAME_REQUEST = b'\x03\xffF\x01\xb7'
+    DC_FRAME_REQUEST = b'\x03\xffF\x00\xb8'
+    # the requests (10 bytes, 24 with the setpoint) and the two info frame replies take about 0.25 s at 2400 baud
+    REFRESH_TIMEOUT = 0.5
+
+    def __init__(self, com_port, serial_handle=None):
+        """
+            serial_handle: an open pyserial like handle to use instead of opening com_port (e.g. capture.ReplaySerial)
+        """
         self.set_point = 0
-        self.inverter_variables = {
-            'dc_current': 0,
-            'dc_voltage': 0,
-            'ac_current': 0,
-            'ac_voltage': 0
-        }
+        self.snapshot = InverterSnapshot()
+        self.info_frames = {'AC': None, 'DC': None}
+        # primary key of the Inverter row the live values are mirrored to, set by Inverter.inverter_utilities
+        self.device_id = None
 
         self.com_port = com_port
-
+        self._transport = None
+        self._reader_task = None
+        self.frame_parser = Mk2FrameParser()
+        # frame type (see mk2_frame_type) -> futures waiting for the next frame of that type
+        self._reply_waiters = {}
+        self.ve_bus_ready = False
+        # seconds the last bring-up (prepare_inverter) took
+        self.bring_up_seconds = None
+
+        if serial_handle is not None:
+            self.serial_handle = serial_handle
+            return
         try:
             self.serial_handle = serial.Serial()
             self.serial_handle.port = self.com_port
@@ -53,72 +84,160 @@ class VictronMultiplusMK2VCP(object):
             log_inverter.info('Opened port to inverter on %s', self.com_port)
         except Exception as err:
             log_inverter.exception('Could not open port to inverter on %s. Error is: %s', self.com_port, err)
-        
-        
+
+    @property
+    def engine(self):
+        return SerialEngine.get_engine()
+
+    @property
+    def transport(self):
+        """
+            Asyncio transport for this port. Lives on the engine loop, use it only from coroutines.
+        """
+        if self._transport is None:
+            self._transport = SerialTransport(self.serial_handle, self.engine.loop)
+        return self._transport
+
+    @property
+    def inverter_variables(self):
+        """
+            Dict view of self.snapshot, for presentation only.
+        """
+        return self.snapshot.as_dict()
+
     def close_coms(self):
         """
             Closes the serial resource for the inverter
         """
+        return self.engine.run(self.close_coms_async())
+
+    async def close_coms_async(self):
         try:
+            if self._reader_task is not None:
+                self._reader_task.cancel()
+                self._reader_task = None
+            self.transport.detach()
             self.serial_handle.close()
+            self.ve_bus_ready = False
             log_inverter.info('Closed port to inverter on %s', self.com_port)
             return True
         except Exception as err:
             log_inverter.exception('Could not close inverter port %s because %s', self.com_port, err)
             return False
     
-    def prepare_inverter(self):
+    def prepare_inverter(self, force=False):
         """
             This method will ensure the inverter is in a state ready to be used during the test.
-            1. It will configure the VE bus 
-            2. It will verify that the comport is open and if it is not it will attempt to open it.
+            1. It will verify that the comport is open and if it is not it will attempt to open it.
+            2. It will configure the VE bus, unless it already is (force reconfigures it)
+            Returns False if the inverter did not answer the handshake.
         """
+        return self.engine.run(self.prepare_inverter_async(force))
+
+    async def prepare_inverter_async(self, force=False):
         try:
-            if self.serial_handle.is_open:
-                self.configure_ve_bus()
-                log_inverter.info('Configured VE bus for inverter on port: %s', self.com_port)
-                return True
-            else:
+            started = time.perf_counter()
+            if not self.serial_handle.is_open:
                 self.serial_handle.open()
-                self.configure_ve_bus()
-                log_inverter.info('Configured VE bus for inverter on port: %s', self.com_port)
-                return True
+                self.ve_bus_ready = False
+            if force or not self.ve_bus_ready:
+                self.ve_bus_ready = await self.configure_ve_bus_async()
+                if not self.ve_bus_ready:
+                    return False
+                self.bring_up_seconds = time.perf_counter() - started
+                log_inverter.info('Configured VE bus for inverter on port: %s in %.3f s', self.com_port,
+                                  self.bring_up_seconds)
+            self.start_reader()
+            return True
         except Exception as err:
             log_test_case.exception('Error encountered in preparing the inverter for test on port: %s. Error is: %s.', self.com_port, err)
             return False
-                
-    
+
     def configure_ve_bus(self):
         """
             This method does the start-up procedure on the inverter (resets the Mk2 etc)
         """
+        return self.engine.run(self.configure_ve_bus_async())
+
+    async def configure_ve_bus_async(self):
         A_command = b'\x04\xFF\x41\x01\x00\xBB'
         reset_command = b'\x02\xFF\x52\xAD'
         X53_command = b'\x09\xFF\x53\x03\x00\xFF\x01\x00\x00\x04\x9E'
 
         try:
-            self.serial_handle.write(A_command)
-            time.sleep(0.1)
-            self.serial_handle.write(X53_command)
-            time.sleep(0.1)
-            self.serial_handle.write(reset_command)
-            time.sleep(0.1)
-            self.serial_handle.write(A_command)
-            time.sleep(0.1)
-            log_inverter.info('VE Bus configure for inverter on port %s', self.com_port)
-            return True
+            # no frame request or setpoint in the middle of the handshake
+            async with self.transport.lock:
+                # the replies are picked up by the RX reader, see wait_reply_async
+                self._start_reader()
+                if await self.handshake_async(A_command, 'A') is None:
+                    return False
+                # not every MK2 firmware acknowledges the state command, nothing to wait for
+                await self.transport.write(X53_command)
+                # the MK2 announces itself with a version frame after the reset
+                if await self.handshake_async(reset_command, 'V') is None:
+                    return False
+                if await self.handshake_async(A_command, 'A') is None:
+                    return False
+                log_inverter.info('VE Bus configure for inverter on port %s', self.com_port)
+                return True
         except Exception as err:
             log_inverter.exception('Initializing VE bus protocol failed on port %s because %s', self.com_port, err)
             return False
 
+    async def handshake_async(self, message, frame_type):
+        """
+            Writes message until the inverter answers with a frame_type frame, HANDSHAKE_RETRIES attempts of
+            HANDSHAKE_TIMEOUT seconds. Returns the reply, None if the inverter never answered.
+        """
+        for attempt in range(1, self.HANDSHAKE_RETRIES + 1):
+            # registered before the write, the reply may come back before the write returns
+            waiter = self._expect_reply(frame_type)
+            await self.transport.write(message)
+            reply = await self.wait_reply_async(frame_type, self.HANDSHAKE_TIMEOUT, waiter)
+            if reply is not None:
+                return reply
+            log_inverter.info('No %s reply from inverter on port %s (attempt %s of %s).', frame_type, self.com_port,
+                              attempt, self.HANDSHAKE_RETRIES)
+        log_inverter.info('Inverter on port %s did not answer the %s handshake.', self.com_port, frame_type)
+        return None
+
+    def _expect_reply(self, frame_type):
+        waiter = self.engine.loop.create_future()
+        self._reply_waiters.setdefault(frame_type, []).append(waiter)
+        return waiter
+
+    async def wait_reply_async(self, frame_type, timeout, waiter=None):
+        """
+            Waits for the next frame_type frame published by the RX reader. Returns the frame, None after timeout.
+        """
+        if waiter is None:
+            waiter = self._expect_reply(frame_type)
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = self._reply_waiters.get(frame_type)
+            if waiters and waiter in waiters:
+                waiters.remove(waiter)
+
+    def _resolve_reply(self, frame_type, frame):
+        for waiter in self._reply_waiters.pop(frame_type, ()):
+            if not waiter.done():
+                waiter.set_result(frame)
+
     def send_setpoint(self):
         """
             This method sends the setpoint to the inverter (self.setpoint)
         """
+        return self.engine.run(self.send_setpoint_async())
+
+    async def send_setpoint_async(self):
         try:
-            message_out = self.make_message_MK2(self.set_point)
-            self.serial_handle.write(message_out)
-            return True
+            async with self.transport.lock:
+                message_out = self.make_message_MK2(self.set_point)
+                await self.transport.write(message_out)
+                return True
         except Exception as err:
             log_inverter.exception('Sending power setpoint to the PU failed on port %s because %s', self.com_port, err)
             return False
@@ -147,14 +266,16 @@ class VictronMultiplusMK2VCP(object):
     def request_DC_frame(self):
         """
             Sends request for a DC frame on the VE bus
-            com_port_handle:
         """
+        return self.engine.run(self.request_DC_frame_async())
+
+    async def request_DC_frame_async(self):
         try:
-            #self.thread_RX.start()  #Start monitoring messages from Power Unit
-            message = b'\x03\xffF\x00\xb8'
-            self.serial_handle.write(message)
-            log_inverter.info('DC frame Requested on port %s', self.com_port)
-            return True
+            async with self.transport.lock:
+                self.start_reader()
+                await self.transport.write(self.DC_FRAME_REQUEST)
+                log_inverter.info('DC frame Requested on port %s', self.com_port)
+                return True
         except Exception as err:
             log_inverter.exception('Requesting the DC frame (maybe serial timeout?) failed on %s because %s', self.com_port, err)
             return False
@@ -163,11 +284,15 @@ class VictronMultiplusMK2VCP(object):
         """
             Sends request for AC frame on the VE bus
         """
+        return self.engine.run(self.request_AC_frame_async())
+
+    async def request_AC_frame_async(self):
         try:
-            message = b'\x03\xffF\x01\xb7'
-            self.serial_handle.write(message)
-            log_inverter.info('AC frame Requested on port: %s', self.com_port)
-            return True
+            async with self.transport.lock:
+                self.start_reader()
+                await self.transport.write(self.AC_FRAME_REQUEST)
+                log_inverter.info('AC frame Requested on port: %s', self.com_port)
+                return True
         except Exception as err:
             log_inverter.exception('Requesting the AC frame (maybe serial timeout?) failed on %s because %s', self.com_port, err)
             return False
@@ -207,20 +332,116 @@ class VictronMultiplusMK2VCP(object):
             Method will send a state command to the inverter.
             Use state to choose state.
         """
+        return self.engine.run(self.send_state_async(state))
+
+    async def send_state_async(self, state=0):
         try:
-            self.serial_handle.write(self.make_state_message(state))
-            log_inverter.info('Switched to state %s the inverter on port %s.', state, self.com_port)
-            return True
+            async with self.transport.lock:
+                await self.transport.write(self.make_state_message(state))
+                if state == 1:
+                    self.snapshot.flags |= INVERTER_IS_ON
+                else:
+                    self.snapshot.flags &= ~INVERTER_IS_ON
+                log_inverter.info('Switched to state %s the inverter on port %s.', state, self.com_port)
+                return True
         except Exception as err:
             log_inverter.exception('Cannot send new state to inverter on port: %s. Error is: %s', self.com_port, err)
             return False
 
+    def start_reader(self):
+        """
+            Starts the background RX reader for this port (no-op if it is already running).
+            Can be called from any thread.
+        """
+        if self.engine.in_engine_thread():
+            self._start_reader()
+        else:
+            self.engine.call_soon(self._start_reader)
+
+    def _start_reader(self):
+        if self._reader_task is None or self._reader_task.done():
+            self.frame_parser.reset()
+            self._reader_task = self.engine.loop.create_task(self._reader_loop())
+
+    async def _reader_loop(self):
+        """
+            Reads the RX stream in bulk chunks and runs it through the MK2 frame parser.
+            Exits when the port is closed; the next frame request restarts it.
+        """
+        log_inverter.info('RX reader started on port %s', self.com_port)
+        try:
+            while self.serial_handle.is_open:
+                chunk = await self.transport.read_available(timeout=1.0)
+                if not chunk:
+                    continue
+                for frame in self.frame_parser.feed(chunk):
+                    self.publish_frame(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            log_inverter.exception('RX reader failed on port %s. Error is: %s', self.com_port, err)
+        log_inverter.info('RX reader stopped on port %s', self.com_port)
+
+    def publish_frame(self, frame):
+        """
+            Called by the RX reader for every valid MK2 frame. AC/DC info frames update self.snapshot.
+        """
+        frame_type = mk2_frame_type(frame)
+        self._resolve_reply(frame_type, frame)
+        if frame_type == 'DC':
+            self.update_DC_frame(frame)
+        elif frame_type == 'AC':
+            self.update_AC_frame(frame)
+        else:
+            return frame_type
+        publish_live_state('inverter', self.com_port, self.snapshot)
+        mirror_inverter_state(self.device_id, self.snapshot, self.set_point)
+        self.info_frames[frame_type] = {'type': frame_type,
+                                        'message': frame,
+                                        'timestamp': time.time()}
+        return frame_type
+
+    def update_DC_frame(self, message):
+        """
+            Updates the dc_current and dc_voltage of the snapshot out of a DC info frame.
+        """
+        try:
+            self.snapshot.dc_voltage, self.snapshot.dc_current = decode_mk2_dc_frame(message)
+            self.snapshot.last_dc_update = time.time()
+            return True
+        except Exception as err:
+            log_inverter.exception('Could not update the DC frame on port %s because %s', self.com_port, err)
+            return False
+
+    def update_AC_frame(self, message):
+        """
+            Updates the ac_voltage and ac_current of the snapshot out of an AC info frame.
+        """
+        try:
+            self.snapshot.ac_voltage, self.snapshot.ac_current = decode_mk2_ac_frame(message)
+            self.snapshot.last_ac_update = time.time()
+            return True
+        except Exception as err:
+            log_inverter.exception('Could not update the AC frame on port %s because %s', self.com_port, err)
+            return False
+
+    def get_info_frame_reply(self):
+        """
+            Returns the most recent AC/DC info frame ({'type', 'message', 'timestamp'}) published by the RX reader.
+            None if no frame has been received yet.
+        """
+        frames = [frame for frame in self.info_frames.values() if frame is not None]
+        if not frames:
+            return None
+        return max(frames, key=lambda frame: frame['timestamp'])
+
     def get_next_byte(self):
         """
-            Use this function to read a single byte from the serial port
+            Use this function to read a single byte from the serial port.
+            Note: while the RX reader is running it consumes the stream, use get_info_frame_reply instead.
         """
         try:
-            byte_in = self.serial_handle.read(1)
+            byte_in = self.engine.run(self.transport.read(1, timeout=0.1))
             return byte_in
         except Exception as err:
             log_inverter.exception('Unable to get next byte from inverter on port: %s. Error is: %s', self.com_port, err)
@@ -230,35 +451,67 @@ class VictronMultiplusMK2VCP(object):
         """
             Call this method periodically to update the readings from the Inverter
         """
+        return self.engine.run(self.request_frames_update_async())
+
+    async def request_frames_update_async(self):
+        return await self.refresh_async(send_setpoint=False)
+
+    def refresh(self, send_setpoint=True):
+        """
+            Pipelined update: the AC and DC frame requests (and the setpoint) go out in one write and the call
+            returns once both info frames are in self.snapshot. True if both replies arrived within REFRESH_TIMEOUT.
+        """
+        return self.engine.run(self.refresh_async(send_setpoint))
+
+    async def refresh_async(self, send_setpoint=True):
         try:
-            self.request_AC_frame()
-            self.time.sleep(0.1)
-            self.request_DC_frame()
-            self.time.sleep(0.1)
-            return True
+            # held until the replies are in, the next refresh does not take the frames of this one
+            async with self.transport.lock:
+                self.start_reader()
+                message = self.AC_FRAME_REQUEST + self.DC_FRAME_REQUEST
+                if send_setpoint:
+                    message += self.make_message_MK2(self.set_point)
+                # the replies are told apart by frame type, whatever order they come back in
+                waiters = {frame_type: self._expect_reply(frame_type) for frame_type in ('AC', 'DC')}
+                await self.transport.write(message)
+                replies = await asyncio.gather(*[self.wait_reply_async(frame_type, self.REFRESH_TIMEOUT, waiter)
+                                                 for frame_type, waiter in waiters.items()])
+                missing = [frame_type for frame_type, reply in zip(waiters, replies) if reply is None]
+                if missing:
+                    log_inverter.info('No %s frame from inverter on port %s.', '/'.join(missing), self.com_port)
+                    return False
+                return True
         except Exception as err:
-            log_inverter.exception('Cannot update frames.', err)
+            log_inverter.exception('Cannot update frames on port %s. Error is: %s', self.com_port, err)
             return False
 
-    def charge(self):
+    def charge(self, set_point=None):
         """
             Method can be called and it will automatically configure the inverter to charge with a set amount
+            (set_point, CHARGING_SETPOINT if None)
         """
+        return self.engine.run(self.charge_async(set_point))
+
+    async def charge_async(self, set_point=None):
         try:
-            self.set_point = settings.CHARGING_SETPOINT
-            self.send_state(1)
+            self.set_point = settings.CHARGING_SETPOINT if set_point is None else set_point
+            await self.send_state_async(1)
             return True
         except Exception as err:
             log_inverter.exception('Cannot set charge mode on port %s. Exception is: %s', self.com_port, err)
             return False
 
-    def invert(self):
+    def invert(self, set_point=None):
         """
             Method can be called and it will automatically configure the iverter to invert with a set amount
+            (set_point, INVERTING_SETPOINT if None)
         """
+        return self.engine.run(self.invert_async(set_point))
+
+    async def invert_async(self, set_point=None):
         try:
-            self.set_point = settings.INVERTING_SETPOINT
-            self.send_state(1)
+            self.set_point = settings.INVERTING_SETPOINT if set_point is None else set_point
+            await self.send_state_async(1)
             return True
         except Exception as err:
             log_inverter.exception('Cannot set invert mode on port %s. Exception is: %s', self.com_port, err)
@@ -268,9 +521,12 @@ class VictronMultiplusMK2VCP(object):
         """
             Method will zero out the setpoint. The inverter will be kept on.
         """
+        return self.engine.run(self.rest_async())
+
+    async def rest_async(self):
         try:
             self.set_point = 0
-            self.send_state(1)
+            await self.send_state_async(1)
             return True
         except Exception as err:
             msg = 'Cannot set rest mode. The inverter on port {} is still running? Exception is: {}'.format(
@@ -283,9 +539,12 @@ class VictronMultiplusMK2VCP(object):
         """
             Method will zero out the setpoint and it will switch the inverter power off.
         """
+        return self.engine.run(self.stop_async())
+
+    async def stop_async(self):
         try:
             self.set_point = 0
-            self.send_state(0)
+            await self.send_state_async(0)
             return True
         except Exception as err:
             log_inverter.exception('Cannot stop the inverter on port %s. Exception is: %s',self.com_port, err)
@@ -309,35 +568,39 @@ class UsbIssBattery(object):
     """
     battery_instances = {}
 
-    def __init__(self, com_port):
+    # time the pack gets between the status request and the read of the 62 byte status frame
+    STATUS_REPLY_DELAY = 0.05
+    STATUS_TIMEOUT = 0.2
+    # the ISS answers its own commands (version, mode) straight away
+    HANDSHAKE_TIMEOUT = 0.1
+    HANDSHAKE_RETRIES = 3
+
+    def __init__(self, com_port, serial_handle=None):
+        """
+            serial_handle: an open pyserial like handle to use instead of opening com_port (e.g. capture.ReplaySerial)
+        """
         self.status_message = b''
+        self.status = None
+
+        self.snapshot = PackSnapshot()
+        # callables invoked with every fresh PackSnapshot, on the engine loop (e.g. the SafetyMonitor)
+        self.sample_listeners = []
+        # per pack limits, Battery.battery_utilities replaces them with the profile stored on the model
+        self.limits = LimitProfile()
+        # primary key of the Battery row the live values are mirrored to, set by Battery.battery_utilities
+        self.device_id = None
 
-        self.pack_variables = {'serial_number': 0,
-                          'cv_1': 0, 'cv_2': 0,
-                          'cv_3': 0, 'cv_4': 0,
-                          'cv_5': 0, 'cv_6': 0,
-                          'cv_7': 0, 'cv_8': 0,
-                          'cv_9': 0, 'cv_max': 0,
-                          'cv_min': 0,
-                          'mosfet_temp': 0, 'pack_temp': 0,
-                          'dc_current': 0,
-                          'is_cell_overvoltage_level_1': False,
-                          'is_cell_overvoltage_level_2': False,
-                          'is_cell_undervoltage_level_1': False,
-                          'is_cell_undervoltage_level_2': False,
-                          'is_not_safe_level_1': False,
-                          'is_not_safe_level_2': False,
-                          'is_pack_overcurrent': False,
-                          'is_overtemperature_mosfets': False,
-                          'is_overtemperature_cells': False,
-                          'is_on': False,
-                          'last_status_update': time.time()
-                          }
-        
         self.start_timestamp = time.time()
 
         self.com_port = com_port
-
+        self._transport = None
+        self.iss_ready = False
+        # seconds the last bring-up (configure_USB_ISS and turn_pack_on) took
+        self.bring_up_seconds = None
+
+        if serial_handle is not None:
+            self.serial_handle = serial_handle
+            return
         try:
             self.serial_handle = serial.Serial()
             self.serial_handle.port = self.com_port
@@ -351,185 +614,195 @@ class UsbIssBattery(object):
         except Exception as err:
             log_battery.exception('Cannot open comms to battery on port %s because of the following error: %s', self.com_port, err)
 
+    @property
+    def engine(self):
+        return SerialEngine.get_engine()
+
+    @property
+    def transport(self):
+        """
+            Asyncio transport for this port. Lives on the engine loop, use it only from coroutines.
+        """
+        if self._transport is None:
+            self._transport = SerialTransport(self.serial_handle, self.engine.loop)
+        return self._transport
+
+    @property
+    def pack_variables(self):
+        """
+            Dict view of self.snapshot, for presentation only.
+        """
+        return self.snapshot.as_dict()
 
     def configure_USB_ISS(self):
         """
             This function will take care of configuring the USB-> I2C bridge.
         """
+        return self.engine.run(self.configure_USB_ISS_async())
+
+    async def configure_USB_ISS_async(self):
         try:
-            message = b'\x5A\x01'
-            self.serial_handle.write(message)
-            time.sleep(0.5)
-            self.serial_handle.read(10)
-
-            # Setting the mode
-            I2C_mode_message = b'\x5A\x02\x60\x04'
-            self.serial_handle.write(I2C_mode_message)
-            time.sleep(0.5)
-            self.serial_handle.read(10)
-            log_battery.info('Configure the ISS adapter for com: %s', self.com_port)
-            return True
+            async with self.transport.lock:
+                # module id, firmware version and current mode
+                message = b'\x5A\x01'
+                if await self.handshake_async(message, 3) is None:
+                    self.iss_ready = False
+                    return False
+
+                # Setting the mode, 0xFF 0x00 acknowledges it
+                I2C_mode_message = b'\x5A\x02\x60\x04'
+                reply = await self.handshake_async(I2C_mode_message, 2)
+                self.iss_ready = reply is not None and reply[0] == 0xFF
+                if not self.iss_ready:
+                    log_battery.info('The ISS adapter on com %s did not accept the I2C mode. Reply: %s', self.com_port,
+                                     reply)
+                    return False
+                log_battery.info('Configure the ISS adapter for com: %s', self.com_port)
+                return True
         except Exception as err:
             log_battery.exception('Error when configuring the USB ISS bridge on com %s. Error is: %s', self.com_port, err)
             return False
         
 
-    def turn_pack_on(self, com_port_handle):
+    async def handshake_async(self, message, reply_size):
         """
-            This method turns the pack on. Note: function needs to be send every 10 sec minimum to maintain pack on.
-            input: com_port handler
-            output: True if successful. False otherwise
+            Sends message until reply_size bytes come back, HANDSHAKE_RETRIES attempts of HANDSHAKE_TIMEOUT seconds.
+            Returns the reply, None if the ISS never answered.
         """
-        try:
-            test = b'\x57\x01\x35\x40\x04\x01\x03\x00\x48\x03'
-            self.serial_handle.write(test)
-            time.sleep(0.01)
-            test = b'\x57\x01\x30\x41\x20\x03'
-            self.serial_handle.write(test)
-            time.sleep(0.01)
-            log_battery.info('Pack on port %s has been turned on.', self.com_port)
-            return True
-        except Exception as err:
-            log_battery.exception('Error when turning pack on port: %s. Pack serial number: %s', self.com_port, self.serial_number)
-            return False
+        for attempt in range(1, self.HANDSHAKE_RETRIES + 1):
+            reply = await self.transport.request(message, reply_size, self.HANDSHAKE_TIMEOUT)
+            if len(reply) == reply_size:
+                return reply
+            log_battery.info('No reply from the ISS adapter on com %s (attempt %s of %s).', self.com_port, attempt,
+                             self.HANDSHAKE_RETRIES)
+        return None
 
-    def close_coms(self):
+    def bring_up(self, force=False):
         """
-            Closes resources for battery serial
+            Configures the USB-ISS (unless it already is, force reconfigures it) and turns the pack on.
+            Returns False if the ISS did not answer.
         """
-        try:
-            self.serial_handle.close()
-            log_battery.info('Closed battery port %s.', self.com_port)
-            return True
-        except Exception as err:
-            log_battery.exception('Could not close battery port %s because %s', self.com_port, err)
+        return self.engine.run(self.bring_up_async(force))
 
-    def get_pack_status(self):
-        """
-            Method gets the status message from the battery pack. It populates self.status with the reply
-        """
+    async def bring_up_async(self, force=False):
         try:
-            message = b'\x57\x01\x34\x40\x01\x00\x00\x41\x03'
-            self.serial_handle.write(message)
-            time.sleep(0.1)
-            reply = self.serial_handle.read(10)
-            message = b'\x54\x41\x3E' #this matches the length of the message read
-            self.serial_handle.reset_input_buffer()
-            self.serial_handle.write(message)
-            time.sleep(0.1)
-            self.status_message = self.serial_handle.read(100)
-
-            crc = 0
-            # what is the hell? is that a dict or a list?
-            crc_received = int.from_bytes({self.status_message[-2], self.status_message[-1]}, byteorder='little')
-            for i in range(60):
-                crc = crc + self.status_message[i]
-
-            if crc == crc_received:
-                return True
-            else:
-                log_battery.info('Status message CRC failed for battery on port %s.', self.com_port)
+            started = time.perf_counter()
+            if not self.serial_handle.is_open:
+                self.serial_handle.open()
+                self.iss_ready = False
+            if (force or not self.iss_ready) and not await self.configure_USB_ISS_async():
                 return False
-        except Exception as err:
-            log_battery.exception('Could not refresh pack values on port %s. Reason: %s.', self.com_port, err)
-            return False
-
-    def update_values(self):
-        """
-            Call this function to update all the model attributes that are read from the battery.
-        """
-        try:
-            if not self.get_pack_status():
-                log_battery.info('Asked for new status but failed. Either CRC or exception. Port: %s', self.com_port)
+            if not await self.turn_pack_on_async():
                 return False
-            self.get_serial_number()
-            self.get_pack_current()
-            self.get_cell_voltages()
-            self.get_temperatures()
-            log_battery.info('Pack values updated. Pack serial number:')
-#             log_battery.info('Pack cell voltages: %s, %s, %s, %s, %s, %s, %s, %s, %s', self.cv_1,
-#                      self.cv_2, self.cv_3, self.cv_4, self.cv_5, self.cv_6, self.cv_7, self.cv_8, self.cv_9)
-            self.pack_variables['last_status_update'] = time.time()
+            self.bring_up_seconds = time.perf_counter() - started
+            log_battery.info('Brought up battery on port %s in %.3f s.', self.com_port, self.bring_up_seconds)
             return True
         except Exception as err:
-            log_battery.exception('Error encountered while updating pack values. Exception is: %s', err)
+            log_battery.exception('Could not bring up the battery on port %s. Error is: %s', self.com_port, err)
             return False
 
-    def get_serial_number(self):
+    def turn_pack_on(self, com_port_handle=None):
         """
-            Method extract the serial number out of the status message. Populates self.serial_number
+            This method turns the pack on. Note: function needs to be send every 10 sec minimum to maintain pack on.
+            input: com_port handler (unused, kept for backwards compatibility)
+            output: True if successful. False otherwise
         """
+        return self.engine.run(self.turn_pack_on_async())
+
+    async def turn_pack_on_async(self):
         try:
-            self.pack_variables['serial_number'] = int.from_bytes(self.status_message[56:60], byteorder = 'little')
-            return True
+            # the keep alive must not land inside a status request (get_pack_status_async)
+            async with self.transport.lock:
+                test = b'\x57\x01\x35\x40\x04\x01\x03\x00\x48\x03'
+                await self.transport.write(test)
+                await asyncio.sleep(0.01)
+                test = b'\x57\x01\x30\x41\x20\x03'
+                await self.transport.write(test)
+                await asyncio.sleep(0.01)
+                self.snapshot.set_flag(PACK_IS_ON)
+                log_battery.info('Pack on port %s has been turned on.', self.com_port)
+                return True
         except Exception as err:
+            log_battery.exception('Error when turning pack on port: %s. Pack serial number: %s. Error is: %s',
+                                  self.com_port, self.snapshot.serial_number, err)
             return False
 
-    def get_pack_current(self):
+    def close_coms(self):
         """
-            Extract the pack current out of the battery message reply (get_Status command). Updates self.dc_current
-            input: none
-            output: True if successful. False otherwise
+            Closes resources for battery serial
         """
+        return self.engine.run(self.close_coms_async())
+
+    async def close_coms_async(self):
         try:
-            temp_variable = struct.unpack('<f', self.status_message[50:54])
-            self.pack_variables['dc_current'] = "{0:.3f}".format(temp_variable[0])
+            self.transport.detach()
+            self.serial_handle.close()
+            self.iss_ready = False
+            log_battery.info('Closed battery port %s.', self.com_port)
             return True
         except Exception as err:
-            log_battery.exception('Cannot refresh pack current value for batt on port %s. Reason is: %s.', self.com_port, err)
+            log_battery.exception('Could not close battery port %s because %s', self.com_port, err)
             return False
 
-    def get_cell_voltages(self):
+    def get_pack_status(self):
         """
-            Function gets cell voltages out of self.status and populates cv1 -> cv9 as well as cv_max and cv_min
+            Method gets the status message from the battery pack. It populates self.status with the decoded reply
         """
+        return self.engine.run(self.get_pack_status_async())
+
+    async def get_pack_status_async(self):
         try:
-            data = self.status_message
-            C1 = (struct.unpack('>f',struct.pack("B",data[17])+struct.pack("B", data[16]) + struct.pack("B", data[15])+struct.pack("B",data[14])))
-            C2 = (struct.unpack('>f',struct.pack("B",data[21])+struct.pack("B", data[20]) + struct.pack("B", data[19])+struct.pack("B",data[18])))
-            C3 = (struct.unpack('>f',struct.pack("B",data[25])+struct.pack("B", data[24]) + struct.pack("B", data[23])+struct.pack("B",data[22])))
-            C4 = (struct.unpack('>f',struct.pack("B",data[29])+struct.pack("B", data[28]) + struct.pack("B", data[27])+struct.pack("B",data[26])))
-            C5 = (struct.unpack('>f',struct.pack("B",data[33])+struct.pack("B", data[32]) + struct.pack("B", data[31])+struct.pack("B",data[30])))
-            C6 = (struct.unpack('>f',struct.pack("B",data[37])+struct.pack("B", data[36]) + struct.pack("B", data[35])+struct.pack("B",data[34])))
-            C7 = (struct.unpack('>f',struct.pack("B",data[41])+struct.pack("B", data[40]) + struct.pack("B", data[39])+struct.pack("B",data[38])))
-            C8 = (struct.unpack('>f',struct.pack("B",data[45])+struct.pack("B", data[44]) + struct.pack("B", data[43])+struct.pack("B",data[42])))
-            C9 = (struct.unpack('>f',struct.pack("B",data[49])+struct.pack("B", data[48]) + struct.pack("B", data[47])+struct.pack("B",data[46])))
-
-            self.pack_variables['cv_1'] = "{0:.3f}".format(C1[0])
-            self.pack_variables['cv_2'] = "{0:.3f}".format(C2[0])
-            self.pack_variables['cv_3'] = "{0:.3f}".format(C3[0])
-            self.pack_variables['cv_4'] = "{0:.3f}".format(C4[0])
-            self.pack_variables['cv_5'] = "{0:.3f}".format(C5[0])
-            self.pack_variables['cv_6'] = "{0:.3f}".format(C6[0])
-            self.pack_variables['cv_7'] = "{0:.3f}".format(C7[0])
-            self.pack_variables['cv_8'] = "{0:.3f}".format(C8[0])
-            self.pack_variables['cv_9'] = "{0:.3f}".format(C9[0])
-
-            self.pack_variables['cv_min'] = min([self.pack_variables['cv_1'], self.pack_variables['cv_2'], self.pack_variables['cv_3'],
-                               self.pack_variables['cv_4'], self.pack_variables['cv_5'], self.pack_variables['cv_6'],
-                               self.pack_variables['cv_7'], self.pack_variables['cv_8'], self.pack_variables['cv_9'] ])
-
-            self.pack_variables['cv_max'] = max([self.pack_variables['cv_1'], self.pack_variables['cv_2'], self.pack_variables['cv_3'],
-                               self.pack_variables['cv_4'], self.pack_variables['cv_5'], self.pack_variables['cv_6'],
-                               self.pack_variables['cv_7'], self.pack_variables['cv_8'], self.pack_variables['cv_9'] ])
-            return True
+            async with self.transport.lock:
+                message = b'\x57\x01\x34\x40\x01\x00\x00\x41\x03'
+                self.transport.reset_input_buffer()
+                await self.transport.write(message)
+                # the ISS answers the I2C_DIRECT sequence with 0xFF (ACK) or 0x00 (NACK) and the count of bytes read
+                reply = await self.transport.read(2, timeout=self.STATUS_TIMEOUT)
+                if reply[:1] != b'\xff':
+                    log_battery.info('Pack on port %s did not acknowledge the status request. Reply: %s',
+                                     self.com_port, reply)
+                    return False
+                await asyncio.sleep(self.STATUS_REPLY_DELAY)
+                message = b'\x54\x41\x3E' #this matches the length of the message read
+                await self.transport.write(message)
+                self.status_message = await self.transport.read(USB_ISS_STATUS_LENGTH, timeout=self.STATUS_TIMEOUT)
+
+                status = decode_status_frame(self.status_message)
+                if status is not None:
+                    self.status = status
+                    return True
+                else:
+                    log_battery.info('Status message CRC failed for battery on port %s.', self.com_port)
+                    return False
         except Exception as err:
-            log_battery.exception('Could not refresh cell voltages on port %s. Reason: %s.', self.com_port, err)
+            log_battery.exception('Could not refresh pack values on port %s. Reason: %s.', self.com_port, err)
             return False
 
-    def get_temperatures(self):
+    def update_values(self):
         """
-            method extracts the temperature readouts from self.status and populates mosfet and pack temperature readings
+            Call this function to update all the model attributes that are read from the battery.
         """
-        try:
-            mosfet_temp= struct.unpack('<f', self.status_message[6:10])
-            pack_temp = struct.unpack('<f', self.status_message[10:14])
+        return self.engine.run(self.update_values_async())
 
-            self.pack_variables['mosfet_temp'] = "{0:.3f}".format(mosfet_temp[0])
-            self.pack_variables['pack_temp'] = "{0:.3f}".format(pack_temp[0])
+    async def update_values_async(self):
+        try:
+            if not await self.get_pack_status_async():
+                log_battery.info('Asked for new status but failed. Either CRC or exception. Port: %s', self.com_port)
+                return False
+            # the state flags are latched, carry them over to the new reading
+            status = self.status
+            status.flags = self.snapshot.flags
+            self.snapshot = status
+            publish_live_state('battery', self.com_port, status)
+            mirror_pack_state(self.device_id, status)
+            for listener in list(self.sample_listeners):
+                try:
+                    listener(status)
+                except Exception as err:
+                    log_battery.exception('Sample listener failed on port %s. Error is: %s', self.com_port, err)
             return True
         except Exception as err:
-            log_battery.exception('Could not refresh temperature values for pack on port %s. Exception is: %s.', self.com_port, err)
+            log_battery.exception('Error encountered while updating pack values. Exception is: %s', err)
             return False
 
     def check_safety_level_1(self):
@@ -537,18 +810,17 @@ class UsbIssBattery(object):
             Method returns True if everything OK. False if the level 1 limits have been exceeded.
         """
         try:
-            c_ovp = self.pack_variables['cv_max'] > settings.BATTERY_CELL_OVP_LEVEL_1
-            c_uvp = self.pack_variables['cv_min'] < settings.BATTERY_CELL_UVP_LEVEL_1
+            snapshot = self.snapshot
+            c_ovp = snapshot.cv_max > self.limits.cell_ovp_level_1
+            c_uvp = snapshot.cv_min < self.limits.cell_uvp_level_1
 
             if c_uvp:
                 log_battery.info('Cell undervoltage, level 1 on port: %s', self.com_port)
-                self.pack_variables['is_cell_undervoltage_level_1'] = True
-                self.pack_variables['is_not_safe_level_1'] = True
+                snapshot.set_flag(PACK_CELL_UNDERVOLTAGE_LEVEL_1 | PACK_NOT_SAFE_LEVEL_1)
                 return  False
             elif c_ovp:
                 log_battery.info('Cell overvoltage, level 1 on port: %s', self.com_port)
-                self.pack_variables['is_cell_overvoltage_level_1'] = True
-                self.pack_variables['is_not_safe_level_1'] = True
+                snapshot.set_flag(PACK_CELL_OVERVOLTAGE_LEVEL_1 | PACK_NOT_SAFE_LEVEL_1)
                 return False
             else:
                 return True
@@ -560,41 +832,32 @@ class UsbIssBattery(object):
         """
             Method return True if everything OK. False if a test stop trigger should be issued.
         """
-        
-        if time.time()-self.start_timestamp >= 20:
-            return False
-        return True
-
         try:
-            c_ovp = self.pack_variables['cv_max'] > settings.BATTERY_CELL_OVP_LEVEL_2
-            c_uvp = self.pack_variables['cv_min'] < settings.BATTERY_CELL_UVP_LEVEL_2
-            ocp = self.pack_variables['dc_current'] > settings.BATTERY_OCP
-            ovt_mosfet = self.pack_variables['mosfet_temp'] > settings.MOSFETS_OVERTEMPERATURE
-            ovt_cells = self.pack_variables['pack_temp'] > settings.CELLS_OVERTEMPERATURE
+            snapshot = self.snapshot
+            c_ovp = snapshot.cv_max > self.limits.cell_ovp_level_2
+            c_uvp = snapshot.cv_min < self.limits.cell_uvp_level_2
+            ocp = snapshot.dc_current > self.limits.overcurrent
+            ovt_mosfet = snapshot.mosfet_temp > self.limits.mosfets_overtemperature
+            ovt_cells = snapshot.pack_temp > self.limits.cells_overtemperature
             if c_ovp:
                 log_battery.info('Cell over-voltage, level 2. Port: %s', self.com_port)
-                self.pack_variables['is_cell_overvoltage_level_2'] = True
-                self.pack_variables['is_not_safe_level_2'] = True
+                snapshot.set_flag(PACK_CELL_OVERVOLTAGE_LEVEL_2 | PACK_NOT_SAFE_LEVEL_2)
                 return False
             elif c_uvp:
                 log_battery.info('Cell under-voltage, level 2. Port: %s', self.com_port)
-                self.pack_variables['is_cell_undervoltage_level_2'] = True
-                self.pack_variables['is_not_safe_level_2'] = True
+                snapshot.set_flag(PACK_CELL_UNDERVOLTAGE_LEVEL_2 | PACK_NOT_SAFE_LEVEL_2)
                 return False
             elif ocp:
                 log_battery.info('Battery over-current. Port: %s', self.com_port)
-                self.pack_variables['is_pack_overcurrent'] = True
-                self.pack_variables['is_not_safe_level_2'] = True
+                snapshot.set_flag(PACK_OVERCURRENT | PACK_NOT_SAFE_LEVEL_2)
                 return False
             elif ovt_mosfet:
                 log_battery.info('Over-temperature (mosfets) on port: %s', self.com_port)
-                self.pack_variables['is_overtemperature_mosfets'] = True
-                self.pack_variables['is_not_safe_level_2'] = True
+                snapshot.set_flag(PACK_OVERTEMPERATURE_MOSFETS | PACK_NOT_SAFE_LEVEL_2)
                 return False
             elif ovt_cells:
                 log_battery.info('Over-temperature (mosfets) on port: %s', self.com_port)
-                self.pack_variables['is_overtemperature_cells'] = True
-                self.pack_variables['is_not_safe_level_2'] = True
+                snapshot.set_flag(PACK_OVERTEMPERATURE_CELLS | PACK_NOT_SAFE_LEVEL_2)
                 return False
             else:
                 return True
@@ -614,7 +877,7 @@ class UsbIssBattery(object):
             Method clears the level_1_error_flag
         """
         try:
-            self.pack_variables['is_not_safe_level_1'] = False
+            self.snapshot.clear_flag(PACK_NOT_SAFE_LEVEL_1)
             return True
         except Exception as err:
             log_battery.exception('Unable to clear error fral level 1 in batt on port %s. Reason is %s', self.com_port, err)
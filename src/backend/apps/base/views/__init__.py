@@ -0,0 +1 @@
+from .telemetry import telemetry_channels, telemetry_series, test_case_report, export_telemetry, live_state
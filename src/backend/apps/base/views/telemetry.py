@@ -0,0 +1,135 @@
+from django.http import JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.views.decorators.http import require_GET
+
+from ..analytics import analyse_test_case
+from ..archive import open_archive
+from ..downsampling import get_pyramid
+from ..export import iter_csv
+from ..live_state import LiveStateRing, RECORD_FIELDS
+from ..models import TestCase
+from ..telemetry import DEVICE_COLUMNS
+
+DOWNSAMPLING_METHODS = ('lttb', 'minmax')
+DEFAULT_POINTS = 1000
+# lttb keeps the first and last samples plus one per bucket
+MIN_POINTS = 3
+MAX_POINTS = 10000
+DEFAULT_LIVE_SAMPLES = 1
+
+
+def _values(array):
+    # NaN is not valid JSON
+    return [None if value != value else value for value in array.tolist()]
+
+
+def _float_param(request, name):
+    value = request.GET.get(name)
+    return None if value in (None, '') else float(value)
+
+
+@require_GET
+def telemetry_channels(request, test_case_id):
+    """
+        Devices and columns available for a test case.
+    """
+    test_case = get_object_or_404(TestCase, id=test_case_id)
+    return JsonResponse({'test_case': test_case.id,
+                         'archived': open_archive(test_case) is not None,
+                         'channels': {device: [column for column in columns if column != 'timestamp']
+                                      for device, columns in DEVICE_COLUMNS.items()}})
+
+
+@require_GET
+def telemetry_series(request, test_case_id, device, column):
+    """
+        Downsampled channel. GET parameters: method (lttb or minmax), points, start and end (epoch seconds).
+    """
+    test_case = get_object_or_404(TestCase, id=test_case_id)
+    if device not in DEVICE_COLUMNS or column not in DEVICE_COLUMNS[device] or column == 'timestamp':
+        return JsonResponse({'error': 'Unknown channel {}/{}'.format(device, column)}, status=404)
+    method = request.GET.get('method', 'lttb')
+    if method not in DOWNSAMPLING_METHODS:
+        return JsonResponse({'error': 'method must be one of {}'.format(', '.join(DOWNSAMPLING_METHODS))}, status=400)
+    try:
+        points = int(request.GET.get('points', DEFAULT_POINTS))
+        start = _float_param(request, 'start')
+        end = _float_param(request, 'end')
+    except ValueError as err:
+        return JsonResponse({'error': str(err)}, status=400)
+    if points < MIN_POINTS:
+        return JsonResponse({'error': 'points must be at least {}'.format(MIN_POINTS)}, status=400)
+    points = min(points, MAX_POINTS)
+    if start is not None and end is not None and start > end:
+        return JsonResponse({'error': 'start is after end'}, status=400)
+
+    pyramid = get_pyramid(test_case, device, column)
+    response = {'test_case': test_case.id, 'device': device, 'column': column, 'method': method}
+    if method == 'lttb':
+        x, y = pyramid.lttb(points, start, end)
+        response.update(x=_values(x), y=_values(y))
+    else:
+        x_start, x_end, y_min, y_max = pyramid.minmax(points, start, end)
+        response.update(x_start=_values(x_start), x_end=_values(x_end), min=_values(y_min), max=_values(y_max))
+    return JsonResponse(response)
+
+
+@require_GET
+def test_case_report(request, test_case_id):
+    """
+        Post-test report of a finished test case. 202 until the archive_telemetry task has archived it.
+    """
+    test_case = get_object_or_404(TestCase, id=test_case_id)
+    if test_case.state != 'FINISHED':
+        return JsonResponse({'error': 'Test case {} is not finished'.format(test_case.id)}, status=400)
+    report = analyse_test_case(test_case)
+    if report is None:
+        return JsonResponse({'test_case': test_case.id, 'status': 'archiving'}, status=202)
+    return JsonResponse({'test_case': test_case.id, 'report': report})
+
+
+@require_GET
+def export_telemetry(request, test_case_id, device):
+    """
+        Streams the samples of a device as CSV. GET parameters: columns (comma separated, all by default),
+        start and end (epoch seconds).
+    """
+    test_case = get_object_or_404(TestCase, id=test_case_id)
+    if device not in DEVICE_COLUMNS:
+        return JsonResponse({'error': 'Unknown device {}'.format(device)}, status=404)
+    columns = [column for column in request.GET.get('columns', '').split(',') if column] or DEVICE_COLUMNS[device]
+    unknown = [column for column in columns if column not in DEVICE_COLUMNS[device]]
+    if unknown:
+        return JsonResponse({'error': 'Unknown columns {}'.format(', '.join(unknown))}, status=400)
+    try:
+        start = _float_param(request, 'start')
+        end = _float_param(request, 'end')
+    except ValueError as err:
+        return JsonResponse({'error': str(err)}, status=400)
+
+    response = StreamingHttpResponse(iter_csv(test_case, device, columns, start, end), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="test_case_{}_{}.csv"'.format(test_case.id, device)
+    return response
+
+
+@require_GET
+def live_state(request, device, port):
+    """
+        Last samples of a device from the shared memory ring of the process owning its port, no database query.
+        GET parameters: samples (1 by default, at most the ring capacity).
+    """
+    if device not in RECORD_FIELDS:
+        return JsonResponse({'error': 'Unknown device {}'.format(device)}, status=404)
+    try:
+        samples = max(1, int(request.GET.get('samples', DEFAULT_LIVE_SAMPLES)))
+    except ValueError as err:
+        return JsonResponse({'error': str(err)}, status=400)
+    ring = LiveStateRing.open(device, port)
+    if ring is None:
+        return JsonResponse({'error': 'No live state for {} {}'.format(device, port)}, status=404)
+    records = ring.read(samples)
+    ring.close()
+    return JsonResponse({'device': device,
+                         'port': port,
+                         'samples': len(records),
+                         'values': {name: _values(records[name]) for name in records.dtype.names}})
@@ -0,0 +1,183 @@
+"""
+Write-behind mirror of the live device values into the Battery and Inverter rows.
+
+The owner of a port stages the fields of every fresh reading (mirror_pack / mirror_inverter, no database access,
+safe on the SerialEngine loop). Staged values are coalesced per device row (the primary key the driver got from
+Battery.battery_utilities / Inverter.inverter_utilities, ports are not unique): a new reading overwrites the pending
+one, and only the fields whose formatted value differs from what was last written are dirty. A background thread
+flushes the dirty fields every LIVE_FIELDS_FLUSH_INTERVAL seconds with one UPDATE per model (CASE WHEN id = ... per
+field, the Django 1.11 equivalent of bulk_update), so a 5 Hz pack costs one row update per flush at most and nothing
+while its values do not change. A batch counts as written from the moment the flush takes it, so a value staged
+meanwhile is compared with what is being written; a failed batch is put back.
+"""
+import atexit
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Case, F, Value, When
+
+from .log import log_base
+
+BATTERY_MODEL = 'Battery'
+INVERTER_MODEL = 'Inverter'
+_MISSING = object()
+
+
+def _format(value, decimals=3):
+    # the live columns are CharFields
+    return None if value is None else '{:.{}f}'.format(value, decimals)
+
+
+class WriteBehindCache(object):
+    """
+        Pending live fields per (model name, device id). Use get_write_behind_cache().
+    """
+
+    def __init__(self, flush_interval=2.0):
+        self.flush_interval = flush_interval
+        # (model name, device id) -> {field: value} not written yet
+        self.pending = {}
+        # (model name, device id) -> {field: value} as last written, or being written
+        self.written = {}
+        self.updates = 0
+        self.statements = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flusher = None
+
+    def _start(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._run, name='write_behind')
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def stage(self, model_name, device_id, values):
+        key = (model_name, device_id)
+        with self._lock:
+            written = self.written.get(key, {})
+            pending = self.pending.setdefault(key, {})
+            for field, value in values.items():
+                if written.get(field, _MISSING) != value:
+                    pending[field] = value
+                else:
+                    # back to the written value, nothing to do for this field any more
+                    pending.pop(field, None)
+            if not pending:
+                del self.pending[key]
+            self._start()
+
+    def mirror_pack(self, device_id, snapshot):
+        values = {'dc_voltage': _format(sum(snapshot.cell_voltages)),
+                  'dc_current': _format(snapshot.dc_current),
+                  'cv_min': _format(snapshot.cv_min),
+                  'cv_max': _format(snapshot.cv_max),
+                  'mosfet_temp': _format(snapshot.mosfet_temp, 1),
+                  'pack_temp': _format(snapshot.pack_temp, 1),
+                  'is_on': snapshot.is_on}
+        for i, cv in enumerate(snapshot.cell_voltages, 1):
+            values['cv_{}'.format(i)] = _format(cv)
+        self.stage(BATTERY_MODEL, device_id, values)
+
+    def mirror_inverter(self, device_id, snapshot, set_point):
+        self.stage(INVERTER_MODEL, device_id, {'dc_voltage': _format(snapshot.dc_voltage, 2),
+                                          'dc_current': _format(snapshot.dc_current, 2),
+                                          'ac_voltage': _format(snapshot.ac_voltage, 2),
+                                          'ac_current': _format(snapshot.ac_current, 2),
+                                          'setpoint': str(set_point),
+                                          'is_on': snapshot.is_on})
+
+    def _update(self, model, rows):
+        """
+            One UPDATE for all the dirty rows of a model. rows: {device id: {field: value}}.
+        """
+        updates = {}
+        for field in sorted(set(field for values in rows.values() for field in values)):
+            whens = [When(id=device_id, then=Value(values[field])) for device_id, values in rows.items()
+                     if field in values]
+            updates[field] = Case(*whens, default=F(field), output_field=model._meta.get_field(field))
+        model.objects.filter(id__in=list(rows)).update(**updates)
+
+    def flush(self):
+        """
+            Writes the dirty fields. Returns how many device rows were updated.
+        """
+        from . import models
+        with self._flush_lock:
+            with self._lock:
+                pending, self.pending = self.pending, {}
+                # written from now on: stage() compares what comes in meanwhile with these values
+                previous = {}
+                for key, values in pending.items():
+                    written = self.written.setdefault(key, {})
+                    previous[key] = {field: written.get(field, _MISSING) for field in values}
+                    written.update(values)
+            if not pending:
+                return 0
+            by_model = {}
+            for (model_name, device_id), values in pending.items():
+                by_model.setdefault(model_name, {})[device_id] = values
+            updated = 0
+            for model_name, rows in by_model.items():
+                try:
+                    self._update(getattr(models, model_name), rows)
+                except Exception as err:
+                    log_base.exception('Could not write the live fields of %s %s. Error is: %s', model_name,
+                                       ', '.join(str(device_id) for device_id in rows), err)
+                    self._restore(model_name, rows, previous)
+                    continue
+                updated += len(rows)
+                self.statements += 1
+            self.updates += updated
+            return updated
+
+    def _restore(self, model_name, rows, previous):
+        # the database still has the previous values; newer staged values win over the ones that failed
+        with self._lock:
+            for device_id, values in rows.items():
+                key = (model_name, device_id)
+                written = self.written[key]
+                for field, value in previous[key].items():
+                    if value is _MISSING:
+                        written.pop(field, None)
+                    else:
+                        written[field] = value
+                pending = self.pending.setdefault(key, {})
+                for field, value in values.items():
+                    pending.setdefault(field, value)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            close_old_connections()
+            self.flush()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_write_behind_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = WriteBehindCache(flush_interval=getattr(settings, 'LIVE_FIELDS_FLUSH_INTERVAL', 2.0))
+            atexit.register(_cache.flush)
+        return _cache
+
+
+def is_write_behind_enabled():
+    return getattr(settings, 'LIVE_FIELDS_ENABLED', False)
+
+
+def mirror_pack_state(device_id, snapshot):
+    # a driver not handed out by a Battery row has nowhere to mirror to
+    if device_id is not None and is_write_behind_enabled():
+        get_write_behind_cache().mirror_pack(device_id, snapshot)
+
+
+def mirror_inverter_state(device_id, snapshot, set_point):
+    if device_id is not None and is_write_behind_enabled():
+        get_write_behind_cache().mirror_inverter(device_id, snapshot, set_point)
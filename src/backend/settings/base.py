@@ -293,6 +293,61 @@ MOSFETS_OVERTEMPERATURE = 80
 CELLS_OVERTEMPERATURE = 50
 
 LOOKUP_TABLE = os.path.join(BASE_DIR, 'settings/test_recipe.csv')
+# per test recipes (TestCase.config holds the file name)
+RECIPES_DIR = os.path.join(BASE_DIR, 'settings/recipes')
+
+# Port owner daemon (manage.py run_port_daemon). Unix socket path, or ['127.0.0.1', <port>] where there are
+# no Unix sockets. Leave as None to have every worker open the serial ports itself.
+PORT_DAEMON_ADDRESS = None
+
+# Rig supervisor: one timer wheel per host drives setpoint, keep alive, telemetry and safety for every running test
+# instead of three beat PeriodicTasks per test. Intervals are in seconds.
+RIG_SUPERVISOR_ENABLED = False
+RIG_SUPERVISOR_INTERVALS = {
+    'setpoint': 5,
+    'keep_alive': 5,
+    'pack_poll': 0.2,
+    'inverter_poll': 2,
+    'state_check': 5,
+}
+
+# Test case state transitions ('memory', 'sqlite' or 'broker'). sqlite is shared by all the processes of the host.
+EVENT_BUS_BACKEND = 'sqlite'
+EVENT_BUS_SQLITE_PATH = os.path.join(BASE_DIR, 'logs', 'events.sqlite3')
+
+# Telemetry history (TelemetrySample rows), written in batches of TELEMETRY_BATCH_SIZE samples or every
+# TELEMETRY_FLUSH_INTERVAL seconds
+TELEMETRY_ENABLED = True
+TELEMETRY_BATCH_SIZE = 500
+TELEMETRY_FLUSH_INTERVAL = 5
+# samples kept in memory while the database is unreachable, the oldest are dropped past it
+TELEMETRY_MAX_BUFFER = 50000
+# raw samples older than this are deleted by prune_telemetry, the minute/step rollups are kept
+TELEMETRY_RAW_RETENTION_DAYS = 30
+# pack samples further apart than this (seconds) are not integrated into the step Ah/Wh counters
+INTEGRATOR_MAX_GAP = 10
+# columnar archives of the finished test cases
+ARCHIVE_DIR = os.path.join(BASE_DIR, 'archive')
+# latest readings of every device in a shared memory ring (LIVE_STATE_CAPACITY samples), readable by all the
+# processes of the host. Needs Python 3.8+ (multiprocessing.shared_memory), stays off on older interpreters
+LIVE_STATE_ENABLED = False
+LIVE_STATE_CAPACITY = 1024
+# live values mirrored into the Battery/Inverter rows: changed fields only, written every LIVE_FIELDS_FLUSH_INTERVAL
+# seconds
+LIVE_FIELDS_ENABLED = True
+LIVE_FIELDS_FLUSH_INTERVAL = 2
+
+# raw serial capture (capture.py): every byte read from and written to the ports, one file per port. Replay a file
+# with the replay_capture command. SERIAL_CAPTURE_PORTS limits the capture to some ports (all of them when empty)
+SERIAL_CAPTURE_ENABLED = False
+SERIAL_CAPTURE_DIR = os.path.join(BASE_DIR, 'logs', 'capture')
+SERIAL_CAPTURE_PORTS = []
+SERIAL_CAPTURE_FLUSH_INTERVAL = 1
+SERIAL_CAPTURE_MAX_BYTES = 64 * 1024 * 1024
+
+# the port daemon brings every battery and inverter of the database up in parallel when it starts (bringup.py)
+BRING_UP_AT_START = True
+
 QUEUES = {}
 for i in range(10):
     QUEUES['main_com_{}'.format(i)] = {}
@@ -19,5 +19,5 @@ from django.contrib import admin
 urlpatterns = [
     url(r'^admin/', include(admin.site.urls)),
     url(r'^silk/', include('silk.urls', namespace='silk')),
-#     url(r'', include('backend.apps.base.urls', namespace='base')),
+    url(r'', include('backend.apps.base.urls', namespace='base')),
 ]
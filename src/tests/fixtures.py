@@ -1,3 +1,17 @@
 # TODO: Create local user for testing
 TEST_USER = ''
 TEST_PASS = ''
+
+
+def create_test_case(battery_port='COM3', inverter_port='COM4', **fields):
+    """
+        Battery, inverter and test case rows, without dispatching the main_task of the new test case.
+    """
+    from unittest import mock
+    from backend.apps.base.models import Battery, Inverter, InverterPool, TestCase
+    battery = Battery.objects.create(name='pack', port=battery_port)
+    inverter = Inverter.objects.create(name='inverter', port=inverter_port,
+                                       inverter_pool=InverterPool.objects.create(name='pool'))
+    fields.setdefault('state', 'RUNNING')
+    with mock.patch('backend.apps.base.models.test_case.main_task'):
+        return TestCase.objects.create(name='test', battery=battery, inverter=inverter, **fields)
@@ -0,0 +1,80 @@
+"""
+Post-test analytics over the columnar archive of a test case.
+"""
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from django.test import TestCase, override_settings
+
+from backend.apps.base.analytics import _integrate, analyse_test_case, analyse_test_cases
+from backend.apps.base.archive import archive_test_case
+from backend.apps.base.models import TelemetrySample
+
+from .fixtures import create_test_case
+
+
+class IntegrateTest(unittest.TestCase):
+    def test_gap_is_not_integrated(self):
+        timestamps = np.array([0.0, 10.0, 100.0, 110.0])
+        self.assertAlmostEqual(_integrate(timestamps, np.full(4, 36.0), 10.0), 720.0)
+
+    def test_nan_interval_is_skipped(self):
+        timestamps = np.array([0.0, 1.0, 2.0])
+        self.assertAlmostEqual(_integrate(timestamps, np.array([1.0, np.nan, 1.0]), 10.0), 0.0)
+        self.assertEqual(_integrate(timestamps[:1], np.ones(1), 10.0), 0.0)
+
+
+@override_settings(INTEGRATOR_MAX_GAP=10.0)
+class ReportTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        settings_override = override_settings(ARCHIVE_DIR=self.directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.test_case = create_test_case(state='FINISHED')
+        # 36 A discharge up to 100 s, then 36 A charge; cell 3 sits 50 mV below the others
+        samples = []
+        for second in range(201):
+            current, cell = (36.0, 3.5) if second <= 100 else (-36.0, 3.6)
+            cells = {'cv_{}'.format(index): cell for index in range(1, 10)}
+            cells['cv_3'] = cell - 0.05
+            samples.append(TelemetrySample(test_case=self.test_case, device='battery', port='COM3',
+                                           timestamp=float(second), dc_current=current,
+                                           dc_voltage=sum(cells.values()), mosfet_temp=30.0 + second / 100,
+                                           pack_temp=25.0 + second / 40, flags=0, **cells))
+        TelemetrySample.objects.bulk_create(samples)
+
+    def test_not_archived(self):
+        self.assertIsNone(analyse_test_case(self.test_case))
+        self.assertEqual(analyse_test_cases([self.test_case]), {self.test_case.id: {'error': 'not archived yet'}})
+
+    def test_report(self):
+        archive_test_case(self.test_case)
+        report = analyse_test_case(self.test_case)
+        self.assertEqual(report['samples'], 201)
+        self.assertEqual(report['duration_s'], 200.0)
+        # the current crosses zero between 100 s and 101 s: half a second each way
+        self.assertAlmostEqual(report['discharge_ah'], 100.5 * 36.0 / 3600)
+        self.assertAlmostEqual(report['charge_ah'], 99.5 * 36.0 / 3600)
+        self.assertAlmostEqual(report['coulombic_efficiency'], 100.5 / 99.5)
+        # one current step of 72 A, the pack voltage jumps 0.9 V
+        self.assertEqual(report['dcir_steps'], 1)
+        self.assertAlmostEqual(report['dcir_ohm'], 0.9 / 72)
+        self.assertAlmostEqual(report['imbalance_mean_v'], 0.05)
+        self.assertEqual(report['weakest_cell'], 3)
+        self.assertAlmostEqual(report['pack_temperature_rise'], 5.0)
+        self.assertAlmostEqual(report['mosfet_temperature_rise'], 2.0)
+
+    def test_reports_in_parallel(self):
+        archive_test_case(self.test_case)
+        other = create_test_case(battery_port='COM5', inverter_port='COM6', state='FINISHED')
+        reports = analyse_test_cases([self.test_case, other], processes=2)
+        self.assertEqual(reports[self.test_case.id], analyse_test_case(self.test_case))
+        self.assertEqual(reports[other.id], {'error': 'not archived yet'})
+
+
+if __name__ == '__main__':
+    unittest.main()
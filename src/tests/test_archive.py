@@ -0,0 +1,68 @@
+"""
+Columnar archive of a finished test case.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from django.test import TestCase, override_settings
+
+from backend.apps.base.archive import archive_test_case, get_archive_dir, open_archive, read_channel
+from backend.apps.base.models import TelemetrySample
+
+from .fixtures import create_test_case
+
+
+class ArchiveTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        settings_override = override_settings(ARCHIVE_DIR=self.directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.test_case = create_test_case(state='FINISHED')
+        # inserted out of order, the archive is sorted by timestamp
+        for timestamp in (3.0, 1.0, 2.0):
+            TelemetrySample.objects.create(test_case=self.test_case, device='battery', port='COM3',
+                                           timestamp=timestamp, dc_current=timestamp * 10, cv_1=3.5, flags=16)
+        TelemetrySample.objects.create(test_case=self.test_case, device='inverter', port='COM4', timestamp=1.5,
+                                       ac_voltage=230.0)
+
+    def test_archive(self):
+        path = archive_test_case(self.test_case)
+        self.assertEqual(path, get_archive_dir(self.test_case.id))
+        self.assertFalse(os.path.exists(path + '.tmp'))
+        self.test_case.refresh_from_db()
+        archive = open_archive(self.test_case)
+        self.assertEqual(len(archive), 4)
+        self.assertIn('cv_9', archive.columns('battery'))
+        np.testing.assert_array_equal(archive.column('battery', 'timestamp'), [1.0, 2.0, 3.0])
+        np.testing.assert_array_equal(archive.column('battery', 'dc_current'), [10.0, 20.0, 30.0])
+        self.assertEqual(archive.column('battery', 'flags').dtype, np.int64)
+        # columns a device does not fill are NaN
+        self.assertTrue(np.isnan(archive.column('battery', 'mosfet_temp')).all())
+        self.assertIsInstance(archive.column('inverter', 'ac_voltage'), np.memmap)
+
+    def test_read_channel(self):
+        timestamps, values = read_channel(self.test_case, 'battery', 'dc_current')
+        np.testing.assert_array_equal(values, [10.0, 20.0, 30.0])
+        archive_test_case(self.test_case)
+        TelemetrySample.objects.all().delete()
+        timestamps, values = read_channel(self.test_case, 'battery', 'dc_current')
+        np.testing.assert_array_equal(timestamps, [1.0, 2.0, 3.0])
+        np.testing.assert_array_equal(values, [10.0, 20.0, 30.0])
+
+    def test_rearchive_replaces(self):
+        archive_test_case(self.test_case)
+        TelemetrySample.objects.create(test_case=self.test_case, device='battery', port='COM3', timestamp=4.0)
+        archive_test_case(self.test_case)
+        self.assertEqual(len(open_archive(self.test_case).column('battery', 'timestamp')), 4)
+
+    def test_no_archive(self):
+        self.assertIsNone(open_archive(self.test_case))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""
+Telemetry backfill from the device logs: line parsing and the per file checkpoints.
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from django.test import TestCase
+
+from backend.apps.base.backfill import LogParser, backfill_log_file, file_key
+from backend.apps.base.models import TelemetrySample
+
+PACK_LINE = ('INFO     2018-03-01 10:00:00,250 utils.py | 644| Pack values updated on port COM3. Pack serial number: '
+             '1234. Cells: 3.500 3.500 3.500 3.500 3.500 3.500 3.500 3.500 3.400. Current: -12.500. '
+             'Temperatures: 30.5/25.0. Flags: 16\n')
+DC_LINE = 'INFO     2018-03-01 10:00:01,000 utils.py | 332| DC frame on port COM4: 51.20 V, -40.00 A\n'
+AC_LINE = 'INFO     2018-03-01 10:00:01,500 utils.py | 346| AC frame on port COM4: 230.00 V, 9.00 A\n'
+OTHER_LINE = 'INFO     2018-03-01 10:00:02,000 utils.py | 156| DC frame Requested on port COM4\n'
+EPOCH = time.mktime((2018, 3, 1, 10, 0, 0, 0, 0, -1))
+
+
+class LogParserTest(unittest.TestCase):
+    def setUp(self):
+        self.parser = LogParser()
+
+    def test_pack_line(self):
+        sample = self.parser.parse(PACK_LINE)
+        self.assertEqual((sample['device'], sample['port'], sample['flags']), ('battery', 'COM3', 16))
+        self.assertAlmostEqual(sample['timestamp'], EPOCH + 0.25)
+        self.assertAlmostEqual(sample['dc_voltage'], 31.4)
+        self.assertEqual((sample['cv_1'], sample['cv_9']), (3.5, 3.4))
+        self.assertEqual((sample['dc_current'], sample['mosfet_temp'], sample['pack_temp']), (-12.5, 30.5, 25.0))
+
+    def test_frames_carry_the_other_frame(self):
+        dc = self.parser.parse(DC_LINE)
+        self.assertEqual((dc['dc_voltage'], dc['dc_current'], dc['ac_voltage']), (51.2, -40.0, None))
+        ac = self.parser.parse(AC_LINE)
+        self.assertEqual((ac['dc_voltage'], ac['ac_voltage'], ac['ac_current']), (51.2, 230.0, 9.0))
+        self.assertAlmostEqual(ac['timestamp'], EPOCH + 1.5)
+
+    def test_other_lines(self):
+        self.assertIsNone(self.parser.parse(OTHER_LINE))
+        self.assertIsNone(self.parser.parse('Pack values updated. Pack serial number: 1234\n'))
+        self.assertIsNone(self.parser.parse(PACK_LINE.replace('Current: -12.500', 'Current: n/a')))
+
+
+class BackfillTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.checkpoints = os.path.join(self.directory, 'backfill')
+        os.mkdir(self.checkpoints)
+        self.path = os.path.join(self.directory, 'inverter.log')
+
+    def write(self, *lines, mode='a'):
+        with open(self.path, mode) as log_file:
+            log_file.write(''.join(lines))
+
+    def test_resumes_from_the_checkpoint(self):
+        self.write(OTHER_LINE, DC_LINE, PACK_LINE)
+        self.assertEqual(backfill_log_file(self.path, self.checkpoints, batch_size=1), (3, 2))
+        self.assertEqual(backfill_log_file(self.path, self.checkpoints), (0, 0))
+        # a line still being written waits for the next run
+        self.write(AC_LINE, AC_LINE[:20])
+        self.assertEqual(backfill_log_file(self.path, self.checkpoints), (1, 1))
+        self.write(AC_LINE[20:])
+        self.assertEqual(backfill_log_file(self.path, self.checkpoints), (1, 1))
+        self.assertEqual(TelemetrySample.objects.count(), 4)
+        self.assertEqual(TelemetrySample.objects.filter(device='inverter', test_case=None).count(), 3)
+
+    def test_checkpoint_follows_rotation(self):
+        self.write(OTHER_LINE, DC_LINE)
+        key = file_key(self.path)
+        backfill_log_file(self.path, self.checkpoints)
+        rotated = self.path + '.1'
+        os.rename(self.path, rotated)
+        self.assertEqual(file_key(rotated), key)
+        self.assertEqual(backfill_log_file(rotated, self.checkpoints), (0, 0))
+        # the new log starts over
+        self.write(AC_LINE, mode='w')
+        self.assertEqual(backfill_log_file(self.path, self.checkpoints), (1, 1))
+
+    def test_empty_file(self):
+        self.write('', mode='w')
+        self.assertIsNone(file_key(self.path))
+        self.assertEqual(backfill_log_file(self.path, self.checkpoints), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
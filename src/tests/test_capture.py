@@ -0,0 +1,229 @@
+"""
+Raw serial capture: the capture files of the CaptureWriter, the playback of ReplaySerial and the replay of a capture
+of a simulated rig into fresh drivers.
+"""
+import glob
+import io
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, override_settings
+
+from backend.apps.base import capture
+from backend.apps.base.capture import (CAPTURE_RX, CAPTURE_TX, CaptureWriter, ReplaySerial, capture_device,
+                                       read_capture, replay_capture)
+from backend.apps.base.simulator import SimulatorHost
+from backend.apps.base.utils import UsbIssBattery, VictronMultiplusMK2VCP
+
+
+class CaptureWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        # flushed by the test, not by the background thread
+        patcher = mock.patch.object(CaptureWriter, '_run')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.writer = CaptureWriter(self.directory)
+        self.addCleanup(self.writer.close)
+
+    def captures(self):
+        return sorted(glob.glob(os.path.join(self.directory, '*.cap')))
+
+    def test_round_trip(self):
+        self.writer.record('/dev/ttyUSB0', CAPTURE_TX, bytearray(b'\x57\x01\x34'))
+        self.writer.record('/dev/ttyUSB0', CAPTURE_RX, b'\xff\x00')
+        self.writer.record('COM4', CAPTURE_TX, b'\x02\xffA')
+        self.writer.flush()
+        self.assertEqual(self.writer.records_written, 3)
+        # one file per port, named after the port
+        self.assertEqual([os.path.basename(path)[:-len('_YYYYmmdd_HHMMSS.cap')] for path in self.captures()],
+                         ['COM4', '_dev_ttyUSB0'])
+        path = self.writer.files['/dev/ttyUSB0'].handle.name
+        port, offset, captured = read_capture(path)
+        self.assertEqual(port, '/dev/ttyUSB0')
+        self.assertAlmostEqual(offset, time.time() - time.monotonic(), delta=5)
+        self.assertEqual([(direction, data) for _, direction, data in captured],
+                         [(CAPTURE_TX, b'\x57\x01\x34'), (CAPTURE_RX, b'\xff\x00')])
+        self.assertLessEqual(captured[0][0], captured[1][0])
+
+    def test_rotation(self):
+        self.writer.max_bytes = 10
+        self.writer.record('COM3', CAPTURE_TX, b'\x57\x01\x34' * 8)
+        self.writer.flush()
+        self.writer.record('COM3', CAPTURE_RX, b'\xff')
+        self.writer.flush()
+        self.writer.close()
+        self.assertEqual([len(read_capture(path)[2]) for path in self.captures()], [1, 1])
+
+    def test_truncated_record_is_dropped(self):
+        self.writer.record('COM3', CAPTURE_TX, b'\x57\x01\x34')
+        self.writer.record('COM3', CAPTURE_RX, b'\xff' * 20)
+        self.writer.close()
+        path, = self.captures()
+        with open(path, 'r+b') as handle:
+            handle.truncate(os.path.getsize(path) - 5)
+        self.assertEqual([data for _, _, data in read_capture(path)[2]], [b'\x57\x01\x34'])
+
+    def test_not_a_capture(self):
+        path = os.path.join(self.directory, 'battery.log')
+        with open(path, 'wb') as handle:
+            handle.write(b'Pack values updated')
+        with self.assertRaises(ValueError):
+            read_capture(path)
+
+    def test_failed_write_drops_the_records(self):
+        self.writer.record('COM3', CAPTURE_TX, b'\x57\x01\x34')
+        with mock.patch.object(capture.CaptureFile, 'write', side_effect=OSError('disk full')):
+            with self.assertLogs('base', 'ERROR'):
+                self.writer.flush()
+        self.assertEqual((self.writer.records_written, self.writer.pending), (0, {}))
+
+
+def records(*chunks, step=int(0.05e9)):
+    # (direction, bytes) -> capture records 50 ms apart
+    return [(index * step, direction, data) for index, (direction, data) in enumerate(chunks)]
+
+
+class ReplaySerialTest(unittest.TestCase):
+    RECORDS = records((CAPTURE_RX, b'boot'), (CAPTURE_TX, b'\x57\x01\x34'), (CAPTURE_RX, b'\x01\x02'),
+                      (CAPTURE_RX, b'\x03'), (CAPTURE_TX, b'\x57\x01\x35'), (CAPTURE_RX, b'\xff'))
+
+    def replay(self, realtime=False):
+        replay = ReplaySerial(self.RECORDS, realtime=realtime, port='COM3')
+        self.addCleanup(replay.close)
+        return replay
+
+    def wait_readable(self, replay, size):
+        # released by the feeder thread
+        deadline = time.monotonic() + 5
+        while replay.in_waiting < size and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+    def test_replies_follow_the_writes(self):
+        replay = self.replay()
+        # the bytes captured before the first write are readable at once
+        self.assertEqual(replay.read(100), b'boot')
+        self.assertEqual(replay.next_write, (0.05, b'\x57\x01\x34'))
+        self.assertEqual(replay.write(b'\x57\x01\x34'), 3)
+        self.assertEqual(replay.in_waiting, 3)
+        self.assertEqual(replay.read(100), b'\x01\x02\x03')
+        self.assertEqual(replay.read(100), b'')
+        replay.write(b'\x57\x01\x36')
+        self.assertTrue(replay.finished)
+        self.assertIsNone(replay.next_write)
+        self.assertEqual((replay.read(100), replay.tx_mismatches, replay.bytes_replayed), (b'\xff', 1, 8))
+
+    def test_reset_input_buffer_keeps_the_next_reply(self):
+        replay = self.replay()
+        replay.reset_input_buffer()
+        replay.write(b'\x57\x01\x34')
+        self.assertEqual(replay.read(100), b'\x01\x02\x03')
+
+    def test_realtime(self):
+        replay = self.replay(realtime=True)
+        self.wait_readable(replay, 4)
+        self.assertEqual(replay.read(100), b'boot')
+        started = time.monotonic()
+        replay.write(b'\x57\x01\x34')
+        self.assertEqual(replay.read(100), b'')
+        self.wait_readable(replay, 3)
+        # released with their capture delay after the write (50 and 100 ms)
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+        self.assertEqual(replay.read(100), b'\x01\x02\x03')
+
+    def test_capture_device(self):
+        self.assertEqual(capture_device(self.RECORDS), 'battery')
+        self.assertEqual(capture_device(records((CAPTURE_TX, b'\x02\xffA\x01\x00\xbb'))), 'inverter')
+        self.assertIsNone(capture_device(records((CAPTURE_TX, b'AT\r\n'))))
+        self.assertIsNone(capture_device(records((CAPTURE_RX, b'\xff'))))
+
+
+@unittest.skipUnless(hasattr(os, 'openpty'), 'the simulator needs pseudo-terminals')
+@override_settings(TELEMETRY_ENABLED=False, LIVE_FIELDS_ENABLED=False, LIVE_STATE_ENABLED=False)
+class ReplayCaptureTest(SimpleTestCase):
+    # a session with a simulated rig is captured, then replayed into fresh drivers
+
+    @classmethod
+    def setUpClass(cls):
+        super(ReplayCaptureTest, cls).setUpClass()
+        cls.directory = tempfile.mkdtemp()
+        cls.host = SimulatorHost(1, soc=0.15)
+        cls.host.start()
+        ports = cls.host.ports()[0]
+        writer = CaptureWriter(cls.directory, flush_interval=60)
+        # only the recorded session is captured, not the replays
+        with override_settings(SERIAL_CAPTURE_ENABLED=True, SERIAL_CAPTURE_PORTS=[]), \
+                mock.patch('backend.apps.base.transport.get_capture_writer', return_value=writer):
+            battery = UsbIssBattery(ports['battery_port'])
+            inverter = VictronMultiplusMK2VCP(ports['inverter_port'])
+            # the transports (and their capture) are created on first use
+            battery.transport, inverter.transport
+        try:
+            cls.battery_calls = [battery.engine.run(call, timeout=10) for call in (
+                battery.configure_USB_ISS_async(), battery.turn_pack_on_async(), battery.update_values_async(),
+                battery.update_values_async())]
+            inverter.set_point = 300
+            cls.inverter_calls = [inverter.engine.run(call, timeout=10) for call in (
+                inverter.configure_ve_bus_async(), inverter.refresh_async())]
+            cls.battery_snapshot = battery.snapshot.as_dict()
+            cls.inverter_snapshot = inverter.snapshot.as_dict()
+        finally:
+            battery.close_coms()
+            inverter.close_coms()
+            writer.close()
+        cls.paths = {capture_device(read_capture(path)[2]): path
+                     for path in glob.glob(os.path.join(cls.directory, '*.cap'))}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.host.stop()
+        shutil.rmtree(cls.directory)
+        super(ReplayCaptureTest, cls).tearDownClass()
+
+    def test_captured_session(self):
+        self.assertEqual(self.battery_calls + self.inverter_calls, [True] * 6)
+        self.assertEqual(sorted(self.paths), ['battery', 'inverter'])
+        port, _, captured = read_capture(self.paths['battery'])
+        self.assertEqual(port, self.host.ports()[0]['battery_port'])
+        self.assertEqual(captured[0][1:], (CAPTURE_TX, b'\x5A\x01'))
+        self.assertIn(CAPTURE_RX, [direction for _, direction, _ in captured])
+
+    def test_battery_replay(self):
+        result = replay_capture(self.paths['battery'])
+        self.assertEqual((result['device'], result['calls'], result['failed_calls'], result['tx_mismatches']),
+                         ('battery', 4, 0, 0))
+        self.assertEqual(result['snapshot']['serial_number'], self.battery_snapshot['serial_number'])
+        self.assertEqual(result['snapshot']['cv_1'], self.battery_snapshot['cv_1'])
+
+    def test_inverter_replay(self):
+        result = replay_capture(self.paths['inverter'])
+        self.assertEqual((result['device'], result['failed_calls'], result['tx_mismatches']), ('inverter', 0, 0))
+        self.assertEqual(result['writes'], len([record for record in read_capture(self.paths['inverter'])[2]
+                                                if record[1] == CAPTURE_TX]))
+        self.assertEqual(result['snapshot']['ac_voltage'], self.inverter_snapshot['ac_voltage'])
+        self.assertEqual(result['snapshot']['dc_voltage'], self.inverter_snapshot['dc_voltage'])
+
+    def test_realtime_replay(self):
+        result = replay_capture(self.paths['battery'], realtime=True)
+        self.assertEqual((result['failed_calls'], result['tx_mismatches']), (0, 0))
+        self.assertEqual(result['snapshot']['serial_number'], self.battery_snapshot['serial_number'])
+
+    def test_command(self):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        not_a_capture = os.path.join(self.directory, 'battery.log')
+        with open(not_a_capture, 'wb') as handle:
+            handle.write(b'Pack values updated')
+        call_command('replay_capture', self.paths['battery'], not_a_capture, stdout=stdout, stderr=stderr)
+        self.assertIn('battery on {}'.format(self.host.ports()[0]['battery_port']), stdout.getvalue())
+        self.assertIn('0 mismatches', stdout.getvalue())
+        self.assertIn(not_a_capture, stderr.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""
+Downsampling of the plotted channels: min/max envelopes and LTTB.
+"""
+import unittest
+
+import numpy as np
+
+from backend.apps.base.downsampling import lttb, minmax
+
+
+class MinmaxTest(unittest.TestCase):
+    def setUp(self):
+        self.x = np.arange(10000, dtype=np.float64)
+        self.y = np.sin(self.x / 100) + np.random.RandomState(0).normal(0, 0.1, len(self.x))
+
+    def test_envelope(self):
+        x_start, x_end, y_min, y_max = minmax(self.x, self.y, 100)
+        self.assertEqual(len(x_start), 100)
+        self.assertEqual(x_start[0], self.x[0])
+        self.assertEqual(x_end[-1], self.x[-1])
+        self.assertTrue((x_start <= x_end).all())
+        self.assertTrue((y_min <= y_max).all())
+        self.assertEqual(y_min.min(), self.y.min())
+        self.assertEqual(y_max.max(), self.y.max())
+
+    def test_bucket_bounds(self):
+        x_start, x_end, y_min, y_max = minmax(self.x, self.y, 100)
+        for start, end, low, high in zip(x_start, x_end, y_min, y_max):
+            bucket = self.y[int(start):int(end) + 1]
+            self.assertEqual(bucket.min(), low)
+            self.assertEqual(bucket.max(), high)
+
+    def test_fewer_samples_than_buckets(self):
+        x_start, x_end, y_min, y_max = minmax(self.x[:10], self.y[:10], 100)
+        self.assertEqual(len(x_start), 10)
+        np.testing.assert_array_equal(y_min, self.y[:10])
+
+    def test_nan_and_empty(self):
+        y = self.y.copy()
+        y[::2] = np.nan
+        _, _, y_min, y_max = minmax(self.x, y, 50)
+        self.assertFalse(np.isnan(y_min).any() or np.isnan(y_max).any())
+        self.assertEqual(len(minmax([], [], 10)[0]), 0)
+
+
+class LttbTest(unittest.TestCase):
+    def setUp(self):
+        self.x = np.arange(5000, dtype=np.float64)
+        self.y = np.cos(self.x / 50)
+
+    def test_threshold(self):
+        x, y = lttb(self.x, self.y, 200)
+        self.assertEqual(len(x), 200)
+        self.assertEqual((x[0], x[-1]), (self.x[0], self.x[-1]))
+        self.assertTrue((np.diff(x) > 0).all())
+        # every point is a sample of the input
+        np.testing.assert_array_equal(y, self.y[x.astype(np.int64)])
+        self.assertGreaterEqual(y.min(), self.y.min())
+        self.assertLessEqual(y.max(), self.y.max())
+
+    def test_keeps_the_spike(self):
+        y = np.zeros(5000)
+        y[2345] = 10.0
+        _, sampled = lttb(self.x, y, 100)
+        self.assertEqual(sampled.max(), 10.0)
+
+    def test_small_input_is_returned(self):
+        x, y = lttb(self.x[:50], self.y[:50], 100)
+        self.assertEqual(len(x), 50)
+        x, y = lttb(self.x, self.y, 2)
+        self.assertEqual(len(x), len(self.x))
+
+
+if __name__ == '__main__':
+    unittest.main()
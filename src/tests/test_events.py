@@ -0,0 +1,109 @@
+"""
+Event bus backends and the teardown dispatched by the writers of the FINISHED state.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from django.test import TransactionTestCase, override_settings
+
+from backend.apps.base.events import InMemoryEventBus, SqliteEventBus
+from backend.apps.base.models import Battery, Inverter, InverterPool, TestCase
+from backend.apps.base.tasks import teardown_test_case
+
+
+class InMemoryEventBusTest(unittest.TestCase):
+    def setUp(self):
+        self.bus = InMemoryEventBus()
+        self.received = []
+
+    def on_message(self, channel, message):
+        self.received.append((channel, message))
+
+    def test_dispatch_by_channel(self):
+        self.bus.subscribe('test_case', self.on_message)
+        self.bus.publish('test_case', {'state': 'RUNNING'})
+        self.bus.publish('test_case_step', {'step_index': 0})
+        self.assertEqual(self.received, [('test_case', {'state': 'RUNNING'})])
+
+    def test_unsubscribe(self):
+        self.bus.subscribe('test_case', self.on_message).unsubscribe()
+        self.bus.publish('test_case', {'state': 'RUNNING'})
+        self.assertEqual(self.received, [])
+
+    def test_failing_subscriber(self):
+        def fail(channel, message):
+            raise ValueError('subscriber bug')
+
+        self.bus.subscribe('test_case', fail)
+        self.bus.subscribe('test_case', self.on_message)
+        with self.assertLogs('base', 'ERROR'):
+            self.bus.publish('test_case', {'state': 'FINISHED'})
+        self.assertEqual(len(self.received), 1)
+
+
+class SqliteEventBusTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'events.sqlite3')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_shared_between_buses(self):
+        publisher, subscriber = SqliteEventBus(self.path), SqliteEventBus(self.path)
+        subscriber.POLL_INTERVAL = 0.01
+        # published before the subscription: not delivered
+        publisher.publish('test_case', {'test_case_id': 1, 'state': 'RUNNING'})
+
+        received = []
+        finished = threading.Event()
+
+        def on_message(channel, message):
+            received.append(message)
+            if message['state'] == 'FINISHED':
+                finished.set()
+
+        subscriber.subscribe('test_case', on_message)
+        publisher.publish('test_case_step', {'test_case_id': 1, 'step_index': 0})
+        publisher.publish('test_case', {'test_case_id': 1, 'state': 'FINISHED'})
+        self.assertTrue(finished.wait(5))
+        self.assertEqual(received, [{'test_case_id': 1, 'state': 'FINISHED'}])
+
+
+@override_settings(TELEMETRY_ENABLED=False, RIG_SUPERVISOR_ENABLED=True)
+class TeardownDispatchTest(TransactionTestCase):
+    # on_commit callbacks only run outside of the test transaction
+
+    def setUp(self):
+        battery = Battery.objects.create(name='pack', port='COM3')
+        inverter = Inverter.objects.create(name='inverter', port='COM4',
+                                           inverter_pool=InverterPool.objects.create(name='pool'))
+        with mock.patch('backend.apps.base.models.test_case.main_task'):
+            self.test_case = TestCase.objects.create(name='test', battery=battery, inverter=inverter,
+                                                     state='RUNNING')
+
+    @mock.patch('backend.apps.base.tasks.teardown_test_case.apply_async')
+    def test_set_state_dispatches_the_teardown(self, apply_async):
+        self.test_case.set_state('RUNNING')
+        apply_async.assert_not_called()
+        self.test_case.set_state('FINISHED', result='PASS')
+        apply_async.assert_called_once_with((self.test_case.id,), queue='main_com_COM3')
+
+    @mock.patch('backend.apps.base.tasks.release_rig')
+    def test_teardown_runs_once(self, release_rig):
+        teardown_test_case(self.test_case.id)
+        release_rig.assert_not_called()
+
+        TestCase.objects.filter(id=self.test_case.id).update(state='FINISHED')
+        teardown_test_case(self.test_case.id)
+        teardown_test_case(self.test_case.id)
+        release_rig.assert_called_once_with(self.test_case.id)
+        self.assertTrue(TestCase.objects.get(id=self.test_case.id).torn_down)
+
+
+if __name__ == '__main__':
+    unittest.main()
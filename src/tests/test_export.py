@@ -0,0 +1,87 @@
+"""
+CSV export of the telemetry, from the database and from the archive, and the authentication of the telemetry routes.
+"""
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test import TestCase, override_settings
+
+from backend.apps.base.archive import archive_test_case
+from backend.apps.base.models import TelemetrySample
+
+from .fixtures import create_test_case
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        settings_override = override_settings(ARCHIVE_DIR=self.directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.test_case = create_test_case(state='FINISHED')
+        for second in range(5):
+            TelemetrySample.objects.create(test_case=self.test_case, device='battery', port='COM3',
+                                           timestamp=float(second), dc_current=1.5 * second,
+                                           cv_1=None if second == 2 else 3.5, flags=0)
+        user = User.objects.create_user('operator', password='secret')
+        self.client.force_login(user)
+
+    def export(self, device='battery', **params):
+        url = reverse('base:export_telemetry', kwargs={'test_case_id': self.test_case.id, 'device': device})
+        return self.client.get(url, params)
+
+    def csv(self, **params):
+        response = self.export(**params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        return b''.join(response.streaming_content).decode().splitlines()
+
+    def test_columns_and_range(self):
+        self.assertEqual(self.csv(columns='timestamp,dc_current,cv_1', start=1, end=3),
+                         ['timestamp,dc_current,cv_1', '1.0,1.5,3.5', '2.0,3.0,', '3.0,4.5,3.5'])
+        self.assertEqual(len(self.csv()), 6)
+
+    @mock.patch('backend.apps.base.export.EXPORT_CHUNK_SIZE', 2)
+    def test_archive_matches_database(self):
+        from_database = self.csv(columns='timestamp,dc_current,cv_1')
+        archive_test_case(self.test_case)
+        TelemetrySample.objects.all().delete()
+        self.assertEqual(self.csv(columns='timestamp,dc_current,cv_1'), from_database)
+        self.assertEqual(self.csv(columns='timestamp', start=3), ['timestamp', '3.0', '4.0'])
+
+    def test_bad_requests(self):
+        self.assertEqual(self.export(device='charger').status_code, 404)
+        self.assertEqual(self.export(columns='timestamp,ac_voltage').status_code, 400)
+        self.assertEqual(self.export(start='soon').status_code, 400)
+        self.assertEqual(self.client.post(reverse('base:export_telemetry', kwargs={
+            'test_case_id': self.test_case.id, 'device': 'battery'})).status_code, 405)
+
+
+class TelemetryRoutesAuthTest(TestCase):
+    def test_login_required(self):
+        test_case = create_test_case(state='FINISHED')
+        urls = [
+            reverse('base:telemetry_channels', kwargs={'test_case_id': test_case.id}),
+            reverse('base:telemetry_series', kwargs={'test_case_id': test_case.id, 'device': 'battery',
+                                                     'column': 'dc_current'}),
+            reverse('base:test_case_report', kwargs={'test_case_id': test_case.id}),
+            reverse('base:export_telemetry', kwargs={'test_case_id': test_case.id, 'device': 'battery'}),
+            reverse('base:live_state', kwargs={'device': 'battery', 'port': 'COM3'}),
+        ]
+        for url in urls:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 302)
+                self.assertTrue(response['Location'].startswith(settings.LOGIN_URL))
+        self.client.force_login(User.objects.create_user('operator', password='secret'))
+        self.assertEqual(self.client.get(urls[0]).status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+"""
+Coulomb counting and its accumulation into the StepResult rows, whatever the process that takes the samples.
+"""
+import unittest
+from unittest import mock
+
+from django.test import TestCase
+
+from backend.apps.base.integration import CoulombCounter, StepIntegrator
+from backend.apps.base.models import StepResult
+from backend.apps.base.snapshots import PackSnapshot
+
+from .fixtures import create_test_case
+
+
+class CoulombCounterTest(unittest.TestCase):
+    def test_constant_current(self):
+        counter = CoulombCounter()
+        for second in range(3601):
+            counter.add(second, 10.0, 30.0)
+        self.assertAlmostEqual(counter.ah, 10.0)
+        self.assertAlmostEqual(counter.wh, 300.0)
+        self.assertEqual(counter.samples, 3601)
+        self.assertEqual((counter.start, counter.end), (0, 3600))
+
+    def test_ramp_is_trapezoidal(self):
+        counter = CoulombCounter()
+        # 0 to 20 A over one hour: 10 Ah
+        for second in range(0, 3601, 5):
+            counter.add(second, 20.0 * second / 3600, 1.0)
+        self.assertAlmostEqual(counter.ah, 10.0)
+
+    def test_sign_follows_current(self):
+        counter = CoulombCounter(max_gap=1000.0)
+        counter.add(0, -36.0, 30.0)
+        counter.add(100, -36.0, 30.0)
+        self.assertAlmostEqual(counter.ah, -1.0)
+        self.assertAlmostEqual(counter.wh, -30.0)
+
+    def test_gap_is_not_integrated(self):
+        counter = CoulombCounter(max_gap=10.0)
+        counter.add(0, 36.0, 1.0)
+        counter.add(10, 36.0, 1.0)
+        counter.add(100, 36.0, 1.0)
+        counter.add(110, 36.0, 1.0)
+        self.assertAlmostEqual(counter.ah, 0.2)
+        self.assertEqual(counter.gaps, 1)
+        self.assertEqual(counter.gap_seconds, 90)
+
+    def test_repeated_sample_and_cell_extremes(self):
+        counter = CoulombCounter(max_gap=1000.0)
+        counter.add(0, 3.6, 1.0, cv_min=3.5, cv_max=3.7)
+        counter.add(0, 100.0, 1.0, cv_min=1.0, cv_max=5.0)
+        counter.add(1000, 3.6, 1.0, cv_min=3.4, cv_max=3.8)
+        self.assertAlmostEqual(counter.ah, 1.0)
+        self.assertEqual(counter.samples, 2)
+        self.assertEqual((counter.cv_min, counter.cv_max), (3.4, 3.8))
+
+
+def pack_snapshot(timestamp, current=36.0):
+    # 9 cells at 3.5 V
+    return PackSnapshot(1, [3.5] * 9, current, 30.0, 25.0, timestamp=timestamp)
+
+
+class StepIntegratorTest(TestCase):
+    def setUp(self):
+        self.test_case = create_test_case()
+        # one integrator per process
+        self.integrators = [StepIntegrator(max_gap=10.0), StepIntegrator(max_gap=10.0)]
+
+    def result(self, step_index=None):
+        return StepResult.objects.get(test_case=self.test_case, step_index=step_index)
+
+    def test_samples_split_across_processes(self):
+        self.integrators[0].start_step(self.test_case.id, 0, 'CC_Charge')
+        # a sample every 5 s, each taken by a different process
+        for second in range(0, 3601, 5):
+            self.integrators[second // 5 % 2].add_samples(self.test_case.id, [pack_snapshot(second)])
+        for result in (self.result(), self.result(0)):
+            self.assertAlmostEqual(result.ah, 36.0)
+            self.assertAlmostEqual(result.wh, 36.0 * 31.5)
+            self.assertEqual((result.samples, result.gaps, result.start, result.end), (721, 0, 0, 3600))
+        self.assertEqual(self.result(0).step_type, 'CC_Charge')
+        self.assertEqual(StepResult.objects.count(), 2)
+
+    def test_steps(self):
+        integrator = self.integrators[0]
+        integrator.start_step(self.test_case.id, 0, 'CC_Charge')
+        integrator.add_samples(self.test_case.id, [pack_snapshot(0), pack_snapshot(10)])
+        integrator.start_step(self.test_case.id, 1, 'Rest')
+        integrator.add_samples(self.test_case.id, [pack_snapshot(20, 0.0), pack_snapshot(30, 0.0)])
+        self.assertAlmostEqual(self.result(0).ah, 0.1)
+        self.assertAlmostEqual(self.result(1).ah, 0.0)
+        self.assertEqual(self.result(1).samples, 2)
+        # the whole test case, across the step boundary
+        self.assertAlmostEqual(self.result().ah, 0.1 + 0.05)
+        # an event delivered twice does not open the step again
+        integrator.start_step(self.test_case.id, 1, 'Rest')
+        self.assertEqual(StepResult.objects.filter(step_index=1).count(), 1)
+
+    def test_finished_test_case_is_ignored(self):
+        integrator = self.integrators[0]
+        self.assertTrue(integrator.add_samples(self.test_case.id, [pack_snapshot(0)]))
+        self.test_case.set_state('FINISHED')
+        self.assertFalse(integrator.add_samples(self.test_case.id, [pack_snapshot(5)]))
+        self.assertEqual(self.result().samples, 1)
+
+    @mock.patch.object(StepIntegrator, '_start')
+    def test_submitted_samples(self, start):
+        integrator = self.integrators[0]
+        for second in (0, 5, 10):
+            integrator.submit_sample(self.test_case.id, pack_snapshot(second))
+        # what the worker thread does
+        integrator.flush()
+        self.assertEqual(integrator.pending, {})
+        self.assertAlmostEqual(self.result().ah, 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
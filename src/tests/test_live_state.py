@@ -0,0 +1,116 @@
+"""
+Shared memory ring of the live device state: sequence numbers, mirrored slots and the reader side.
+"""
+import unittest
+import uuid
+
+from django.test import SimpleTestCase, override_settings
+
+from backend.apps.base import live_state
+from backend.apps.base.live_state import LiveStateRing, is_shared_memory_available, publish_live_state
+from backend.apps.base.snapshots import InverterSnapshot, PackSnapshot
+
+
+def pack_snapshot(timestamp):
+    return PackSnapshot(1234, [3.5] * 9, timestamp / 10, 30.0, 25.0, timestamp=timestamp)
+
+
+@unittest.skipUnless(is_shared_memory_available(), 'multiprocessing.shared_memory needs Python 3.8+')
+class LiveStateRingTest(unittest.TestCase):
+    def setUp(self):
+        self.port = 'COM_{}'.format(uuid.uuid4().hex[:8])
+        self.ring = LiveStateRing.create('battery', self.port, capacity=4)
+        self.addCleanup(self.ring.close)
+
+    def write(self, start, count):
+        for timestamp in range(start, start + count):
+            self.ring.write(pack_snapshot(float(timestamp)))
+
+    def test_empty(self):
+        self.assertEqual(len(self.ring.read(4)), 0)
+        self.assertIsNone(self.ring.latest())
+
+    def test_sequence_numbers(self):
+        self.write(1, 3)
+        records = self.ring.read(2)
+        self.assertEqual(records['seq'].tolist(), [2, 3])
+        self.assertEqual(records['timestamp'].tolist(), [2.0, 3.0])
+        latest = self.ring.latest()
+        self.assertEqual((latest['seq'], latest['serial_number'], latest['cv_9']), (3, 1234, 3.5))
+        # asking for more than what was written
+        self.assertEqual(self.ring.read(10)['seq'].tolist(), [1, 2, 3])
+
+    def test_wrap_around_is_contiguous(self):
+        self.write(1, 10)
+        self.assertEqual(self.ring.count, 10)
+        self.assertEqual(self.ring.read(4)['seq'].tolist(), [7, 8, 9, 10])
+        # every slot and its mirror hold the same record
+        records = self.ring.records
+        self.assertEqual(records[:4].tolist(), records[4:].tolist())
+
+    def test_view_is_zero_copy(self):
+        self.write(1, 2)
+        view = self.ring.view(1)
+        self.write(3, 4)
+        # same slot, overwritten meanwhile
+        self.assertEqual(view['seq'].tolist(), [6])
+        del view
+
+    def test_overwritten_records_are_not_returned(self):
+        self.write(1, 6)
+        # the writer overwrote the oldest record while the reader copied it
+        self.ring.records['seq'][2] = self.ring.records['seq'][6] = 99
+        self.assertEqual(self.ring.read(4)['seq'].tolist(), [5, 6])
+
+    def test_reader(self):
+        self.write(1, 3)
+        reader = LiveStateRing.open('battery', self.port)
+        self.addCleanup(reader.close)
+        self.assertEqual(reader.read(3).tolist(), self.ring.read(3).tolist())
+        self.write(4, 1)
+        self.assertEqual(reader.latest()['seq'], 4)
+        self.assertIsNone(LiveStateRing.open('battery', self.port + '_missing'))
+        self.assertIsNone(LiveStateRing.open('inverter', self.port))
+
+    def test_stale_segment_is_replaced(self):
+        self.write(1, 3)
+        # the previous owner died without unlinking its segment
+        self.ring.owner = False
+        ring = LiveStateRing.create('battery', self.port, capacity=8)
+        self.addCleanup(ring.close)
+        self.assertEqual((ring.capacity, ring.count), (8, 0))
+
+    def test_inverter_without_frames(self):
+        ring = LiveStateRing.create('inverter', self.port, capacity=2)
+        self.addCleanup(ring.close)
+        ring.write(InverterSnapshot(ac_voltage=230.0, last_ac_update=10.0))
+        latest = ring.latest()
+        self.assertEqual((latest['ac_voltage'], latest['last_ac_update']), (230.0, 10.0))
+        self.assertNotEqual(latest['last_dc_update'], latest['last_dc_update'])
+
+
+@unittest.skipUnless(is_shared_memory_available(), 'multiprocessing.shared_memory needs Python 3.8+')
+class PublishLiveStateTest(SimpleTestCase):
+    def setUp(self):
+        self.port = 'COM_{}'.format(uuid.uuid4().hex[:8])
+
+    def tearDown(self):
+        ring = live_state._writers.pop(('battery', self.port), None)
+        if ring is not None:
+            ring.close()
+
+    @override_settings(LIVE_STATE_ENABLED=False)
+    def test_disabled(self):
+        publish_live_state('battery', self.port, pack_snapshot(1.0))
+        self.assertIsNone(LiveStateRing.open('battery', self.port))
+
+    @override_settings(LIVE_STATE_ENABLED=True, LIVE_STATE_CAPACITY=8)
+    def test_published(self):
+        publish_live_state('battery', self.port, pack_snapshot(1.0))
+        reader = LiveStateRing.open('battery', self.port)
+        self.addCleanup(reader.close)
+        self.assertEqual((reader.capacity, reader.latest()['timestamp']), (8, 1.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+"""
+Port daemon against a simulated rig: remote drivers, exposed methods and the per pack limits.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from django.test import TestCase, override_settings
+
+from backend.apps.base import port_daemon
+from backend.apps.base.models import Battery
+from backend.apps.base.port_daemon import PortDaemon, PortDaemonClient, PortDaemonError, RemoteBattery
+from backend.apps.base.safety import LimitProfile
+from backend.apps.base.simulator import SimulatorHost
+from backend.apps.base.utils import UsbIssBattery
+
+
+@unittest.skipUnless(hasattr(os, 'openpty'), 'the simulator needs pseudo-terminals')
+@override_settings(TELEMETRY_ENABLED=False, LIVE_FIELDS_ENABLED=False, LIVE_STATE_ENABLED=False)
+class PortDaemonTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(PortDaemonTest, cls).setUpClass()
+        cls.host = SimulatorHost(1, soc=0.15)
+        cls.host.start()
+        cls.port = cls.host.ports()[0]['battery_port']
+        cls.socket_dir = tempfile.mkdtemp()
+        cls.address = os.path.join(cls.socket_dir, 'port_daemon.sock')
+        cls.daemon = PortDaemon(cls.address)
+        cls.daemon.engine.run(cls.daemon.start_async())
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.daemon.stop()
+        UsbIssBattery.battery_instances.pop(cls.port, None)
+        cls.host.stop()
+        shutil.rmtree(cls.socket_dir)
+        super(PortDaemonTest, cls).tearDownClass()
+
+    def setUp(self):
+        port_daemon._client = None
+        self.client = PortDaemonClient(self.address, timeout=10)
+
+    def tearDown(self):
+        self.client.close()
+        if port_daemon._client is not None:
+            port_daemon._client.close()
+            port_daemon._client = None
+
+    def test_remote_battery(self):
+        battery = RemoteBattery(self.port, client=self.client)
+        self.assertTrue(battery.configure_USB_ISS())
+        self.assertTrue(battery.turn_pack_on())
+        self.assertTrue(battery.update_values())
+        self.assertEqual(battery.snapshot.serial_number, self.host.rigs[0].pack.serial_number)
+
+    def test_method_not_exposed(self):
+        with self.assertLogs('base', 'ERROR'):
+            with self.assertRaises(PortDaemonError):
+                self.client.call('battery', self.port, 'serial_handle')
+            with self.assertRaises(PortDaemonError):
+                self.client.call('host', None, 'rigs')
+        with self.assertRaises(AttributeError):
+            RemoteBattery(self.port, client=self.client).transport
+
+    def test_limits_round_trip(self):
+        battery = RemoteBattery(self.port, client=self.client)
+        battery.limits = LimitProfile(cell_ovp_level_1=3.9)
+        self.assertIsInstance(battery.limits, LimitProfile)
+        self.assertEqual(battery.limits.cell_ovp_level_1, 3.9)
+        self.assertEqual(UsbIssBattery.battery_instances[self.port].limits.cell_ovp_level_1, 3.9)
+
+    def test_battery_utilities_sends_the_pack_limits(self):
+        battery = Battery.objects.create(name='pack', port=self.port, cell_ovp_level_2=4.05, overcurrent=42)
+        with override_settings(PORT_DAEMON_ADDRESS=self.address):
+            remote = battery.battery_utilities
+        self.assertIsInstance(remote, RemoteBattery)
+        limits = UsbIssBattery.battery_instances[self.port].limits
+        self.assertEqual(limits.cell_ovp_level_2, 4.05)
+        self.assertEqual(limits.overcurrent, 42)
+        self.assertEqual(limits.cell_ovp_level_1, LimitProfile().cell_ovp_level_1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+
+from backend.apps.base.protocol import (Mk2FrameParser, decode_mk2_ac_frame, decode_mk2_dc_frame,
+                                        decode_status_frame, mk2_frame_type, MK2_MARKER_COMMAND)
+from backend.apps.base.simulator import Mk2Device, PackModel, mk2_frame, status_frame
+
+
+class StatusFrameTest(unittest.TestCase):
+    def setUp(self):
+        self.pack = PackModel(900001)
+        self.pack.current = 12.5
+
+    def test_round_trip(self):
+        snapshot = decode_status_frame(status_frame(self.pack), timestamp=1.0)
+        self.assertEqual(snapshot.serial_number, 900001)
+        self.assertEqual(len(snapshot.cell_voltages), 9)
+        for decoded, cell_voltage in zip(snapshot.cell_voltages, self.pack.cell_voltages):
+            self.assertAlmostEqual(decoded, cell_voltage, places=5)
+        self.assertAlmostEqual(snapshot.dc_current, 12.5, places=5)
+        self.assertAlmostEqual(snapshot.pack_temp, self.pack.pack_temp, places=5)
+        self.assertEqual(snapshot.timestamp, 1.0)
+
+    def test_bad_crc(self):
+        frame = bytearray(status_frame(self.pack))
+        frame[20] ^= 0x01
+        self.assertIsNone(decode_status_frame(bytes(frame)))
+
+    def test_short_frame(self):
+        self.assertIsNone(decode_status_frame(status_frame(self.pack)[:-1]))
+
+
+class Mk2FrameTest(unittest.TestCase):
+    def setUp(self):
+        self.pack = PackModel(900002)
+        self.device = Mk2Device(self.pack)
+        self.parser = Mk2FrameParser()
+
+    def test_dc_frame(self):
+        self.pack.current = -8.3
+        frames = self.parser.feed(self.device.dc_frame())
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(mk2_frame_type(frames[0]), 'DC')
+        dc_voltage, dc_current = decode_mk2_dc_frame(frames[0])
+        self.assertAlmostEqual(dc_voltage, self.pack.voltage, places=2)
+        self.assertAlmostEqual(dc_current, 8.3, places=1)
+
+    def test_ac_frame(self):
+        self.device.is_on = True
+        self.device.set_point = 500
+        frames = self.parser.feed(self.device.ac_frame())
+        self.assertEqual(mk2_frame_type(frames[0]), 'AC')
+        ac_voltage, ac_current = decode_mk2_ac_frame(frames[0])
+        self.assertEqual(ac_voltage, 230.0)
+        self.assertGreater(ac_current, 0)
+
+    def test_command_reply(self):
+        frames = self.parser.feed(mk2_frame(MK2_MARKER_COMMAND, b'S\x00'))
+        self.assertEqual(mk2_frame_type(frames[0]), 'S')
+
+    def test_split_stream(self):
+        stream = self.device.version_frame() + self.device.dc_frame() + self.device.ac_frame()
+        frames = []
+        for position in range(0, len(stream), 3):
+            frames.extend(self.parser.feed(stream[position:position + 3]))
+        self.assertEqual([mk2_frame_type(frame) for frame in frames], ['V', 'DC', 'AC'])
+        self.assertEqual(self.parser.bytes_dropped, 0)
+
+    def test_resynchronises_after_garbage(self):
+        frames = self.parser.feed(b'\x00\x13\x37' + self.device.dc_frame())
+        self.assertEqual([mk2_frame_type(frame) for frame in frames], ['DC'])
+        self.assertEqual(self.parser.bytes_dropped, 3)
+
+    def test_bad_checksum(self):
+        frame = bytearray(self.device.dc_frame())
+        frame[-1] ^= 0xFF
+        self.assertEqual(self.parser.feed(bytes(frame)), [])
+        self.assertGreater(self.parser.checksum_errors, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
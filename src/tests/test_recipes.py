@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from backend.apps.base.models import TestCase
+from backend.apps.base.recipes import compile_recipe, RecipeError, STEP_CC_CHARGE, STEP_CC_DISCHARGE, STEP_REST
+from backend.apps.base.snapshots import PackSnapshot
+
+TEST_RECIPE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend', 'settings',
+                           'test_recipe.csv')
+HEADER = 'step_id,setpoint,limit_type,v_limit,timeout_seconds,step_type\n'
+
+
+class CompileRecipeTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_recipe(self, content):
+        path = os.path.join(self.directory, 'recipe.csv')
+        with open(path, 'w') as recipe_file:
+            recipe_file.write(content)
+        return path
+
+    def test_recipe(self):
+        path = self.write_recipe(HEADER + '1,0,voltage,32,7200,Rest\n'
+                                          '2,-400,voltage,32,600,CC Charge\n'
+                                          '3,,voltage,27,,CC Discharge\n'
+                                          '4,-500,,32,,CC Charge\n')
+        recipe = compile_recipe(path)
+        self.assertEqual([step.step_type for step in recipe.steps],
+                         [STEP_REST, STEP_CC_CHARGE, STEP_CC_DISCHARGE, STEP_CC_CHARGE])
+        self.assertEqual(recipe.steps[0].setpoint, 0)
+        self.assertEqual((recipe.steps[1].setpoint, recipe.steps[1].v_limit, recipe.steps[1].timeout_seconds),
+                         (-400, 32, 600))
+        # no setpoint: the INVERTING_SETPOINT of the settings, no timeout: the v_limit or the level 1 limits
+        self.assertEqual((recipe.steps[2].setpoint, recipe.steps[2].v_limit), (None, 27))
+        self.assertIsNone(recipe.steps[2].timeout_seconds)
+        # v_limit only applies with the voltage limit type
+        self.assertIsNone(recipe.steps[3].v_limit)
+
+    def test_shipped_recipe_untimed_rest(self):
+        # the Rest rows without a timeout of settings/test_recipe.csv would block run_test
+        with self.assertRaisesRegex(RecipeError, 'Line 6: a Rest step needs a timeout'):
+            compile_recipe(TEST_RECIPE)
+
+    def test_rest_needs_timeout(self):
+        path = self.write_recipe(HEADER + '1,0,,32,,Rest\n')
+        with self.assertRaisesRegex(RecipeError, 'Line 2'):
+            compile_recipe(path)
+
+    def test_setpoint_sign(self):
+        for row in ('1,500,,,60,CC Charge\n', '1,-500,,,60,CC Discharge\n', '1,100,,,60,Rest\n'):
+            with self.subTest(row=row), self.assertRaisesRegex(RecipeError, 'Line 2'):
+                compile_recipe(self.write_recipe(HEADER + row))
+
+    def test_voltage_limit_needs_v_limit(self):
+        with self.assertRaisesRegex(RecipeError, 'Line 2: the voltage limit type needs a v_limit'):
+            compile_recipe(self.write_recipe(HEADER + '1,-500,voltage,,,CC Charge\n'))
+
+    def test_unknown_step_type(self):
+        path = self.write_recipe(HEADER + '1,0,,32,60,Rest\n2,0,,32,60,Boost\n')
+        with self.assertRaisesRegex(RecipeError, 'Line 3'):
+            compile_recipe(path)
+
+    def test_missing_column(self):
+        path = self.write_recipe('step_id,setpoint\n1,0\n')
+        with self.assertRaisesRegex(RecipeError, 'step_type'):
+            compile_recipe(path)
+
+    def test_empty_recipe(self):
+        with self.assertRaises(RecipeError):
+            compile_recipe(self.write_recipe(HEADER))
+
+
+class FakeBattery(object):
+    com_port = 'COM1'
+
+    def __init__(self, voltages, level_1_at=None):
+        # pack voltage of each successive reading
+        self.voltages = list(voltages)
+        self.level_1_at = level_1_at
+        self.readings = 0
+        self.snapshot = PackSnapshot()
+
+    def update_values(self):
+        voltage = self.voltages[min(self.readings, len(self.voltages) - 1)]
+        self.snapshot = PackSnapshot(1, [voltage / 9] * 9)
+        self.readings += 1
+        return True
+
+    def check_safety_level_1(self):
+        return self.level_1_at is None or self.readings < self.level_1_at
+
+    def check_safety_level_2(self):
+        return True
+
+    def clear_level_1_error_flag(self):
+        return True
+
+
+class FakeInverter(object):
+    com_port = 'COM2'
+
+    def __init__(self):
+        self.calls = []
+
+    def charge(self, set_point=None):
+        self.calls.append(('charge', set_point))
+
+    def invert(self, set_point=None):
+        self.calls.append(('invert', set_point))
+
+    def rest(self):
+        self.calls.append(('rest', None))
+
+
+class RecipeStepTest(unittest.TestCase):
+    def setUp(self):
+        self.test_case = TestCase()
+        self.test_case.STEP_POLL_INTERVAL = 0
+        self.inverter = FakeInverter()
+
+    def test_untimed_step_ends_on_level_1(self):
+        # nothing but the wait loop refreshes the pack of this process
+        battery = FakeBattery([30, 30, 30, 30], level_1_at=3)
+        self.test_case.cc_charge(battery, self.inverter, start_timestamp=0, timeout_seconds=None)
+        self.assertEqual(battery.readings, 3)
+        self.assertEqual(self.inverter.calls, [('charge', None), ('rest', None)])
+
+    def test_charge_ends_on_v_limit(self):
+        battery = FakeBattery([30, 31, 32.1, 33])
+        self.test_case.cc_charge(battery, self.inverter, start_timestamp=0, timeout_seconds=None, set_point=-400,
+                                 v_limit=32)
+        self.assertEqual(battery.readings, 3)
+        self.assertEqual(self.inverter.calls[0], ('charge', -400))
+
+    def test_discharge_ends_on_v_limit(self):
+        battery = FakeBattery([30, 28, 26.9])
+        self.test_case.cc_discharge(battery, self.inverter, start_timestamp=0, timeout_seconds=None, set_point=300,
+                                    v_limit=27)
+        self.assertEqual(battery.readings, 3)
+        self.assertEqual(self.inverter.calls[0], ('invert', 300))
+
+    def test_timeout(self):
+        battery = FakeBattery([30])
+        self.test_case.rest(battery, self.inverter, start_timestamp=0, timeout_seconds=1, v_limit=32)
+        self.assertEqual(battery.readings, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+"""
+Vectorised fleet evaluation (FleetSafetyEngine) and its hand over to the SafetyMonitor of each pack.
+"""
+import asyncio
+import unittest
+
+from backend.apps.base.safety import FleetSafetyEngine, LimitProfile, SafetyMonitor
+from backend.apps.base.snapshots import (PackSnapshot, PACK_CELL_OVERVOLTAGE_LEVEL_1, PACK_CELL_OVERVOLTAGE_LEVEL_2,
+                                         PACK_CELL_UNDERVOLTAGE_LEVEL_1, PACK_CELL_UNDERVOLTAGE_LEVEL_2,
+                                         PACK_NOT_SAFE_LEVEL_1, PACK_NOT_SAFE_LEVEL_2, PACK_OVERCURRENT,
+                                         PACK_OVERTEMPERATURE_CELLS, PACK_OVERTEMPERATURE_MOSFETS)
+
+LIMITS = LimitProfile(cell_ovp_level_1=3.9, cell_ovp_level_2=4.1, cell_uvp_level_1=3.0, cell_uvp_level_2=2.8,
+                      overcurrent=50, mosfets_overtemperature=80, cells_overtemperature=60)
+LEVEL_1 = PACK_NOT_SAFE_LEVEL_1
+LEVEL_2 = PACK_NOT_SAFE_LEVEL_1 | PACK_NOT_SAFE_LEVEL_2
+
+
+def pack_snapshot(cell_voltage=3.5, dc_current=10.0, mosfet_temp=30.0, pack_temp=25.0, **cells):
+    cell_voltages = [cell_voltage] * 9
+    for index, value in cells.items():
+        cell_voltages[int(index[1:])] = value
+    return PackSnapshot(1, cell_voltages, dc_current, mosfet_temp, pack_temp)
+
+
+class FakeEngine(object):
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+
+
+class FakeBattery(object):
+    def __init__(self, com_port):
+        self.com_port = com_port
+        self.limits = LIMITS
+        self.sample_listeners = []
+        self.snapshot = PackSnapshot()
+        self.engine = FakeEngine()
+
+
+class FakeInverter(object):
+    com_port = 'COM_INV'
+
+    def __init__(self):
+        self.stops = 0
+
+    async def stop_async(self):
+        self.stops += 1
+        return True
+
+
+class FleetSafetyEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.fleet = FleetSafetyEngine(capacity=2)
+
+    def flags_of(self, snapshot):
+        self.fleet.register('COM1', LIMITS)
+        self.fleet.update('COM1', snapshot)
+        return self.fleet.flags_by_port()['COM1']
+
+    def test_no_sample_never_trips(self):
+        self.fleet.register('COM1', LIMITS)
+        self.assertEqual(self.fleet.flags_by_port(), {'COM1': 0})
+
+    def test_safe_pack(self):
+        self.assertEqual(self.flags_of(pack_snapshot()), 0)
+
+    def test_limit_columns(self):
+        cases = (
+            (pack_snapshot(c4=3.95), PACK_CELL_OVERVOLTAGE_LEVEL_1 | LEVEL_1),
+            (pack_snapshot(c4=4.2), PACK_CELL_OVERVOLTAGE_LEVEL_1 | PACK_CELL_OVERVOLTAGE_LEVEL_2 | LEVEL_2),
+            (pack_snapshot(c0=2.9), PACK_CELL_UNDERVOLTAGE_LEVEL_1 | LEVEL_1),
+            (pack_snapshot(c8=2.7), PACK_CELL_UNDERVOLTAGE_LEVEL_1 | PACK_CELL_UNDERVOLTAGE_LEVEL_2 | LEVEL_2),
+            (pack_snapshot(dc_current=51), PACK_OVERCURRENT | PACK_NOT_SAFE_LEVEL_2),
+            (pack_snapshot(mosfet_temp=81), PACK_OVERTEMPERATURE_MOSFETS | PACK_NOT_SAFE_LEVEL_2),
+            (pack_snapshot(pack_temp=61), PACK_OVERTEMPERATURE_CELLS | PACK_NOT_SAFE_LEVEL_2),
+        )
+        for snapshot, expected in cases:
+            with self.subTest(snapshot=snapshot):
+                self.assertEqual(self.flags_of(snapshot), expected)
+
+    def test_growth_keeps_rows(self):
+        self.fleet.register('COM1', LIMITS)
+        self.fleet.register('COM2', LIMITS)
+        self.fleet.update('COM1', pack_snapshot(c2=4.2))
+        self.fleet.update('COM2', pack_snapshot())
+        self.fleet.register('COM3', LIMITS)
+        self.assertEqual(len(self.fleet.active), 4)
+        self.assertEqual(self.fleet.rows, {'COM1': 0, 'COM2': 1, 'COM3': 2})
+        flags = self.fleet.flags_by_port()
+        self.assertTrue(flags['COM1'] & PACK_NOT_SAFE_LEVEL_2)
+        self.assertEqual((flags['COM2'], flags['COM3']), (0, 0))
+        self.assertEqual(tuple(self.fleet.limits[0]), LIMITS.as_tuple())
+
+    def test_unregister_frees_the_row(self):
+        self.fleet.register('COM1', LIMITS)
+        self.fleet.register('COM2', LIMITS)
+        self.fleet.update('COM1', pack_snapshot(c2=4.2))
+        self.fleet.unregister('COM1')
+        self.assertEqual(self.fleet.flags_by_port(), {'COM2': 0})
+        # the freed row is reused, without the readings of its previous pack
+        self.assertEqual(self.fleet.register('COM3', LIMITS), 0)
+        self.assertEqual(self.fleet.ports[:2], ['COM3', 'COM2'])
+        self.assertEqual(self.fleet.flags_by_port(), {'COM2': 0, 'COM3': 0})
+        self.assertEqual(len(self.fleet.active), 2)
+
+
+class FleetDispatchTest(unittest.TestCase):
+    def setUp(self):
+        self.fleet = FleetSafetyEngine(capacity=2)
+        self.batteries = [FakeBattery('COM1'), FakeBattery('COM2')]
+        self.inverters = [FakeInverter(), FakeInverter()]
+        self.trips = []
+        self.monitors = [SafetyMonitor(battery, inverter, on_trip=self.on_trip, fleet=self.fleet)
+                         for battery, inverter in zip(self.batteries, self.inverters)]
+        for monitor in self.monitors:
+            monitor.attach()
+
+    def tearDown(self):
+        for battery in self.batteries:
+            battery.engine.loop.close()
+
+    async def on_trip(self, reason):
+        self.trips.append(reason)
+
+    def run_trips(self, battery):
+        loop = battery.engine.loop
+        pending = asyncio.all_tasks(loop)
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending))
+
+    def sample(self, index, snapshot):
+        for listener in self.batteries[index].sample_listeners:
+            listener(snapshot)
+
+    def test_level_2_stops_the_inverter_once(self):
+        self.sample(0, pack_snapshot(dc_current=60))
+        self.sample(1, pack_snapshot())
+        self.assertTrue(self.fleet.dirty)
+        for _ in range(3):
+            self.fleet.evaluate_and_dispatch()
+            self.run_trips(self.batteries[0])
+        self.assertEqual(self.inverters[0].stops, 1)
+        self.assertEqual(self.inverters[1].stops, 0)
+        self.assertTrue(self.monitors[0].tripped)
+        self.assertEqual(self.monitors[0].metrics.trips, 1)
+        self.assertEqual(len(self.trips), 1)
+        self.assertTrue(self.batteries[0].snapshot.has_flag(PACK_OVERCURRENT))
+
+    def test_level_1_only_sets_the_flags(self):
+        self.sample(1, pack_snapshot(c3=3.95))
+        self.fleet.evaluate_and_dispatch()
+        self.run_trips(self.batteries[1])
+        self.assertEqual(self.inverters[1].stops, 0)
+        self.assertFalse(self.monitors[1].tripped)
+        self.assertTrue(self.batteries[1].snapshot.has_flag(PACK_NOT_SAFE_LEVEL_1))
+
+    def test_detached_monitor(self):
+        self.monitors[0].detach()
+        self.assertEqual(self.batteries[0].sample_listeners, [])
+        self.assertNotIn('COM1', self.fleet.rows)
+        self.fleet.evaluate_and_dispatch()
+        self.assertEqual(self.inverters[0].stops, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+Drivers against the simulated rigs (Linux pseudo-terminals, see backend/apps/base/simulator).
+
+Run with the Django test runner (python manage.py test tests): the drivers read the settings. No database: the
+telemetry, live fields and live state stay off, and the samples the rig supervisor hands to the step integrator
+are not queued.
+"""
+import asyncio
+import os
+import unittest
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from backend.apps.base.integration import StepIntegrator
+from backend.apps.base.simulator import SimulatorHost
+from backend.apps.base.supervisor import RigSupervisor
+from backend.apps.base.utils import UsbIssBattery, VictronMultiplusMK2VCP
+
+
+@unittest.skipUnless(hasattr(os, 'openpty'), 'the simulator needs pseudo-terminals')
+@override_settings(TELEMETRY_ENABLED=False, LIVE_FIELDS_ENABLED=False, LIVE_STATE_ENABLED=False)
+class SimulatedRigTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(SimulatedRigTest, cls).setUpClass()
+        # cells at about 3.5 V, inside the level 1 limits of the settings
+        cls.host = SimulatorHost(1, soc=0.15)
+        cls.host.start()
+        cls.rig = cls.host.rigs[0]
+        ports = cls.host.ports()[0]
+        cls.battery = UsbIssBattery(ports['battery_port'])
+        cls.inverter = VictronMultiplusMK2VCP(ports['inverter_port'])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.battery.close_coms()
+        cls.inverter.close_coms()
+        cls.host.stop()
+        super(SimulatedRigTest, cls).tearDownClass()
+
+    def run_async(self, coro):
+        return self.battery.engine.run(coro, timeout=10)
+
+    def test_bring_up(self):
+        self.assertTrue(self.run_async(self.battery.bring_up_async(force=True)))
+        self.assertTrue(self.battery.iss_ready)
+        self.assertIsNotNone(self.battery.bring_up_seconds)
+        self.assertTrue(self.rig.pack.is_on(self.rig.pack.on_until - 1))
+        self.assertTrue(self.run_async(self.inverter.prepare_inverter_async(force=True)))
+        self.assertTrue(self.inverter.ve_bus_ready)
+
+    def test_refresh(self):
+        self.inverter.set_point = 300
+        self.assertTrue(self.run_async(self.inverter.refresh_async()))
+        self.assertEqual(self.rig.inverter.set_point, 300)
+        snapshot = self.inverter.snapshot
+        self.assertIsNotNone(snapshot.last_ac_update)
+        self.assertIsNotNone(snapshot.last_dc_update)
+        self.assertAlmostEqual(snapshot.dc_voltage, self.rig.pack.voltage, delta=0.5)
+        self.assertEqual(snapshot.ac_voltage, 230.0)
+
+    def test_keep_alive_and_poll_interleave(self):
+        self.assertTrue(self.run_async(self.battery.bring_up_async()))
+        requests = self.rig.battery.status_requests
+
+        async def cycles():
+            results = []
+            for _ in range(10):
+                results += await asyncio.gather(self.battery.turn_pack_on_async(), self.battery.update_values_async(),
+                                                self.battery.turn_pack_on_async(), self.battery.update_values_async())
+            return results
+
+        self.assertTrue(all(self.run_async(cycles())))
+        self.assertEqual(self.rig.battery.status_requests - requests, 20)
+        self.assertEqual(self.battery.snapshot.serial_number, self.rig.pack.serial_number)
+
+    @mock.patch.object(StepIntegrator, 'submit_sample')
+    def test_supervisor_cycle(self, submit_sample):
+        self.assertTrue(self.run_async(self.battery.bring_up_async()))
+        self.assertTrue(self.run_async(self.inverter.prepare_inverter_async()))
+        rig = RigSupervisor(1, self.battery, self.inverter, set_point=-400)
+        samples = []
+        jobs = rig.make_jobs()
+        self.battery.sample_listeners.append(samples.append)
+        try:
+            async def cycle():
+                # every job of the timer wheel fires on the same tick at the start of a test
+                return await asyncio.gather(*[job.callback() for job in jobs])
+
+            self.assertEqual(self.run_async(cycle()), [True] * len(jobs))
+        finally:
+            rig.cancel()
+            self.battery.sample_listeners.remove(samples.append)
+        self.assertEqual(self.rig.inverter.set_point, -400)
+        self.assertEqual(len(samples), 1)
+        self.assertEqual(samples[0].serial_number, self.rig.pack.serial_number)
+        submit_sample.assert_called_once_with(1, samples[0])
+        self.assertFalse(rig.safety_monitor.tripped)
+        self.assertIsNotNone(self.inverter.snapshot.last_dc_update)
+        self.assertNotIn(rig.integrate_pack_sample, self.battery.sample_listeners)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+"""
+Host supervisor against a simulated rig: rigs of finished test cases are released, one rig per port.
+"""
+import os
+import unittest
+from unittest import mock
+
+from django.test import TransactionTestCase, override_settings
+
+from backend.apps.base.models import Battery, Inverter, InverterPool, TestCase
+from backend.apps.base.simulator import SimulatorHost
+from backend.apps.base.supervisor import HostSupervisor
+from backend.apps.base.utils import UsbIssBattery, VictronMultiplusMK2VCP
+
+
+@unittest.skipUnless(hasattr(os, 'openpty'), 'the simulator needs pseudo-terminals')
+@override_settings(TELEMETRY_ENABLED=False, LIVE_FIELDS_ENABLED=False, LIVE_STATE_ENABLED=False)
+class HostSupervisorTest(TransactionTestCase):
+    # the supervisor queries the test cases from the executor threads, they must see committed rows
+
+    @classmethod
+    def setUpClass(cls):
+        super(HostSupervisorTest, cls).setUpClass()
+        cls.host = SimulatorHost(1, soc=0.15)
+        cls.host.start()
+        cls.ports = cls.host.ports()[0]
+
+    @classmethod
+    def tearDownClass(cls):
+        for instances, port in ((UsbIssBattery.battery_instances, cls.ports['battery_port']),
+                                (VictronMultiplusMK2VCP.inverter_instances, cls.ports['inverter_port'])):
+            if port in instances:
+                instances.pop(port).close_coms()
+        cls.host.stop()
+        super(HostSupervisorTest, cls).tearDownClass()
+
+    def setUp(self):
+        self.battery = Battery.objects.create(name='pack', port=self.ports['battery_port'])
+        pool = InverterPool.objects.create(name='pool')
+        self.inverter = Inverter.objects.create(name='inverter', port=self.ports['inverter_port'], inverter_pool=pool)
+        self.supervisor = HostSupervisor()
+
+    def tearDown(self):
+        for test_case_id in list(self.supervisor.rigs):
+            self.supervisor.stop_rig(test_case_id)
+
+    def start(self, test_case):
+        return self.supervisor.start_rig(test_case.id, self.battery.port, self.inverter.port, -400)
+
+    def make_test_case(self, state='RUNNING'):
+        # the rig is handed to the supervisor by the test, not by main_task
+        with mock.patch('backend.apps.base.models.test_case.main_task'):
+            return TestCase.objects.create(name='test', battery=self.battery, inverter=self.inverter, state=state)
+
+    def finish(self, test_case):
+        TestCase.objects.filter(id=test_case.id).update(state='FINISHED')
+
+    def release_finished_rigs(self):
+        return self.supervisor.engine.run(self.supervisor.release_finished_rigs(), timeout=10)
+
+    def test_releases_finished_rigs(self):
+        test_case = self.make_test_case()
+        self.assertTrue(self.start(test_case))
+        self.release_finished_rigs()
+        self.assertEqual(self.supervisor.supervised_rigs(), [test_case.id])
+
+        self.finish(test_case)
+        self.release_finished_rigs()
+        self.assertEqual(self.supervisor.supervised_rigs(), [])
+        self.assertNotIn(self.battery.port, self.supervisor.fleet.rows)
+
+    def test_one_rig_per_port(self):
+        first, second = self.make_test_case(), self.make_test_case()
+        self.assertTrue(self.start(first))
+        with self.assertLogs('base', 'ERROR'):
+            self.assertFalse(self.start(second))
+        self.assertEqual(self.supervisor.supervised_rigs(), [first.id])
+
+        self.finish(first)
+        self.assertTrue(self.start(second))
+        self.assertEqual(self.supervisor.supervised_rigs(), [second.id])
+        self.assertIs(self.supervisor.fleet.monitors[self.battery.port], self.supervisor.rigs[second.id].safety_monitor)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+"""
+TelemetryWriter: batched sample inserts, retry of the failed batches, the bounded buffer and the rollups merged across
+writers.
+"""
+import unittest
+from unittest import mock
+
+from django.db import DatabaseError
+from django.test import TestCase
+
+from backend.apps.base.models import TelemetryRollup, TelemetrySample
+from backend.apps.base.snapshots import InverterSnapshot, PackSnapshot
+from backend.apps.base.telemetry import TelemetryWriter
+
+from .fixtures import create_test_case
+
+
+def pack_snapshot(timestamp, current=5.0):
+    return PackSnapshot(1, [3.5] * 9, current, 30.0, 25.0, timestamp=timestamp)
+
+
+class TelemetryWriterTest(TestCase):
+    def setUp(self):
+        # flushed by the test, not by the background thread
+        patcher = mock.patch.object(TelemetryWriter, '_start')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.writer = TelemetryWriter(batch_size=100, flush_interval=0, max_buffer=5)
+
+    def record(self, count, start=60.0):
+        for index in range(count):
+            self.writer.record_pack(None, 'COM1', pack_snapshot(start + index))
+
+    def test_flush(self):
+        self.record(3)
+        inverter = InverterSnapshot(ac_voltage=230.0, last_ac_update=61.5, last_dc_update=61.4)
+        self.writer.record_inverter(None, 'COM2', inverter)
+        self.writer.record_inverter(None, 'COM2', InverterSnapshot())
+        self.assertEqual(self.writer.flush(), 4)
+        self.assertEqual(self.writer.buffer, [])
+        pack = TelemetrySample.objects.filter(device='battery').order_by('timestamp').first()
+        self.assertAlmostEqual(pack.dc_voltage, 31.5)
+        self.assertEqual((pack.cv_9, pack.dc_current, pack.port), (3.5, 5.0, 'COM1'))
+        self.assertEqual(TelemetrySample.objects.get(device='inverter').ac_voltage, 230.0)
+        self.assertEqual(self.writer.flush(), 0)
+
+    def test_failed_batch_is_retried(self):
+        self.record(3)
+        with mock.patch.object(TelemetrySample.objects, 'bulk_create', side_effect=DatabaseError('gone')):
+            with self.assertLogs('base', 'ERROR'):
+                self.assertEqual(self.writer.flush(), 0)
+        self.assertEqual(len(self.writer.buffer), 3)
+        self.record(1, start=63.0)
+        self.assertEqual(self.writer.flush(), 4)
+        self.assertEqual(list(TelemetrySample.objects.order_by('timestamp').values_list('timestamp', flat=True)),
+                         [60.0, 61.0, 62.0, 63.0])
+        self.assertEqual(self.writer.samples_dropped, 0)
+
+    def test_buffer_bound(self):
+        self.record(4)
+        with mock.patch.object(TelemetrySample.objects, 'bulk_create', side_effect=DatabaseError('gone')):
+            with self.assertLogs('base', 'ERROR'):
+                self.writer.flush()
+                self.record(3, start=64.0)
+                self.writer.flush()
+        # the oldest go first
+        self.assertEqual([sample.timestamp for sample in self.writer.buffer], [62.0, 63.0, 64.0, 65.0, 66.0])
+        self.assertEqual(self.writer.samples_dropped, 2)
+
+    def test_failed_rollups_are_retried(self):
+        # one row per channel and bucket
+        self.writer.max_buffer = 100
+        self.record(2)
+        self.writer.rollups.close_all()
+        with mock.patch.object(TelemetryRollup.objects, 'bulk_create', side_effect=DatabaseError('gone')):
+            with self.assertLogs('base', 'ERROR'):
+                self.assertEqual(self.writer.flush(), 2)
+        self.assertEqual(TelemetryRollup.objects.count(), 0)
+        self.assertTrue(self.writer.pending_rollups)
+        self.writer.flush()
+        self.assertEqual(self.writer.pending_rollups, [])
+        self.assertEqual(TelemetryRollup.objects.get(channel='dc_current', period='minute').count, 2)
+
+
+class RollupMergeTest(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(TelemetryWriter, '_start')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.test_case = create_test_case()
+        # one writer per process
+        self.writers = [TelemetryWriter(flush_interval=0), TelemetryWriter(flush_interval=0)]
+
+    def record(self, writer, timestamp, current):
+        writer.record_pack(self.test_case.id, 'COM3', pack_snapshot(timestamp, current))
+
+    def close(self, writer):
+        writer.rollups.close_all()
+        writer.flush()
+
+    def test_one_row_per_bucket(self):
+        self.record(self.writers[0], 60.0, 2.0)
+        self.record(self.writers[1], 61.0, 6.0)
+        self.record(self.writers[0], 62.0, 4.0)
+        self.record(self.writers[1], 125.0, 1.0)
+        for writer in self.writers:
+            self.close(writer)
+        minutes = TelemetryRollup.objects.filter(channel='dc_current', period='minute').order_by('bucket')
+        self.assertEqual([rollup.bucket for rollup in minutes], [1, 2])
+        rollup = minutes[0]
+        self.assertEqual((rollup.count, rollup.minimum, rollup.maximum, rollup.start, rollup.end),
+                         (3, 2.0, 6.0, 60.0, 62.0))
+        self.assertAlmostEqual(rollup.mean, 4.0)
+        # the latest sample of the bucket, whatever the writer that flushed last
+        self.assertEqual(rollup.last, 4.0)
+
+    def test_step_buckets(self):
+        for writer in self.writers:
+            writer.start_step(self.test_case.id, 0)
+        self.record(self.writers[0], 60.0, 2.0)
+        self.record(self.writers[1], 90.0, 4.0)
+        for writer in self.writers:
+            writer.finish_test_case(self.test_case.id)
+            writer.flush()
+        rollup = TelemetryRollup.objects.get(channel='dc_current', period='step')
+        self.assertEqual((rollup.step_index, rollup.bucket, rollup.count, rollup.last), (0, 0, 2, 4.0))
+
+    def test_failed_merge_is_retried_once(self):
+        self.record(self.writers[0], 60.0, 2.0)
+        self.close(self.writers[0])
+        self.record(self.writers[1], 61.0, 4.0)
+        self.writers[1].rollups.close_all()
+        with mock.patch.object(TelemetryRollup.objects, 'bulk_create', side_effect=DatabaseError('gone')):
+            with self.assertLogs('base', 'ERROR'):
+                self.writers[1].flush()
+        # nothing of the failed batch was merged
+        self.assertEqual(TelemetryRollup.objects.get(channel='dc_current', period='minute').count, 1)
+        self.writers[1].flush()
+        self.assertEqual(TelemetryRollup.objects.get(channel='dc_current', period='minute').count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
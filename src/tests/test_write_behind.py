@@ -0,0 +1,110 @@
+"""
+Write-behind mirror of the live values into the Battery and Inverter rows.
+"""
+import unittest
+from unittest import mock
+
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+
+from backend.apps.base.models import Battery, Inverter, InverterPool
+from backend.apps.base.snapshots import InverterSnapshot, PackSnapshot
+from backend.apps.base.utils import UsbIssBattery, VictronMultiplusMK2VCP
+from backend.apps.base.write_behind import BATTERY_MODEL, WriteBehindCache, mirror_pack_state
+
+
+def pack_snapshot(current=5.0):
+    return PackSnapshot(1, [3.5] * 9, current, 30.0, 25.0)
+
+
+class WriteBehindCacheTest(TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(WriteBehindCache, '_start')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = WriteBehindCache()
+        # two rows on the same port, e.g. a pack replaced on its rig
+        self.battery = Battery.objects.create(name='pack', port='COM3')
+        self.other = Battery.objects.create(name='old pack', port='COM3')
+
+    def dc_current(self, battery=None):
+        return Battery.objects.get(id=(battery or self.battery).id).dc_current
+
+    def test_coalesced_and_keyed_by_row(self):
+        self.cache.mirror_pack(self.battery.id, pack_snapshot(1.0))
+        self.cache.mirror_pack(self.battery.id, pack_snapshot(2.0))
+        self.assertEqual(self.cache.flush(), 1)
+        self.assertEqual(self.dc_current(), '2.000')
+        self.assertEqual(Battery.objects.get(id=self.battery.id).dc_voltage, '31.500')
+        self.assertIsNone(self.dc_current(self.other))
+        # nothing changed, nothing to write
+        self.cache.mirror_pack(self.battery.id, pack_snapshot(2.0))
+        self.assertEqual(self.cache.flush(), 0)
+
+    def test_value_back_during_the_flush(self):
+        self.cache.mirror_pack(self.battery.id, pack_snapshot(1.0))
+        self.cache.flush()
+        self.cache.mirror_pack(self.battery.id, pack_snapshot(2.0))
+        update = self.cache._update
+
+        def update_while_staging(model, rows):
+            # the reading goes back to the value of the previous flush while 2.000 is being written
+            self.cache.mirror_pack(self.battery.id, pack_snapshot(1.0))
+            update(model, rows)
+        with mock.patch.object(self.cache, '_update', side_effect=update_while_staging):
+            self.cache.flush()
+        self.assertEqual(self.dc_current(), '2.000')
+        self.cache.flush()
+        self.assertEqual(self.dc_current(), '1.000')
+
+    def test_failed_flush_is_put_back(self):
+        self.cache.mirror_pack(self.battery.id, pack_snapshot(1.0))
+        self.cache.flush()
+        self.cache.mirror_pack(self.battery.id, pack_snapshot(2.0))
+        with mock.patch.object(self.cache, '_update', side_effect=DatabaseError('gone')):
+            with self.assertLogs('base', 'ERROR'):
+                self.assertEqual(self.cache.flush(), 0)
+        self.assertEqual(self.cache.written[(BATTERY_MODEL, self.battery.id)]['dc_current'], '1.000')
+        # back to the value the row still has: nothing to write any more
+        self.cache.mirror_pack(self.battery.id, pack_snapshot(1.0))
+        self.assertNotIn('dc_current', self.cache.pending.get((BATTERY_MODEL, self.battery.id), {}))
+        self.cache.mirror_pack(self.battery.id, pack_snapshot(3.0))
+        self.cache.flush()
+        self.assertEqual(self.dc_current(), '3.000')
+
+    def test_inverter(self):
+        inverter = Inverter.objects.create(name='inverter', port='COM4',
+                                           inverter_pool=InverterPool.objects.create(name='pool'))
+        self.cache.mirror_inverter(inverter.id, InverterSnapshot(dc_voltage=51.2, ac_voltage=230.0), -400)
+        self.cache.flush()
+        inverter.refresh_from_db()
+        self.assertEqual((inverter.dc_voltage, inverter.ac_voltage, inverter.setpoint), ('51.20', '230.00', '-400'))
+
+
+class DriverDeviceIdTest(TestCase):
+    def setUp(self):
+        # drivers already open on the ports, as in the process owning them
+        UsbIssBattery.battery_instances['COM3'] = UsbIssBattery('COM3', serial_handle=mock.MagicMock())
+        VictronMultiplusMK2VCP.inverter_instances['COM4'] = VictronMultiplusMK2VCP('COM4',
+                                                                                   serial_handle=mock.MagicMock())
+
+    def tearDown(self):
+        UsbIssBattery.battery_instances.pop('COM3', None)
+        VictronMultiplusMK2VCP.inverter_instances.pop('COM4', None)
+
+    def test_utilities_carry_the_row_id(self):
+        battery = Battery.objects.create(name='pack', port='COM3')
+        inverter = Inverter.objects.create(name='inverter', port='COM4',
+                                           inverter_pool=InverterPool.objects.create(name='pool'))
+        self.assertEqual(battery.battery_utilities.device_id, battery.id)
+        self.assertEqual(inverter.inverter_utilities.device_id, inverter.id)
+
+    @override_settings(LIVE_FIELDS_ENABLED=True)
+    @mock.patch('backend.apps.base.write_behind.get_write_behind_cache')
+    def test_driver_without_row(self, get_cache):
+        mirror_pack_state(None, pack_snapshot())
+        get_cache.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()